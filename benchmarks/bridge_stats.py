@@ -0,0 +1,109 @@
+"""Benchmarks the cost of recording a pop, a submit and a job in the bridge stats, with an hour of them recorded
+already, against the way it used to be done (kept below), which went through all of them on every update.
+
+The clock is simulated, so the hour of history takes no time to build. The averages of both are printed side
+by side, as the rolling windows expire their values by buckets rather than one by one.
+
+Usage: python -m benchmarks.bridge_stats [--rate 5] [--updates 20000]
+"""
+import argparse
+import random
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from worker import stats
+from worker.stats import BridgeStats
+
+clock = SimpleNamespace(now=0.0)
+
+
+class ReferenceBridgeStats:
+    """The pop, submit and kudos stats of BridgeStats, the way they used to be calculated"""
+
+    def __init__(self):
+        self.stats = {}
+        self.kudos_record = deque()
+        self.pop_record = deque()
+        self.submit_record = deque()
+
+    def update_pop_stats(self, node, pop_time):
+        self.pop_record.append((node, pop_time, clock.now))
+        now = clock.now
+        too_old = now - 3600
+        while self.pop_record and self.pop_record[0][2] < too_old:
+            self.pop_record.popleft()
+        recent = now - (60 * 5)
+        average_1_hour = sum(poptime for _, poptime, _ in self.pop_record) / len(self.pop_record)
+        data_5_mins = [poptime for _, poptime, when in self.pop_record if when > recent]
+        self.stats["pop_time_avg_5_mins"] = round(sum(data_5_mins) / len(data_5_mins), 2)
+        self.stats["pop_time_avg_1_hour"] = round(average_1_hour, 2)
+
+    def update_submit_stats(self, queue_time, submit_time):
+        now = clock.now
+        self.submit_record.append((queue_time, submit_time, now))
+        too_old = now - 3600
+        while self.submit_record and self.submit_record[0][2] < too_old:
+            self.submit_record.popleft()
+        recent = now - (60 * 5)
+        data_5_mins = [(queued, submit) for queued, submit, when in self.submit_record if when > recent]
+        self.stats["submit_queue_time_avg_5_mins"] = round(sum(q for q, _ in data_5_mins) / len(data_5_mins), 2)
+        self.stats["submit_time_avg_5_mins"] = round(sum(s for _, s in data_5_mins) / len(data_5_mins), 2)
+
+    def update_inference_stats(self, model_name, kudos):  # noqa: ARG002
+        now = clock.now
+        too_old = now - 3600
+        self.kudos_record.append((kudos, now))
+        oldest = self.kudos_record[0][1]
+        while self.kudos_record and self.kudos_record[0][1] < too_old:
+            oldest = self.kudos_record.popleft()[1]
+        period = now - oldest
+        total_kudos = 0 if period < 10 else sum(score for score, _ in self.kudos_record) * (3600 / period)
+        jobs_per_hour = 1 if period < 10 else len(self.kudos_record) * (3600 / period)
+        self.stats["kudos_per_hour"] = round(total_kudos)
+        self.stats["jobs_per_hour"] = round(jobs_per_hour)
+
+
+def record_job(bridge_stats, rng):
+    bridge_stats.update_pop_stats("node", rng.lognormvariate(-1, 0.5))
+    bridge_stats.update_submit_stats(rng.expovariate(20), rng.lognormvariate(0, 0.4))
+    bridge_stats.update_inference_stats("model", rng.uniform(5, 30))
+
+
+def time_update_us(bridge_stats, args):
+    """Fills an hour of jobs, then times recording some more"""
+    rng = random.Random(42)
+    clock.now = 1_000_000.0
+    for _ in range(3600 * args.rate):
+        clock.now += 1 / args.rate
+        record_job(bridge_stats, rng)
+    elapsed = 0
+    for _ in range(args.updates):
+        clock.now += 1 / args.rate
+        start = time.perf_counter()
+        record_job(bridge_stats, rng)
+        elapsed += time.perf_counter() - start
+    return round(1_000_000 * elapsed / args.updates, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark recording the bridge stats")
+    parser.add_argument("--rate", type=int, default=5, help="Jobs per second")
+    parser.add_argument("--updates", type=int, default=20_000, help="How many jobs to time")
+    args = parser.parse_args()
+    stats.time = SimpleNamespace(time=lambda: clock.now)
+    reference = ReferenceBridgeStats()
+    rolling = BridgeStats()
+    reference_us = time_update_us(reference, args)
+    rolling_us = time_update_us(rolling, args)
+    print(f"{3600 * args.rate} jobs in the last hour")
+    print(f"reference:       {reference_us:>8} us per job")
+    print(f"rolling windows: {rolling_us:>8} us per job")
+    snapshot = rolling.snapshot()
+    for key, value in reference.stats.items():
+        print(f"{key:<30} {value:>10} {snapshot[key]:>10}")
+    print({key: value for key, value in snapshot.items() if key not in rolling.stats})
+    start = time.perf_counter()
+    for _ in range(1000):
+        rolling.snapshot()
+    print(f"snapshot: {round(1000 * (time.perf_counter() - start), 1)} us")
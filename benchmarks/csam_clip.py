@@ -0,0 +1,87 @@
+"""Benchmarks the CLIP part of the CSAM check on CPU, with a small stand-in CLIP model.
+
+Compares re-encoding the vocabulary on every image (as the interrogator does) with the cached text features,
+where each check is a single image encode and one matrix multiply.
+
+Usage: python -m benchmarks.csam_clip [--checks 50] [--width 512]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from worker import csam
+
+
+class StandInClip(torch.nn.Module):
+    """Same interface as a CLIP model, with a fraction of the parameters"""
+
+    def __init__(self, width, vocab_size=49408, context_length=77, image_size=224, patch_size=16):
+        super().__init__()
+        self.vocab_size = vocab_size
+        self.context_length = context_length
+        self.token_embedding = torch.nn.Embedding(vocab_size, width)
+        self.text_encoder = torch.nn.TransformerEncoder(
+            torch.nn.TransformerEncoderLayer(width, nhead=8, batch_first=True),
+            num_layers=2,
+        )
+        self.patch_embedding = torch.nn.Conv2d(3, width, kernel_size=patch_size, stride=patch_size)
+        self.image_encoder = torch.nn.TransformerEncoder(
+            torch.nn.TransformerEncoderLayer(width, nhead=8, batch_first=True),
+            num_layers=2,
+        )
+        self.image_size = image_size
+
+    def tokenize(self, texts):
+        tokens = torch.zeros(len(texts), self.context_length, dtype=torch.long)
+        for index, text in enumerate(texts):
+            encoded = [hash(word) % self.vocab_size for word in text.split()][: self.context_length]
+            tokens[index, : len(encoded)] = torch.tensor(encoded)
+        return tokens
+
+    def preprocess(self, image):
+        pixels = np.asarray(image.convert("RGB").resize((self.image_size, self.image_size)), dtype=np.float32)
+        return torch.from_numpy(pixels / 255).permute(2, 0, 1)
+
+    def encode_text(self, tokens):
+        return self.text_encoder(self.token_embedding(tokens)).mean(dim=1)
+
+    def encode_image(self, pixels):
+        patches = self.patch_embedding(pixels).flatten(2).transpose(1, 2)
+        return self.image_encoder(patches).mean(dim=1)
+
+
+def uncached_similarities(clip_model, image, words):
+    """What the interrogator does for each image: encode the vocabulary again, then compare"""
+    with torch.no_grad():
+        text_features = clip_model["model"].encode_text(clip_model["tokenizer"](list(words))).float()
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+        image_features = clip_model["model"].encode_image(clip_model["preprocess"](image).unsqueeze(0)).float()
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+    return {word: float(image_features[0] @ text_features[index]) for index, word in enumerate(words)}
+
+
+def measure(get_similarities, clip_model, images, words):
+    start = time.perf_counter()
+    results = [get_similarities(clip_model, image, words) for image in images]
+    return round(1000 * (time.perf_counter() - start) / len(images), 2), results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CLIP part of the CSAM check on CPU")
+    parser.add_argument("--checks", type=int, default=50, help="How many images to check")
+    parser.add_argument("--width", type=int, default=512, help="Embedding width of the stand-in model")
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    model = StandInClip(args.width).eval()
+    clip_model = {"model": model, "preprocess": model.preprocess, "device": "cpu", "tokenizer": model.tokenize}
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 255, (512, 512, 3), dtype="uint8")) for _ in range(args.checks)]
+    words = csam.get_word_list()
+    uncached_ms, expected = measure(uncached_similarities, clip_model, images, words)
+    cached_ms, results = measure(csam.get_similarities, clip_model, images, words)
+    max_difference = max(abs(result[word] - exp[word]) for result, exp in zip(results, expected) for word in words)
+    print(f"re-encoding the vocabulary: {uncached_ms} ms per check")
+    print(f"cached text features:       {cached_ms} ms per check (max similarity difference {max_difference:.2e})")
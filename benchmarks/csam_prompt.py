@@ -0,0 +1,197 @@
+"""Benchmarks the prompt normalization and boost matching of the CSAM checker, for prompts of 50 to 5000 chars.
+
+Before timing anything, the current implementation is checked against the reference one (the way it used to be
+done, kept below) on a golden corpus of generated prompts, which mixes in the boost words, weights, punctuation,
+spaced out letters and accents. Any difference aborts the benchmark.
+
+Usage: python -m benchmarks.csam_prompt [--prompts 200] [--seed 42]
+"""
+import argparse
+import random
+import sys
+import time
+
+import regex as re
+from unidecode import unidecode
+
+from worker import csam
+
+WORDS = [
+    "girl",
+    "boy",
+    "nina",
+    "flat chest",
+    "pigtails",
+    "pig tails",
+    "baby",
+    "toddler",
+    "infant",
+    "child",
+    "kid",
+    "kind",
+    "angel",
+    "sister",
+    "bro",
+    "daughter",
+    "tochter",
+    "son",
+    "twin",
+    "small",
+    "little",
+    "tiny",
+    "petite",
+    "woman",
+    "adult",
+    "old",
+    "years old",
+    "year old",
+    "school",
+    "grade",
+    "class",
+    "high class",
+    "kitten",
+    "realistic",
+    "portrait",
+    "landscape",
+    "masterpiece",
+    "best quality",
+    "castle",
+    "dragon",
+    "mature",
+    "elderly",
+    "middle aged",
+    "young",
+    "café",
+    "naïve",
+    "Zoë",
+    "日本",
+    "classic",
+    "grandson",
+    "Girl",
+    "SCHOOL",
+]
+DECORATIONS = [
+    lambda word: word,
+    lambda word: f"({word}:1.2)",
+    lambda word: f"(({word}:1.1):0.9)",
+    lambda word: f"[{word}]",
+    lambda word: f"{word}_{word}",
+    lambda word: " ".join(word),
+    lambda word: "  ".join(word),
+    lambda word: f"{word},",
+    lambda word: f"{word}!!",
+    lambda word: f"{word}\t",
+    lambda word: f"{word}\n",
+]
+
+
+def reference_normalize_prompt(prompt):
+    """normalize_prompt, the way it used to be done"""
+    negprompt = None
+    if "###" in prompt:
+        prompt, negprompt = prompt.split("###", 1)
+    prompt = csam.weight_remover.sub(r"\1", prompt)
+    prompt = csam.whitespace_converter.sub(" ", prompt)
+    for match in re.finditer(csam.whitespace_remover, prompt):
+        trim_match = match.group(0).strip()
+        replacement = re.sub(r"\s+", "", trim_match)
+        prompt = prompt.replace(trim_match, replacement)
+    prompt = re.sub(r"\s+", " ", prompt)
+    prompt = unidecode(prompt)
+    if negprompt:
+        negprompt = csam.weight_remover.sub(r"\1", negprompt)
+        negprompt = csam.whitespace_converter.sub(" ", negprompt)
+        for match in re.finditer(csam.whitespace_remover, negprompt):
+            trim_match = match.group(0).strip()
+            replacement = re.sub(r"\s+", "", trim_match)
+            negprompt = negprompt.replace(trim_match, replacement)
+        negprompt = re.sub(r"\s+", " ", negprompt)
+        negprompt = unidecode(negprompt)
+    return prompt, negprompt
+
+
+def reference_find_prompt_boosts(prompt):
+    """The boost matching, the way it used to be done: one search per boost"""
+    found = []
+    for entry in csam.PROMPT_BOOSTS:
+        prompt_re = entry["regex"].search(prompt)
+        found.append(prompt_re.group() if prompt_re else None)
+    return found
+
+
+def generate_prompt(rng, length):
+    parts = []
+    while sum(len(part) + 2 for part in parts) < length:
+        parts.append(rng.choice(DECORATIONS)(rng.choice(WORDS)))
+    prompt = ", ".join(parts)[:length]
+    if rng.random() < 0.5:
+        prompt = f"{prompt}###{generate_prompt(rng, max(length // 4, 10))}".replace("######", "###")
+    return prompt
+
+
+def generate_corpus(args):
+    rng = random.Random(args.seed)
+    corpus = {length: [generate_prompt(rng, length) for _ in range(args.prompts)] for length in args.lengths}
+    # The corner cases which motivated each step of the normalization
+    corpus[0] = [
+        "",
+        "###",
+        "a b c d girl",
+        "xa b c girl a b c",
+        "a b cd, a b c",
+        "(g i r l:1.3), (school:0.8)",
+        "((child:1.1):1.2) ###(old:1.5)",
+        "ｇｉｒｌ, naïve café",
+        "10 years old, old man, classic",
+        "high class, class, grandson, son",
+        "\x1cgirl\x1f\x00KID, Kind\u00a0child\u2003old",
+    ]
+    return corpus
+
+
+def check_golden(corpus):
+    mismatches = 0
+    for prompts in corpus.values():
+        for prompt in prompts:
+            expected_prompt, expected_negprompt = reference_normalize_prompt(prompt)
+            if csam.normalize_prompt(prompt) != (expected_prompt, expected_negprompt):
+                mismatches += 1
+                print(f"Normalization mismatch for {prompt!r}")
+            if csam.find_prompt_boosts(expected_prompt) != reference_find_prompt_boosts(expected_prompt):
+                mismatches += 1
+                print(f"Boost mismatch for {expected_prompt!r}")
+    return mismatches
+
+
+def time_per_prompt(prompts, function, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for prompt in prompts:
+            function(prompt)
+    return round(1_000_000 * (time.perf_counter() - start) / (repeats * len(prompts)), 1)
+
+
+def reference_pipeline(prompt):
+    return reference_find_prompt_boosts(reference_normalize_prompt(prompt)[0])
+
+
+def current_pipeline(prompt):
+    return csam.find_prompt_boosts(csam.normalize_prompt(prompt)[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CSAM prompt normalization and boost matching")
+    parser.add_argument("--prompts", type=int, default=200, help="Prompts per length in the golden corpus")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[50, 200, 1000, 5000], help="Prompt lengths")
+    parser.add_argument("--repeats", type=int, default=3, help="How many times to time each corpus")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the golden corpus")
+    args = parser.parse_args()
+    corpus = generate_corpus(args)
+    if mismatches := check_golden(corpus):
+        print(f"{mismatches} results differ from the reference implementation")
+        sys.exit(1)
+    print(f"Identical results on {sum(len(prompts) for prompts in corpus.values())} prompts")
+    for length in args.lengths:
+        reference = time_per_prompt(corpus[length], reference_pipeline, args.repeats)
+        current = time_per_prompt(corpus[length], current_pipeline, args.repeats)
+        print(f"{length:>5} chars: reference {reference:>8} us, current {current:>8} us per prompt")
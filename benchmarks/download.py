@@ -0,0 +1,170 @@
+"""Benchmarks downloading and decoding the source images of the jobs from a local HTTP server, against the way it
+used to be done (kept below): one image after the other, with the chunks added up, and decoded at full size.
+
+The server waits --latency seconds before answering each request, to stand for the distance to R2, and serves
+JPEGs and PNGs. It also checks that images over the size cap are refused, with their size announced or not.
+The source cache is disabled for those timings, then the same images are fetched again through it: from memory,
+from disk (as after a restart, or once evicted from memory), and at new urls with the same content.
+
+Usage: python -m benchmarks.download [--images 8] [--size 2048] [--latency 0.1] [--target 1024]
+"""
+import argparse
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from worker.jobs.downloader import ImageDownloader
+from worker.jobs.source_cache import source_cache
+from worker.metrics import metrics
+from worker.sessions import http_session
+
+
+def reference_download(image_url):
+    """JobPopper.download_image_data and convert_image_data_to_pil, as they were"""
+    img_data = None
+    with http_session.get(image_url, stream=True, timeout=2) as r:
+        size = r.headers.get("Content-Length", 0)
+        if int(size) > 5120000:
+            return None
+        mbs = 0
+        for chunk in r.iter_content(chunk_size=1024 * 1024):
+            if chunk:
+                if mbs == 0:
+                    img_data = chunk
+                else:
+                    img_data += chunk
+                mbs += 1
+                if mbs > 5:
+                    return None
+    img = Image.open(BytesIO(img_data))
+    if len(img.split()) == 4:
+        return img.convert("RGBA")
+    return img.convert("RGB")
+
+
+def get_test_image(size, image_format, noise):
+    rng = np.random.default_rng(42)
+    gradient = np.linspace(0, 200, size)
+    pixels = gradient[None, :, None] * 0.6 + gradient[:, None, None] * 0.4 + rng.normal(0, noise, (size, size, 3))
+    buffer = BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype("uint8")).save(buffer, format=image_format, quality=90)
+    return buffer.getvalue()
+
+
+def start_server(files, latency):
+    """Serves the files by path. Paths starting with /chunked/ are sent without their size"""
+
+    class ImageHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            path = self.path.split("?", 1)[0]
+            chunked = path.startswith("/chunked/")
+            body = files.get(path.removeprefix("/chunked"))
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            if chunked:
+                # Sent without its size
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for start in range(0, len(body), 65536):
+                    chunk = body[start : start + 65536]
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                self.wfile.write(b"0\r\n\r\n")
+            else:
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    server.daemon_threads = True
+    # The downloads refused for their size are cut short
+    server.handle_error = lambda *args: None  # noqa: ARG005
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def time_ms(function, repeats=3):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, round(1000 * min(timings), 1)
+
+
+def benchmark_cache(downloader, base_url, args):
+    """Times the same images fetched again, from each tier of the source cache"""
+    size = (args.target, args.target)
+    for path in ("/image.jpg", "/image.png"):
+        urls = [f"{base_url}{path}?cached{index}" for index in range(args.images)]
+        with tempfile.TemporaryDirectory() as directory:
+            source_cache.configure(max_memory=1024 * 1024 * 1024, max_disk=1024 * 1024 * 1024, directory=directory)
+            _, first_ms = time_ms(lambda urls=urls: downloader.fetch_all(urls, size), repeats=1)
+            images, memory_ms = time_ms(lambda urls=urls: downloader.fetch_all(urls, size))
+            # Changing the cached images must not change those of the next jobs
+            before = np.asarray(images[1]).copy()
+            images[0].paste((255, 0, 0), (0, 0, *images[0].size))
+            untouched = np.array_equal(np.asarray(downloader.fetch_all(urls[1:2], size)[0]), before)
+            source_cache.configure(max_memory=0)
+            _, disk_ms = time_ms(lambda urls=urls: downloader.fetch_all(urls, size))
+            source_cache.configure(max_memory=1024 * 1024 * 1024)
+            downloader.fetch_all(urls, size)
+            source_cache.configure(max_disk=0)
+            new_urls = [f"{base_url}{path}?other{index}" for index in range(args.images)]
+            _, content_ms = time_ms(lambda urls=new_urls: downloader.fetch_all(urls, size), repeats=1)
+        print(f"{args.images} x {path} again, cached images left untouched by the jobs: {untouched}")
+        print(f"  first fetch:  {first_ms:>8} ms")
+        print(f"  from memory:  {memory_ms:>8} ms")
+        print(f"  from disk:    {disk_ms:>8} ms")
+        print(f"  new urls:     {content_ms:>8} ms, with the same content")
+    print(metrics.render().decode("utf-8").split("# HELP horde_worker_source_cache_total")[1].split("# HELP")[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark downloading and decoding source images")
+    parser.add_argument("--images", type=int, default=8, help="How many images a job has, e.g. interrogation forms")
+    parser.add_argument("--size", type=int, default=2048, help="Width and height of the images")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds before the server answers")
+    parser.add_argument("--target", type=int, default=1024, help="The size the images are used at")
+    args = parser.parse_args()
+    # Less noise in the PNG, so that it stays under the size cap
+    files = {"/image.jpg": get_test_image(args.size, "JPEG", 12), "/image.png": get_test_image(args.size, "PNG", 0)}
+    files["/too_big.bin"] = b"\0" * 6_000_000
+    server = start_server(files, args.latency)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    downloader = ImageDownloader(threads=args.images)
+    for path, body in files.items():
+        print(f"{path}: {len(body) // 1024} KB")
+    print(f"too big refused: {downloader.download(base_url + '/too_big.bin') is None}")
+    print(f"too big refused without its size: {downloader.download(base_url + '/chunked/too_big.bin') is None}")
+
+    # The images at every url are the same, which the cache would notice
+    source_cache.configure(max_memory=0)
+    for path in ("/image.jpg", "/image.png"):
+        # Distinct urls, as the downloader fetches the same url only once
+        urls = [f"{base_url}{path}?{index}" for index in range(args.images)]
+        size = (args.target, args.target)
+        reference, reference_ms = time_ms(lambda urls=urls: [reference_download(url) for url in urls])
+        downloaded, downloaded_ms = time_ms(lambda urls=urls: downloader.fetch_all(urls))
+        reduced, reduced_ms = time_ms(lambda urls=urls, size=size: downloader.fetch_all(urls, size))
+        same = all(
+            a is not None and np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(reference, downloaded)
+        )
+        print(f"{args.images} x {path}, same pixels as the reference: {same}")
+        print(f"  reference:  {reference_ms:>8} ms")
+        print(f"  concurrent: {downloaded_ms:>8} ms")
+        print(f"  reduced:    {reduced_ms:>8} ms, to {reduced[0].size}")
+    benchmark_cache(downloader, base_url, args)
+    server.shutdown()
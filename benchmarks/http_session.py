@@ -0,0 +1,48 @@
+"""Benchmarks the cost of opening a new connection per request against reusing the pooled worker session.
+
+Each round does what a worker thread does for a job: pop, download the source image, upload to R2 and submit,
+against a local fake horde. Over TLS to the real horde the gap is much larger, as every new connection
+also pays for a TLS handshake.
+
+Usage: python -m benchmarks.http_session [--rounds 200] [--threads 4]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from worker.sessions import connection_stats, http_session
+from worker.testing.fake_horde import FakeHorde, FakeHordeServer
+
+
+def run_round(client, url):
+    pop = client.post(f"{url}/api/v2/generate/pop", json={"name": "Benchmark Worker"}, timeout=10).json()
+    if pop.get("source_image"):
+        client.get(pop["source_image"], timeout=10)
+    client.put(pop["r2_upload"], data=b"0" * 64 * 1024, timeout=10)
+    client.post(f"{url}/api/v2/generate/submit", json={"id": pop["id"], "generation": "R2"}, timeout=10)
+
+
+def run(args, client):
+    connection_stats.reset()
+    with FakeHordeServer(FakeHorde(source_image_ratio=1)) as server:
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            list(executor.map(lambda _: run_round(client, server.url), range(args.rounds)))
+        elapsed = time.monotonic() - start
+    return {
+        "rounds_per_second": round(args.rounds / elapsed, 1),
+        "connections": connection_stats.get_stats(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-request connections against the pooled session")
+    parser.add_argument("--rounds", type=int, default=200, help="How many pop/download/upload/submit rounds to run")
+    parser.add_argument("--threads", type=int, default=4, help="How many rounds to run concurrently")
+    args = parser.parse_args()
+    http_session.configure(max_threads=args.threads)
+    # The plain requests module doesn't go through our counting adapter, so only its throughput is reported
+    print(f"requests (new connection per request): {run(args, requests)}")
+    print(f"pooled session:                        {run(args, http_session)}")
@@ -0,0 +1,74 @@
+"""Microbenchmarks the overhead of creating a popper and a job, with a deep copy of the bridge data each
+(as we used to do) against the shared bridge data snapshot.
+
+The bridge data carries the four censor images, like the Stable Diffusion bridge data does.
+HordeLib is not part of this benchmark, as it needs a GPU. It's a per process instance now in any case.
+
+Usage: python -m benchmarks.job_overhead [--iterations 200]
+"""
+import argparse
+import copy
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from PIL import Image
+
+from worker.bridge_data.framework import BridgeDataTemplate
+from worker.jobs.framework import HordeJobFramework
+from worker.jobs.poppers import JobPopper
+
+CENSOR_IMAGES = ("sfw_worker", "censorlist", "sfw_request", "csam")
+
+
+class BenchmarkBridgeData(BridgeDataTemplate):
+    snapshot_shared_attributes = (
+        *BridgeDataTemplate.snapshot_shared_attributes,
+        *(f"censor_image_{name}" for name in CENSOR_IMAGES),
+    )
+
+    def __init__(self):
+        super().__init__(SimpleNamespace())
+        self.model_names = [f"Model {index}" for index in range(30)]
+        self.blacklist = ["a", "b", "c"]
+        self.censorlist = ["d", "e", "f"]
+        for name in CENSOR_IMAGES:
+            image = Image.open(f"assets/nsfw_censor_{name}.png")
+            image.load()
+            setattr(self, f"censor_image_{name}", image)
+
+
+def create_popper_and_job(bridge_data):
+    JobPopper(None, bridge_data)
+    HordeJobFramework(None, bridge_data, {"id": "00000000"})
+
+
+def create_popper_and_job_legacy(bridge_data):
+    """Both the popper and the job used to take a deep copy of their own"""
+    JobPopper(None, copy.deepcopy(bridge_data))
+    HordeJobFramework(None, copy.deepcopy(bridge_data), {"id": "00000000"})
+
+
+def measure(args, create):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        create()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "ms_per_pop_and_job": round(1000 * elapsed / args.iterations, 3),
+        "peak_kb": round(peak / 1024),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the per pop and per job overhead")
+    parser.add_argument("--iterations", type=int, default=200, help="How many poppers and jobs to create")
+    args = parser.parse_args()
+    bridge_data = BenchmarkBridgeData()
+    print(f"deep copy: {measure(args, lambda: create_popper_and_job_legacy(bridge_data))}")
+    snapshot = bridge_data.snapshot()
+    print(f"snapshot:  {measure(args, lambda: create_popper_and_job(snapshot))}")
+    print(f"taking a snapshot (once per reload): {measure(args, bridge_data.snapshot)}")
@@ -0,0 +1,124 @@
+"""Benchmarks the kudos model over many logged jobs, in jobs per second.
+
+Compares the way the kudos used to be calculated (one hot tensors and a forward pass per payload, kept below)
+with calculate_kudos_batch on both backends, which fills one feature matrix for the distinct payloads and runs
+the model once on it. The generated jobs repeat themselves about as much as real ones do, see --distinct.
+
+The times predicted by the batches are compared with the reference ones. Batching can change the last bits of
+the float32 outputs, so a time may round the other way, but one differing by more than 0.01s aborts the benchmark.
+
+Usage: python -m benchmarks.kudos_batch [--jobs 100000] [--distinct 0.2] [--model worker/jobs/kudos-v20-66.ckpt]
+"""
+import argparse
+import random
+import sys
+import time
+
+import torch
+
+from worker.jobs.kudos import KudosModel
+
+
+def reference_payload_to_tensor(payload):
+    """payload_to_tensor, the way it used to be done"""
+
+    def one_hot_encode(strings, unique_strings):
+        one_hot = torch.zeros(len(strings), len(unique_strings))
+        for i, string in enumerate(strings):
+            one_hot[i, unique_strings.index(string)] = 1
+        return one_hot
+
+    data = [
+        [
+            payload["height"] / 1024,
+            payload["width"] / 1024,
+            payload["ddim_steps"] / 100,
+            payload["cfg_scale"] / 30,
+            payload.get("denoising_strength", 1.0),
+            payload.get("control_strength", payload.get("denoising_strength", 1.0)),
+            1.0 if payload["karras"] else 0.0,
+            1.0 if payload.get("hires_fix", False) else 0.0,
+            1.0 if payload.get("source_image", False) else 0.0,
+            1.0 if payload.get("source_mask", False) else 0.0,
+        ],
+    ]
+    sampler_name = payload["sampler_name"] if payload["sampler_name"] in KudosModel.KNOWN_SAMPLERS else "k_euler"
+    return torch.cat(
+        (
+            torch.tensor(data).float(),
+            one_hot_encode([sampler_name], KudosModel.KNOWN_SAMPLERS),
+            one_hot_encode([payload.get("control_type", "None")], KudosModel.KNOWN_CONTROL_TYPES),
+            one_hot_encode([payload.get("source_processing", "txt2img")], KudosModel.KNOWN_SOURCE_PROCESSING),
+            torch.sum(
+                one_hot_encode(payload.get("post_processing", []), KudosModel.KNOWN_POST_PROCESSORS),
+                dim=0,
+                keepdim=True,
+            ),
+        ),
+        dim=1,
+    )
+
+
+def reference_payload_to_time(kudos_model, payload):
+    with torch.no_grad():
+        output = kudos_model.model(reference_payload_to_tensor(payload).squeeze())
+    return round(float(output.item()), 2)
+
+
+def generate_payload(rng):
+    payload = {
+        "width": rng.choice([512, 576, 768, 1024]),
+        "height": rng.choice([512, 640, 768, 1024]),
+        "ddim_steps": rng.choice([20, 25, 30, 40, 50]),
+        "cfg_scale": rng.choice([5, 7, 7.5, 9]),
+        "karras": rng.random() < 0.8,
+        "hires_fix": rng.random() < 0.1,
+        "sampler_name": rng.choice([*KudosModel.KNOWN_SAMPLERS, "lcm"]),
+        "post_processing": rng.sample(KudosModel.KNOWN_POST_PROCESSORS, rng.choice([0, 0, 0, 1, 2])),
+    }
+    if rng.random() < 0.2:
+        payload["source_image"] = True
+        payload["source_processing"] = rng.choice(["img2img", "inpainting", "outpainting"])
+        payload["denoising_strength"] = round(rng.uniform(0.3, 1), 2)
+    if rng.random() < 0.05:
+        payload["control_type"] = rng.choice(KudosModel.KNOWN_CONTROL_TYPES)
+    return payload
+
+
+def generate_jobs(args):
+    rng = random.Random(args.seed)
+    distinct = [generate_payload(rng) for _ in range(max(int(args.jobs * args.distinct), 1))]
+    return [rng.choice(distinct) for _ in range(args.jobs)]
+
+
+def jobs_per_second(jobs, calculate):
+    start = time.perf_counter()
+    results = calculate(jobs)
+    return round(len(jobs) / (time.perf_counter() - start)), results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the kudos model over many jobs")
+    parser.add_argument("--jobs", type=int, default=100_000, help="How many jobs to calculate the kudos of")
+    parser.add_argument("--distinct", type=float, default=0.2, help="Share of the jobs which are distinct")
+    parser.add_argument("--model", default="worker/jobs/kudos-v20-66.ckpt", help="The kudos model")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the jobs")
+    args = parser.parse_args()
+    jobs = generate_jobs(args)
+    torch_model = KudosModel(args.model)
+    numpy_model = KudosModel(args.model, backend="numpy")
+    reference_jobs, expected = jobs_per_second(
+        jobs,
+        lambda jobs: [reference_payload_to_time(torch_model, payload) for payload in jobs],
+    )
+    torch_jobs, torch_times = jobs_per_second(jobs, torch_model.payloads_to_times)
+    numpy_jobs, numpy_times = jobs_per_second(jobs, numpy_model.payloads_to_times)
+    for backend, times in (("torch", torch_times), ("numpy", numpy_times)):
+        differences = [abs(job_time - expected_time) for job_time, expected_time in zip(times, expected)]
+        if max(differences) > 0.011:
+            print(f"The {backend} backend predicts times up to {max(differences)}s away from the reference")
+            sys.exit(1)
+        print(f"{backend}: {sum(map(bool, differences))} of {len(jobs)} times rounded differently")
+    print(f"reference, one job at a time: {reference_jobs:>10} jobs/s")
+    print(f"batched, torch:               {torch_jobs:>10} jobs/s")
+    print(f"batched, numpy:               {numpy_jobs:>10} jobs/s")
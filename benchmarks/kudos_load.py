@@ -0,0 +1,67 @@
+"""Benchmarks loading the kudos model and predicting the kudos of a single job, from the pickled torch checkpoint
+against the weights converted to .npz (see kudos.py).
+
+Each load is timed in a fresh interpreter, imports included, as that's what a worker or a script pays when it
+starts. The kudos of each path are compared on generated jobs before their latency is measured, with the
+memoized times cleared before every call so that the model runs each time.
+
+Usage: python -m benchmarks.kudos_load [--checkpoint worker/jobs/kudos-v20-66.ckpt] [--calls 2000]
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.kudos_batch import generate_payload
+from worker.jobs.kudos import KudosModel
+
+LOAD_SCRIPT = """
+import time
+start = time.perf_counter()
+from worker.jobs.kudos import KudosModel
+KudosModel({filename!r})
+print(1000 * (time.perf_counter() - start))
+"""
+
+
+def time_load_ms(filename, repeats):
+    """The median time to import the kudos model and load it, in a fresh interpreter"""
+    timings = sorted(
+        float(subprocess.check_output([sys.executable, "-c", LOAD_SCRIPT.format(filename=filename)], text=True))
+        for _ in range(repeats)
+    )
+    return round(timings[len(timings) // 2], 1)
+
+
+def time_call_us(kudos_model, payloads):
+    start = time.perf_counter()
+    for payload in payloads:
+        kudos_model.time_cache.clear()
+        kudos_model.calculate_kudos(payload)
+    return round(1_000_000 * (time.perf_counter() - start) / len(payloads), 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark loading the kudos model, pickled against .npz")
+    parser.add_argument("--checkpoint", default="worker/jobs/kudos-v20-66.ckpt", help="The pickled kudos model")
+    parser.add_argument("--calls", type=int, default=2000, help="How many single jobs to predict")
+    parser.add_argument("--loads", type=int, default=5, help="How many times to load each model")
+    args = parser.parse_args()
+    rng = random.Random(42)
+    payloads = [generate_payload(rng) for _ in range(args.calls)]
+    with tempfile.TemporaryDirectory() as directory:
+        weights_filename = os.path.join(directory, "kudos.npz")
+        pickled_model = KudosModel(args.checkpoint)
+        pickled_model.save_weights(weights_filename)
+        weights_model = KudosModel(weights_filename)
+        expected = [pickled_model.calculate_kudos(payload) for payload in payloads]
+        results = [weights_model.calculate_kudos(payload) for payload in payloads]
+        differences = sum(result != expected_kudos for result, expected_kudos in zip(results, expected))
+        print(f"{differences} of {len(payloads)} kudos differ, from times rounded the other way")
+        print(f"pickle load: {time_load_ms(args.checkpoint, args.loads):>8} ms")
+        print(f"npz load:    {time_load_ms(weights_filename, args.loads):>8} ms")
+        print(f"pickle call: {time_call_us(pickled_model, payloads):>8} us per job")
+        print(f"npz call:    {time_call_us(weights_model, payloads):>8} us per job")
@@ -0,0 +1,153 @@
+"""Load tests the whole path of a job, from the pop to the submit, with several workers against the fake horde.
+
+Each worker runs in a process of its own, with the real main loop, popper, downloader, Stable Diffusion job
+and submit pool. The inference is made up by the synthetic backend, at --speed megapixelsteps per second.
+The fake horde answers with the latency and faults asked for, and times each job from its pop to its submit.
+The first --warmup seconds are left out of the report.
+
+Faults are given as a list of fault=ratio, of the faults of FakeHorde.FAULTS, e.g. stale=0.05,server_error=0.01
+
+Usage: python -m benchmarks.load_test [--workers 4] [--duration 30] [--threads 1] [--queue_size 1]
+       [--pop_latency 0.2] [--submit_latency 0.1] [--pop_faults server_error=0.02] [--submit_faults stale=0.02]
+"""
+import argparse
+import multiprocessing
+import threading
+import time
+
+from worker.inference import inference
+from worker.jobs.poppers import StableDiffusionPopper
+from worker.jobs.stable_diffusion import StableDiffusionHordeJob
+from worker.jobs.submitter import job_submitter
+from worker.logger import logger
+from worker.testing.fake_bridge_data import FakeBridgeData
+from worker.testing.fake_horde import FakeHorde, FakeHordeServer
+from worker.testing.fake_model_manager import FakeModelManager
+from worker.workers.framework import WorkerFramework
+
+
+class LoadTestWorker(WorkerFramework):
+    def __init__(self, model_manager, bridge_data):
+        super().__init__(model_manager, bridge_data)
+        self.is_daemon = True
+        self.PopperClass = StableDiffusionPopper
+        self.JobClass = StableDiffusionHordeJob
+        self.last_config_reload = time.time()
+
+    def can_process_jobs(self):
+        return True
+
+    def reload_bridge_data(self):
+        self.last_config_reload = time.time()
+
+
+def get_bridge_data(horde_url, index, args):
+    return FakeBridgeData(
+        horde_url=horde_url,
+        api_key="0000000000",
+        worker_name=f"Load Test Worker {index}",
+        priority_usernames=[],
+        max_pixels=64 * 64 * 8 * 32,
+        nsfw=True,
+        censor_nsfw=False,
+        censorlist=[],
+        blacklist=[],
+        allow_img2img=True,
+        allow_painting=True,
+        allow_unsafe_ip=True,
+        allow_post_processing=True,
+        allow_controlnet=False,
+        allow_lora=False,
+        require_upfront_kudos=False,
+        suppress_speed_warnings=True,
+        max_threads=args.threads,
+        queue_size=args.queue_size,
+        prefetch_jobs=args.prefetch,
+        submit_threads=args.submit_threads,
+    )
+
+
+def run_worker(index, horde_url, args, stop_event):
+    """Runs a worker until stop_event is set, in a process of its own"""
+    # The injected faults would have every worker log warnings
+    logger.disable("worker")
+    inference.configure("synthetic", speed=args.speed)
+    worker = LoadTestWorker(FakeModelManager(), get_bridge_data(horde_url, index, args))
+    loop = threading.Thread(target=worker.start, daemon=True)
+    loop.start()
+    stop_event.wait()
+    worker.should_stop = True
+    worker.wake()
+    loop.join(timeout=10)
+    # Delivers the pending submissions before the process exits
+    job_submitter.shutdown()
+
+
+def get_faults(text):
+    faults = {}
+    for item in filter(None, (text or "").split(",")):
+        fault, ratio = item.split("=")
+        if fault not in FakeHorde.FAULTS:
+            raise ValueError(f"Unknown fault '{fault}'. Known faults: {', '.join(FakeHorde.FAULTS)}")
+        faults[fault] = float(ratio)
+    return faults
+
+
+def main(args):
+    horde = FakeHorde(
+        pop_latency=args.pop_latency,
+        submit_latency=args.submit_latency,
+        source_image_ratio=args.source_image_ratio,
+        empty_pop_ratio=args.empty_pop_ratio,
+        pop_faults=get_faults(args.pop_faults),
+        submit_faults=get_faults(args.submit_faults),
+        image_sizes=((512, 512), (512, 768), (768, 768)),
+        steps=(20, 30),
+        post_processing=((), (), (), ("GFPGAN",), ("RealESRGAN_x2plus",)),
+    )
+    # The workers mustn't inherit the threads of the server
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    with FakeHordeServer(horde) as server:
+        workers = [
+            context.Process(target=run_worker, args=(index, server.url, args, stop_event))
+            for index in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        time.sleep(args.warmup)
+        horde.reset_stats()
+        time.sleep(args.duration)
+        report = horde.get_report()
+        stop_event.set()
+        for worker in workers:
+            worker.join(timeout=15)
+            if worker.is_alive():
+                worker.terminate()
+    print(f"{args.workers} workers of {args.threads} threads, for {args.duration}s after {args.warmup}s of warm up")
+    print(f"jobs: {report['jobs']}, {report['jobs_per_second']} jobs/s, still open: {report['open_jobs']}")
+    print(
+        f"pop to submit: p50 {report['p50_seconds']}s, p95 {report['p95_seconds']}s, p99 {report['p99_seconds']}s",
+    )
+    print(f"faults injected: {report['faults'] or 'none'}")
+    for name, jobs in sorted(report["workers"].items()):
+        print(f"  {name}: {jobs} jobs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test workers against the fake horde")
+    parser.add_argument("--workers", type=int, default=4, help="How many worker processes to run")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds to leave out of the report")
+    parser.add_argument("--threads", type=int, default=1, help="max_threads of each worker")
+    parser.add_argument("--queue_size", type=int, default=1, help="queue_size of each worker")
+    parser.add_argument("--submit_threads", type=int, default=2, help="submit_threads of each worker")
+    parser.add_argument("--prefetch", action="store_true", help="Prefetch the jobs")
+    parser.add_argument("--speed", type=float, default=3, help="Megapixelsteps per second of the synthetic inference")
+    parser.add_argument("--pop_latency", type=float, default=0.2, help="Seconds each pop takes")
+    parser.add_argument("--submit_latency", type=float, default=0.1, help="Seconds each submit takes")
+    parser.add_argument("--source_image_ratio", type=float, default=0.2, help="Ratio of jobs with a source image")
+    parser.add_argument("--empty_pop_ratio", type=float, default=0, help="Ratio of the pops without a job")
+    parser.add_argument("--pop_faults", help="Faults of the pops, as fault=ratio,...")
+    parser.add_argument("--submit_faults", help="Faults of the submits, as fault=ratio,...")
+    main(parser.parse_args())
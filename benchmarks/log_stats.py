@@ -0,0 +1,163 @@
+"""Benchmarks scanning the bridge logs for pop-stats.py and model-stats.py, on generated logs.
+
+The reference is the way the scripts used to scan: counting the lines for the progress bar, then matching
+every line against regexes starting with ".*". It's timed on the first log file only, as it takes minutes on
+gigabytes, and its stats are compared with those of the scanner on that file. The scanner is then timed on
+all the logs without an index, again with nothing new logged, and after more is logged.
+
+Usage: python -m benchmarks.log_stats [--size 2048] [--files 4] [--processes 4] [--directory /tmp/logs]
+"""
+import argparse
+import datetime
+import mmap
+import os
+import random
+import re
+import tempfile
+import time
+import uuid
+
+from worker.log_stats import LogScanner
+
+REFERENCE_POP_REGEX = re.compile(r".*(\d\d\d\d-\d\d-\d\d \d\d:\d\d).* Job pop took (\d+\.\d+).*node: (.*)\)")
+REFERENCE_MODEL_REGEX = re.compile(r".*(\d\d\d\d-\d\d-\d\d).*Starting generation for id \S+: (.*) @")
+REFERENCE_KUDOS_REGEX = re.compile(r".*(\d\d\d\d-\d\d-\d\d \d\d:\d\d).* and contributed for (\d+\.\d+)")
+
+MODELS = ["stable_diffusion", "Deliberate", "Anything Diffusion", "Realistic Vision", "SDXL 1.0"]
+NODES = ["10.0.0.1:443", "10.0.0.2:443", "10.0.0.3:443"]
+NOISE = [
+    "worker.workers.framework:start_job:{line} - New job processing",
+    "worker.jobs.submitter:submit:{line} - Finished job in threadpool",
+    "worker.workers.framework:check_running_job_status:{line} - Job finished successfully",
+    "worker.jobs.poppers:horde_pop:{line} - Server https://aihorde.net has no valid generations for us to do.",
+    "worker.bridge_data.framework:reload_data:{line} - Reloaded bridge data",
+]
+
+
+def log_line(level, when, message):
+    return f"{level: <10} | {when:%Y-%m-%d %H:%M:%S.%f} | {message}\n"
+
+
+def generate_job(rng, when):
+    """The lines of a job, with a few lines of noise"""
+    job_id = uuid.UUID(int=rng.getrandbits(128))
+    model = rng.choice(MODELS)
+    lines = [
+        log_line(
+            "DEBUG",
+            when,
+            f"worker.jobs.poppers:horde_pop:49 - Job pop took {rng.uniform(0.1, 3):.6f} (node: {rng.choice(NODES)})",
+        ),
+        log_line(
+            "INFO",
+            when,
+            f"worker.jobs.stable_diffusion:start_job:178 - Starting generation for id {job_id}: {model} @ "
+            "512x512 for 30 steps k_euler_a. Prompt length is 120 characters And it appears to contain 0 weights",
+        ),
+    ]
+    lines.extend(
+        log_line("DEBUG", when, rng.choice(NOISE).format(line=rng.randint(1, 400))) for _ in range(rng.randint(5, 25))
+    )
+    lines.append(
+        log_line(
+            "INFO",
+            when,
+            f"worker.jobs.framework:submit_job:221 - Submitted job with id {job_id} and contributed for "
+            f"{rng.uniform(5, 40):.1f}. Job took 5.2 seconds since queued and 4.9 since start.",
+        ),
+    )
+    return "".join(lines)
+
+
+def generate_logs(directory, size, files, rng):
+    """Writes `files` logs of `size` megabytes in total, a job every second, the last one being bridge.log"""
+    when = datetime.datetime(2023, 6, 1)
+    filenames = [os.path.join(directory, f"bridge.2023-06-01_{index:02}.log") for index in range(files - 1)]
+    filenames.append(os.path.join(directory, "bridge.log"))
+    for filename in filenames:
+        with open(filename, "wt", encoding="utf-8") as log_file:
+            written = 0
+            while written < size * 1024 * 1024 / files:
+                block = "".join(generate_job(rng, when + datetime.timedelta(seconds=second)) for second in range(100))
+                when += datetime.timedelta(seconds=100)
+                written += log_file.write(block)
+    return filenames
+
+
+def reference_scan(filename):
+    """The line count and regexes of the scripts, before the scanner"""
+    with open(filename, "r+") as fp:
+        buf = mmap.mmap(fp.fileno(), 0)
+        lines = 0
+        while buf.readline():
+            lines += 1
+    pops = {}
+    models = {}
+    kudos = {}
+    with open(filename, "rt", encoding="UTF-8", errors="ignore") as infile:
+        for line in infile:
+            if regex := REFERENCE_POP_REGEX.match(line):
+                node = regex.group(3).split(":")[0]
+                pops[node] = pops.get(node, 0) + 1
+            if regex := REFERENCE_MODEL_REGEX.match(line):
+                models[regex.group(2)] = models.get(regex.group(2), 0) + 1
+            if regex := REFERENCE_KUDOS_REGEX.match(line):
+                hour = regex.group(1)[:-3]
+                kudos[hour] = kudos.get(hour, 0) + float(regex.group(2))
+    return pops, models, kudos
+
+
+def time_scan(scanner):
+    start = time.perf_counter()
+    summary = scanner.scan()
+    return summary, time.perf_counter() - start
+
+
+def main(args, directory):
+    rng = random.Random(42)
+    start = time.perf_counter()
+    filenames = generate_logs(directory, args.size, args.files, rng)
+    total_mb = sum(os.path.getsize(filename) for filename in filenames) / 1024 / 1024
+    first_mb = os.path.getsize(filenames[0]) / 1024 / 1024
+    print(f"Generated {round(total_mb)} MB in {len(filenames)} files in {time.perf_counter() - start:.1f} seconds")
+
+    start = time.perf_counter()
+    pops, models, kudos = reference_scan(filenames[0])
+    reference_seconds = time.perf_counter() - start
+    summary = LogScanner(filenames[0], index_file=None, processes=1).scan()
+    same = (
+        pops == {node: count for node, (_, count) in summary.get_pop_times().items()}
+        and models == {model: count for model, (count, _) in summary.get_models().items()}
+        and kudos.keys() == summary.get_kudos_per_hour().keys()
+        and all(abs(kudos[hour] - value) < 0.01 for hour, value in summary.get_kudos_per_hour().items())
+    )
+    print(f"Same stats as the reference on the first file: {same}")
+    print(f"reference:        {first_mb / reference_seconds:>8.1f} MB/s ({reference_seconds:.1f} s on the first file)")
+
+    index_file = os.path.join(directory, "stats-index.json")
+    scanner = LogScanner(os.path.join(directory, "bridge*.log"), index_file, processes=args.processes)
+    summary, seconds = time_scan(scanner)
+    print(f"cold scan:        {total_mb / seconds:>8.1f} MB/s ({seconds:.1f} s, {args.processes} processes)")
+    _, seconds = time_scan(scanner)
+    print(f"nothing new:      {1000 * seconds:>8.1f} ms")
+    with open(filenames[-1], "at", encoding="utf-8") as log_file:
+        appended = log_file.write("".join(generate_job(rng, datetime.datetime(2023, 7, 1)) for _ in range(10_000)))
+    _, seconds = time_scan(scanner)
+    print(f"{appended / 1024 / 1024:.1f} MB new:     {1000 * seconds:>8.1f} ms")
+    generations = sum(count for count, _ in summary.get_models().values())
+    print(f"{generations} generations, {sum(summary.get_kudos_per_hour().values()):.0f} kudos")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark scanning the bridge logs")
+    parser.add_argument("--size", type=int, default=2048, help="Megabytes of logs to generate")
+    parser.add_argument("--files", type=int, default=4, help="How many log files to split them in")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Processes scanning the logs")
+    parser.add_argument("--directory", help="Where to write the logs, a temporary directory by default")
+    args = parser.parse_args()
+    if args.directory:
+        os.makedirs(args.directory, exist_ok=True)
+        main(args, args.directory)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            main(args, directory)
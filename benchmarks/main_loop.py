@@ -0,0 +1,138 @@
+"""Benchmarks the worker main loop with fake jobs, so that no GPU or horde connection is needed.
+
+Reports the CPU the main loop burns while all threads are busy, and the latency between a job
+finishing and the next one starting. The legacy 20ms polling loop is kept here for comparison.
+
+Usage: python -m benchmarks.main_loop [--duration 10] [--job_time 0.5] [--threads 1] [--queue_size 1]
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from worker.testing.fake_bridge_data import FakeBridgeData
+from worker.workers.framework import WorkerFramework
+
+
+class FakeJob:
+    """Stands in for a HordeJobFramework job. It just sleeps for the duration of the 'inference'"""
+
+    def __init__(self, job_time, timings):
+        self.job_time = job_time
+        self.timings = timings
+        self.current_model = "fake"
+        self.start_time = time.time()
+
+    def start_job(self):
+        self.timings.append(("start", time.monotonic()))
+        time.sleep(self.job_time)
+        self.timings.append(("end", time.monotonic()))
+
+    def is_faulted(self):
+        return False
+
+    def is_out_of_memory(self):
+        return False
+
+    def is_stale(self):
+        return False
+
+    def get_stale_deadline(self):
+        return self.start_time + 1200
+
+
+class FakePopper:
+    def __init__(self, job_time, timings):
+        self.job_time = job_time
+        self.timings = timings
+
+    def horde_pop(self):
+        return [FakeJob(self.job_time, self.timings)]
+
+
+class BenchmarkWorker(WorkerFramework):
+    def __init__(self, bridge_data, job_time):
+        super().__init__(None, bridge_data)
+        self.is_daemon = True
+        self.job_time = job_time
+        self.timings = []
+        self.last_config_reload = time.time()
+
+    def can_process_jobs(self):
+        return True
+
+    def pop_job(self):
+        return FakePopper(self.job_time, self.timings).horde_pop()
+
+    def reload_bridge_data(self):
+        self.last_config_reload = time.time()
+
+
+class LegacyPollingWorker(BenchmarkWorker):
+    """The main loop as it was before it became event driven"""
+
+    def process_jobs(self):
+        if time.time() - self.last_config_reload > 60:
+            self.reload_bridge_data()
+        if not self.can_process_jobs():
+            time.sleep(5)
+            return
+        if len(self.waiting_jobs) < self.bridge_data.queue_size:
+            self.add_job_to_queue()
+        while len(self.running_jobs) < self.bridge_data.max_threads and self.start_job():
+            pass
+        for job_thread, start_time, job in self.running_jobs:
+            self.check_running_job_status(job_thread, start_time, job)
+            if self.should_restart or self.should_stop:
+                break
+        time.sleep(0.02)
+
+
+def run(worker_class, args):
+    bridge_data = FakeBridgeData(
+        max_threads=args.threads,
+        queue_size=args.queue_size,
+        disable_terminal_ui=True,
+        stats_output_frequency=0,
+        prefetch_jobs=False,
+        submit_threads=2,
+        submit_backlog=10,
+    )
+    worker = worker_class(bridge_data, args.job_time)
+    loop = threading.Thread(target=worker.start, daemon=True)
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    loop.start()
+    time.sleep(args.duration)
+    worker.should_stop = True
+    worker.wake()
+    loop.join()
+    cpu_used = time.process_time() - cpu_start
+    wall = time.monotonic() - wall_start
+    # Every start after the initial fill of the threads is caused by the completion right before it
+    latencies = []
+    last_end = None
+    for event, when in sorted(worker.timings, key=lambda timing: timing[1]):
+        if event == "end":
+            last_end = when
+        elif last_end is not None:
+            latencies.append((when - last_end) * 1000)
+            last_end = None
+    ends = [when for event, when in worker.timings if event == "end"]
+    return {
+        "jobs": len(ends),
+        "cpu_percent": round(100 * cpu_used / wall, 2),
+        "latency_ms_avg": round(statistics.mean(latencies), 3) if latencies else None,
+        "latency_ms_max": round(max(latencies), 3) if latencies else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the worker main loop")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run each loop for")
+    parser.add_argument("--job_time", type=float, default=0.5, help="Seconds each fake job takes")
+    parser.add_argument("--threads", type=int, default=1, help="max_threads")
+    parser.add_argument("--queue_size", type=int, default=1, help="queue_size")
+    args = parser.parse_args()
+    for name, worker_class in (("polling", LegacyPollingWorker), ("event-driven", BenchmarkWorker)):
+        print(f"{name:>13}: {run(worker_class, args)}")
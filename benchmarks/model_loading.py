@@ -0,0 +1,96 @@
+"""Benchmarks bringing a worker online with many models, loaded one after the other as _reload_models used to
+(kept below), against the model load scheduler, on a fake model manager which sleeps to stand for the disk.
+
+The utility models (safety checker, post-processors) load first either way. We report when the first image
+model was available, when the one the horde has the longest queue for was, and when they all were, then
+how close the estimate of the time left is on a second load.
+
+Usage: python -m benchmarks.model_loading [--models 20] [--load_seconds 0.5] [--threads 2]
+"""
+import argparse
+import random
+import threading
+import time
+
+from worker.model_loader import ModelLoadScheduler
+from worker.testing.fake_model_manager import FakeModelManager
+
+UTILITY_MODELS = ["ViT-L/14", "safety_checker", "RealESRGAN_x4plus"]
+
+
+def reference_reload_models(model_manager, model_names, on_loaded):
+    """BridgeDataTemplate._reload_models, as it was"""
+    for model in model_manager.get_loaded_models_names():
+        if model not in model_names:
+            model_manager.unload_model(model)
+    for model in model_names:
+        if model not in model_manager.get_loaded_models_names():
+            if model == "safety_checker":
+                success = model_manager.load(model, cpu_only=True)
+            else:
+                success = model_manager.load(model)
+            if success:
+                on_loaded(model)
+
+
+def run(load, model_names, load_seconds, most_wanted):
+    """Returns the seconds until the first image model, the most wanted one, and every model were loaded"""
+    model_manager = FakeModelManager(model_names, loaded=False, load_seconds=load_seconds)
+    start = time.monotonic()
+    loaded_at = {}
+
+    def on_loaded(model):
+        loaded_at[model] = time.monotonic() - start
+
+    load(model_manager, on_loaded)
+    first = min(seconds for model, seconds in loaded_at.items() if model not in UTILITY_MODELS)
+    return first, loaded_at[most_wanted], time.monotonic() - start
+
+
+def main(args):
+    rng = random.Random(42)
+    image_models = [f"Model {index}" for index in range(args.models)]
+    model_names = UTILITY_MODELS + image_models
+    load_seconds = {model: rng.uniform(0.5, 1.5) * args.load_seconds for model in model_names}
+    demand = {model: rng.randint(0, 500) for model in image_models}
+    most_wanted = max(image_models, key=lambda model: demand[model])
+
+    reference = run(
+        lambda model_manager, on_loaded: reference_reload_models(model_manager, model_names, on_loaded),
+        model_names,
+        load_seconds,
+        most_wanted,
+    )
+    scheduler = ModelLoadScheduler()
+    scheduler.configure(max_threads=args.threads)
+
+    def scheduled_load(model_manager, on_loaded):
+        scheduler.listeners = [on_loaded]
+        scheduler.load(model_manager, model_names, demand)
+
+    scheduled = run(scheduled_load, model_names, load_seconds, most_wanted)
+    print(f"{len(model_names)} models, {args.load_seconds}s each on average, {args.threads} threads")
+    print(f"{'':<12}{'first':>10}{'most wanted':>14}{'all':>10}")
+    for name, (first, wanted, total) in (("reference", reference), ("scheduler", scheduled)):
+        print(f"{name:<12}{first:>9.2f}s{wanted:>13.2f}s{total:>9.2f}s")
+    # The load times are known now, so the estimate of the next load should be close
+    scheduler.listeners = []
+    model_manager = FakeModelManager(model_names, loaded=False, load_seconds=load_seconds)
+    thread = threading.Thread(target=scheduler.load, args=(model_manager, model_names, demand))
+    start = time.monotonic()
+    thread.start()
+    time.sleep(args.load_seconds)
+    eta = scheduler.get_progress()["eta"]
+    estimated_at = time.monotonic() - start
+    thread.join()
+    print(
+        f"ETA after {estimated_at:.2f}s of a reload: {eta:.2f}s, took {time.monotonic() - start - estimated_at:.2f}s",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark loading the models of a worker")
+    parser.add_argument("--models", type=int, default=20, help="How many image models to load")
+    parser.add_argument("--load_seconds", type=float, default=0.5, help="Average seconds to load a model")
+    parser.add_argument("--threads", type=int, default=2, help="Models loaded at the same time")
+    main(parser.parse_args())
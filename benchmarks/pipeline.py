@@ -0,0 +1,90 @@
+"""Benchmarks the whole Stable Diffusion pipeline of a worker on the CPU, with the synthetic inference backend.
+
+A single worker pops from the fake horde, downloads the source images, runs the job through the safety checks,
+the post-processors, the encoding and the upload, and submits it, all of it for real but the inference.
+We report the jobs per second, the average seconds spent in each stage of the jobs, and the CPU seconds this
+process spent per job, which is the overhead of the worker itself. It runs in this process, so that it can be
+profiled, e.g. with a sampling profiler attached to it.
+
+Usage: python -m benchmarks.pipeline [--duration 30] [--threads 1] [--queue_size 1] [--speed 3]
+       [--post_processing_ratio 0.4] [--source_image_ratio 0.2]
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from benchmarks.load_test import LoadTestWorker, get_bridge_data
+from worker.inference import inference
+from worker.logger import logger
+from worker.testing.fake_horde import FakeHorde, FakeHordeServer
+from worker.testing.fake_model_manager import FakeModelManager
+
+
+def get_stage_seconds(trace_file):
+    """The average seconds each stage of the submitted jobs took"""
+    totals = {}
+    jobs = 0
+    with open(trace_file, "rt", encoding="utf-8") as traces:
+        for line in traces:
+            trace = json.loads(line)
+            if trace.get("status") != "DONE":
+                continue
+            jobs += 1
+            for stage in trace["stages"]:
+                totals[stage["stage"]] = totals.get(stage["stage"], 0) + stage["duration"]
+    return {stage: round(seconds / max(jobs, 1), 3) for stage, seconds in totals.items()}
+
+
+def main(args):
+    logger.disable("worker")
+    inference.configure("synthetic", speed=args.speed)
+    ratio = args.post_processing_ratio
+    # As many jobs without post-processing as with, for each post-processor
+    post_processing = [("GFPGAN",), ("RealESRGAN_x2plus",), ("RealESRGAN_x4plus",)]
+    without = round(len(post_processing) * (1 - ratio) / ratio) if ratio else 1
+    horde = FakeHorde(
+        source_image_ratio=args.source_image_ratio,
+        image_sizes=((512, 512), (512, 768), (768, 768), (1024, 1024)),
+        steps=(20, 30),
+        post_processing=((),) * without + (tuple(post_processing) if ratio else ()),
+        seed=42,
+    )
+    with tempfile.TemporaryDirectory() as directory, FakeHordeServer(horde) as server:
+        trace_file = os.path.join(directory, "job_trace.jsonl")
+        bridge_data = get_bridge_data(server.url, 0, args)
+        bridge_data.job_trace_file = trace_file
+        worker = LoadTestWorker(FakeModelManager(), bridge_data)
+        loop = threading.Thread(target=worker.start, daemon=True)
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        loop.start()
+        time.sleep(args.duration)
+        worker.should_stop = True
+        worker.wake()
+        loop.join()
+        cpu_seconds = time.process_time() - cpu_start
+        elapsed = time.monotonic() - start
+        report = horde.get_report()
+        stage_seconds = get_stage_seconds(trace_file)
+    jobs = max(report["jobs"], 1)
+    print(f"{report['jobs']} jobs in {elapsed:.1f}s: {report['jobs'] / elapsed:.2f} jobs/s")
+    print(f"CPU seconds per job: {cpu_seconds / jobs:.3f}")
+    print("average seconds per stage:")
+    for stage, seconds in stage_seconds.items():
+        print(f"  {stage:<14}{seconds:>8.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the whole worker pipeline without a GPU")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run the worker for")
+    parser.add_argument("--threads", type=int, default=1, help="max_threads")
+    parser.add_argument("--queue_size", type=int, default=1, help="queue_size")
+    parser.add_argument("--submit_threads", type=int, default=2, help="submit_threads")
+    parser.add_argument("--prefetch", action="store_true", help="Prefetch the jobs")
+    parser.add_argument("--speed", type=float, default=3, help="Megapixelsteps per second of the synthetic inference")
+    parser.add_argument("--post_processing_ratio", type=float, default=0.4, help="Ratio of jobs with a post-processor")
+    parser.add_argument("--source_image_ratio", type=float, default=0.2, help="Ratio of jobs with a source image")
+    main(parser.parse_args())
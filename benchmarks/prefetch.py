@@ -0,0 +1,125 @@
+"""Benchmarks how long the (fake) GPU sits idle waiting on the horde, with and without job prefetching.
+
+The worker runs the real StableDiffusionPopper against a local fake horde with a configurable pop latency.
+Jobs are fake and just sleep for the duration of the 'inference'.
+
+Usage: python -m benchmarks.prefetch [--duration 20] [--pop_latency 1] [--job_time 2] [--source_image_ratio 0.5]
+"""
+import argparse
+import threading
+import time
+
+from worker.jobs.poppers import StableDiffusionPopper
+from worker.testing.fake_bridge_data import FakeBridgeData
+from worker.testing.fake_horde import FakeHorde, FakeHordeServer
+from worker.testing.fake_model_manager import FakeModelManager
+from worker.tracing import JobTimeline
+from worker.workers.framework import WorkerFramework
+
+
+class FakeInferenceJob:
+    """Takes a popped job and pretends to run inference on it"""
+
+    job_time = 1
+    busy_time = 0
+    completed = 0
+    _mutex = threading.Lock()
+
+    def __init__(self, mm, bd, pop):  # noqa: ARG002
+        self.pop = pop
+        self.current_model = pop["model"]
+        self.start_time = time.time()
+        self.timeline = JobTimeline("image")
+
+    def run_job(self):
+        start = time.monotonic()
+        time.sleep(self.job_time)
+        with FakeInferenceJob._mutex:
+            FakeInferenceJob.busy_time += time.monotonic() - start
+            FakeInferenceJob.completed += 1
+
+    def is_faulted(self):
+        return False
+
+    def is_out_of_memory(self):
+        return False
+
+    def is_stale(self):
+        return False
+
+    def get_stale_deadline(self):
+        return self.start_time + 1200
+
+
+class BenchmarkWorker(WorkerFramework):
+    def __init__(self, model_manager, bridge_data):
+        super().__init__(model_manager, bridge_data)
+        self.is_daemon = True
+        self.PopperClass = StableDiffusionPopper
+        self.JobClass = FakeInferenceJob
+        self.last_config_reload = time.time()
+
+    def can_process_jobs(self):
+        return True
+
+    def reload_bridge_data(self):
+        self.last_config_reload = time.time()
+
+
+def run(args, prefetch_jobs):
+    FakeInferenceJob.job_time = args.job_time
+    FakeInferenceJob.busy_time = 0
+    FakeInferenceJob.completed = 0
+    horde = FakeHorde(pop_latency=args.pop_latency, source_image_ratio=args.source_image_ratio)
+    with FakeHordeServer(horde) as server:
+        bridge_data = FakeBridgeData(
+            horde_url=server.url,
+            api_key="0000000000",
+            worker_name="Benchmark Worker",
+            priority_usernames=[],
+            max_pixels=64 * 64 * 8 * 8,
+            nsfw=True,
+            blacklist=[],
+            allow_img2img=True,
+            allow_painting=True,
+            allow_unsafe_ip=True,
+            allow_post_processing=False,
+            allow_controlnet=False,
+            allow_lora=False,
+            require_upfront_kudos=False,
+            max_threads=args.threads,
+            queue_size=args.queue_size,
+            disable_terminal_ui=True,
+            stats_output_frequency=0,
+            prefetch_jobs=prefetch_jobs,
+            submit_threads=2,
+            submit_backlog=10,
+        )
+        worker = BenchmarkWorker(FakeModelManager(), bridge_data)
+        loop = threading.Thread(target=worker.start, daemon=True)
+        start = time.monotonic()
+        loop.start()
+        time.sleep(args.duration)
+        worker.should_stop = True
+        worker.wake()
+        loop.join()
+        elapsed = time.monotonic() - start
+    gpu_time = elapsed * args.threads
+    return {
+        "jobs": FakeInferenceJob.completed,
+        "pops": horde.pops,
+        "gpu_idle_percent": round(100 * (gpu_time - FakeInferenceJob.busy_time) / gpu_time, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark GPU idle time with and without job prefetching")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to run each configuration for")
+    parser.add_argument("--pop_latency", type=float, default=1, help="Seconds each horde pop takes")
+    parser.add_argument("--job_time", type=float, default=2, help="Seconds each fake inference takes")
+    parser.add_argument("--source_image_ratio", type=float, default=0.5, help="Ratio of jobs with a source image")
+    parser.add_argument("--threads", type=int, default=1, help="max_threads")
+    parser.add_argument("--queue_size", type=int, default=0, help="queue_size")
+    args = parser.parse_args()
+    for prefetch_jobs in (False, True):
+        print(f"prefetch_jobs={prefetch_jobs!s:>5}: {run(args, prefetch_jobs)}")
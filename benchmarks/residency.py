@@ -0,0 +1,128 @@
+"""Replays /status/models snapshots through the choice of the dynamic models, the way calculate_dynamic_models used
+to make it (kept below) against the residency planner, and reports how many models each loaded and the kudos
+they would have brought in.
+
+The snapshots are those recorded by a worker with model_status_record_file set, or generated: models whose
+popularity drifts slowly, with queues which jump around it from one snapshot to the next, as the horde's do.
+Both ways are valued the same way, by the share of the queue of each loaded model we could have done at
+--speed, within what the worker can do in the time it doesn't spend loading models.
+
+Usage: python -m benchmarks.residency [--record status.jsonl] [--dynamic 5] [--budget 16384] [--speed 3]
+       [--load_seconds 10] [--hours 24]
+"""
+import argparse
+import random
+
+from worker.residency import ResidencyPlanner
+
+
+def reference_choose(statuses, number_of_dynamic_models):
+    """calculate_dynamic_models, as it was: the models with the longest eta, then queue"""
+    models_data = [md for md in statuses if md["queued"] > 0]
+    models_data.sort(key=lambda x: (x["eta"], x["queued"]), reverse=True)
+    return [model["name"] for model in models_data[:number_of_dynamic_models]]
+
+
+def generate_snapshots(hours, interval, rng):
+    """A snapshot every interval seconds, of 40 models with a Zipf-like popularity which drifts"""
+    popularity = {f"Model {index}": 2_000_000 / (index + 1) for index in range(40)}
+    snapshots = []
+    for step in range(int(hours * 3600 / interval)):
+        statuses = []
+        for name in popularity:
+            popularity[name] *= rng.lognormvariate(0, 0.03)
+            queued = popularity[name] * rng.lognormvariate(0, 0.8) if rng.random() < 0.9 else 0
+            count = max(int(popularity[name] / 100_000), 1)
+            performance = 1.5
+            eta = queued / (count * performance)
+            statuses.append(
+                {"name": name, "queued": queued, "count": count, "performance": performance, "eta": int(eta)},
+            )
+        snapshots.append((step * interval, statuses))
+    return snapshots
+
+
+def replay(snapshots, choose, valuer, capacity, load_seconds, served=None):
+    """Returns how many models were loaded and the kudos they would have brought in, with choose(time, statuses)
+    returning the dynamic models to have loaded. served(model, kudos, time) is told what each one brought in"""
+    loaded = set()
+    loads = 0
+    kudos = 0
+    for index, (now, statuses) in enumerate(snapshots):
+        interval = snapshots[index + 1][0] - now if index + 1 < len(snapshots) else 0
+        chosen = set(choose(now, statuses))
+        new_models = chosen - loaded
+        loads += len(new_models)
+        loaded = chosen
+        statuses = {status["name"]: status for status in statuses}
+        served_kudos = {}
+        for model in loaded:
+            busy = interval - load_seconds if model in new_models else interval
+            served_kudos[model] = valuer.get_demand_rate(statuses.get(model), capacity) * max(busy, 0)
+        # The worker can't do more than its capacity across all its models, less the time it spent loading
+        available = capacity * max(interval - load_seconds * len(new_models), 0)
+        scale = min(available / sum(served_kudos.values()), 1) if sum(served_kudos.values()) else 0
+        for model, model_kudos in served_kudos.items():
+            kudos += model_kudos * scale
+            if served and model_kudos:
+                served(model, model_kudos * scale, now + interval)
+    return loads, kudos
+
+
+def main(args):
+    if args.record:
+        snapshots = ResidencyPlanner.read_status_record(args.record)
+    else:
+        snapshots = generate_snapshots(args.hours, 60, random.Random(42))
+    hours = (snapshots[-1][0] - snapshots[0][0]) / 3600
+    print(f"{len(snapshots)} snapshots over {hours:.1f} hours, {args.dynamic} dynamic models")
+    valuer = ResidencyPlanner()
+    capacity = args.speed * valuer.get_kudos_per_megapixelstep()
+
+    reference_loads, reference_kudos = replay(
+        snapshots,
+        lambda _now, statuses: reference_choose(statuses, args.dynamic),
+        valuer,
+        capacity,
+        args.load_seconds,
+    )
+    planner = ResidencyPlanner()
+    load_seconds = {}
+
+    def plan(now, statuses):
+        names = [status["name"] for status in statuses]
+        load_seconds.update(dict.fromkeys(names, args.load_seconds))
+        residency_plan = planner.plan(
+            statuses,
+            names,
+            budget_mb=args.budget,
+            max_models=args.dynamic,
+            load_seconds=load_seconds,
+            capacity=capacity,
+            now=now,
+        )
+        planner.apply(residency_plan, now)
+        return residency_plan.keep
+
+    def served(model, model_kudos, now):
+        # As the jobs we'd have done for it
+        planner.record_job(model, model_kudos, model_kudos / valuer.get_kudos_per_megapixelstep(), now)
+
+    loads, kudos = replay(snapshots, plan, valuer, capacity, args.load_seconds, served)
+    print(f"{'':<12}{'loads':>8}{'loads/hour':>12}{'kudos':>12}")
+    for name, model_loads, model_kudos in (
+        ("reference", reference_loads, reference_kudos),
+        ("planner", loads, kudos),
+    ):
+        print(f"{name:<12}{model_loads:>8}{model_loads / max(hours, 1 / 60):>12.1f}{model_kudos:>12.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark choosing the dynamic models")
+    parser.add_argument("--record", help="A file of snapshots recorded with model_status_record_file")
+    parser.add_argument("--dynamic", type=int, default=5, help="number_of_dynamic_models")
+    parser.add_argument("--budget", type=float, default=16384, help="Megabytes the models may fill")
+    parser.add_argument("--speed", type=float, default=3, help="Megapixelsteps per second the worker does")
+    parser.add_argument("--load_seconds", type=float, default=10, help="Seconds to load a model")
+    parser.add_argument("--hours", type=float, default=24, help="Hours of snapshots to generate")
+    main(parser.parse_args())
@@ -0,0 +1,81 @@
+"""Replays a stream of jobs through the scheduling of the worker on simulated time, once for each of the settings
+given, and reports the jobs and kudos per hour of each, how long the GPU sat idle and how many jobs went stale.
+
+The jobs are those of a job trace file (job_trace_file) or generated, for a GPU doing --speed megapixelsteps
+per second. Each setting takes a comma separated list of values, and every combination of them is simulated.
+
+Usage: python -m benchmarks.simulate [--trace job_trace.jsonl] [--jobs 2000] [--speed 3] [--threads 1,2]
+       [--queue_size 0,1,2] [--max_power 8,32] [--submit_threads 2] [--hours 0]
+"""
+import argparse
+import itertools
+import random
+
+from worker.logger import logger
+from worker.testing.fake_bridge_data import FakeBridgeData
+from worker.testing.simulator import WorkerSimulator, generate_jobs, read_job_trace
+
+
+def get_values(text, kind=int):
+    return [kind(value) for value in text.split(",")]
+
+
+def main(args):
+    # The worker logs every job, hours of which are simulated here
+    logger.disable("worker")
+    if args.trace:
+        jobs = read_job_trace(args.trace)
+        print(f"{len(jobs)} jobs from {args.trace}")
+    else:
+        jobs = generate_jobs(args.jobs, random.Random(42), args.speed)
+        print(f"{len(jobs)} generated jobs, at {args.speed} megapixelsteps per second")
+    columns = ("threads", "queue", "power", "submit", "jobs/hour", "kudos/hour", "GPU idle", "stale", "skipped")
+    print("".join(f"{column:>11}" for column in columns))
+    for threads, queue_size, max_power, submit_threads in itertools.product(
+        get_values(args.threads),
+        get_values(args.queue_size),
+        get_values(args.max_power),
+        get_values(args.submit_threads),
+    ):
+        bridge_data = FakeBridgeData(
+            max_threads=threads,
+            queue_size=queue_size,
+            max_power=max_power,
+            submit_threads=submit_threads,
+            submit_backlog=10,
+            stats_output_frequency=0,
+        )
+        simulator = WorkerSimulator(
+            jobs,
+            bridge_data,
+            gpu_concurrency_gain=args.gpu_concurrency_gain,
+            empty_pop_ratio=args.empty_pop_ratio,
+        )
+        report = simulator.run(args.hours * 3600 if args.hours else None)
+        values = (
+            threads,
+            queue_size,
+            max_power,
+            submit_threads,
+            report["jobs_per_hour"],
+            report["kudos_per_hour"],
+            f"{report['gpu_idle_percent']}%",
+            report["stale_jobs"],
+            report["skipped_jobs"],
+        )
+        print("".join(f"{value:>11}" for value in values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the worker on a stream of jobs to tune its settings")
+    parser.add_argument("--trace", help="A job trace file to replay (job_trace_file)")
+    parser.add_argument("--jobs", type=int, default=2000, help="How many jobs to generate without a trace")
+    parser.add_argument("--speed", type=float, default=3, help="Megapixelsteps per second of the generated jobs")
+    parser.add_argument("--threads", default="1,2", help="max_threads values")
+    parser.add_argument("--queue_size", default="0,1,2", help="queue_size values")
+    parser.add_argument("--max_power", default="32", help="max_power values")
+    parser.add_argument("--submit_threads", default="2", help="submit_threads values")
+    parser.add_argument("--gpu_concurrency_gain", type=float, default=0.15, help="Extra work a second thread does")
+    parser.add_argument("--empty_pop_ratio", type=float, default=0, help="Share of the pops which find no job")
+    parser.add_argument("--hours", type=float, default=0, help="Simulated hours to stop after, 0 for all the jobs")
+    main(parser.parse_args())
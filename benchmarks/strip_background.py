@@ -0,0 +1,77 @@
+"""Benchmarks the per image latency of strip_background on CPU, for cold and warm rembg sessions.
+
+"legacy" creates a session for every image, as strip_background used to. "cold" is the first image on a fresh
+session pool, which has to load the model, and "warm" the following ones, which reuse the session.
+With --threads, the warm images are also stripped from that many threads at once, each on its own session,
+which only scales if the alpha matting releases the GIL.
+
+The u2net model is downloaded by rembg on first use, so run this once before trusting its numbers.
+
+Usage: python -m benchmarks.strip_background [--images 10] [--size 512] [--threads 2]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rembg
+from PIL import Image
+
+from worker.utils.background import RembgSessionPool, rembg_sessions, remove_background
+
+MODEL_NAME = "u2net"
+ALPHA_MATTING_OPTIONS = {
+    "alpha_matting": 10,
+    "alpha_matting_foreground_threshold": 240,
+    "alpha_matting_background_threshold": 10,
+    "alpha_matting_erode_size": 10,
+}
+
+
+def legacy_remove_background(image):
+    session = rembg.new_session(MODEL_NAME)
+    result = rembg.remove(image, session=session, only_mask=False, **ALPHA_MATTING_OPTIONS)
+    del session
+    return result
+
+
+def generate_image(size, seed):
+    """A bright disc on a noisy background, so that the alpha matting has an edge to work on"""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 80, (size, size, 3), dtype="uint8")
+    y, x = np.ogrid[:size, :size]
+    pixels[(x - size / 2) ** 2 + (y - size / 2) ** 2 < (size / 3) ** 2] = (230, 180, 120)
+    return Image.fromarray(pixels)
+
+
+def time_ms(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return round(1000 * (time.perf_counter() - start), 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark strip_background on cold and warm sessions")
+    parser.add_argument("--images", type=int, default=10, help="How many images to strip")
+    parser.add_argument("--size", type=int, default=512, help="Square size of the images")
+    parser.add_argument("--threads", type=int, default=2, help="Concurrent background removals, 0 to skip them")
+    args = parser.parse_args()
+    images = [generate_image(args.size, seed) for seed in range(args.images)]
+    # Makes sure the model is downloaded before timing anything
+    RembgSessionPool().acquire(MODEL_NAME)
+    legacy = [time_ms(legacy_remove_background, image) for image in images]
+    print(f"legacy, new session per image: {round(sum(legacy) / len(legacy), 1)} ms per image")
+    cold = time_ms(remove_background, images[0], MODEL_NAME, ALPHA_MATTING_OPTIONS)
+    print(f"session pool, cold:            {cold} ms")
+    warm = [time_ms(remove_background, image, MODEL_NAME, ALPHA_MATTING_OPTIONS) for image in images]
+    print(f"session pool, warm:            {round(sum(warm) / len(warm), 1)} ms per image")
+    if args.threads:
+        rembg_sessions.configure(max_sessions=args.threads)
+        with ThreadPoolExecutor(args.threads) as executor:
+            # Loads the sessions of the other threads
+            list(executor.map(lambda image: remove_background(image, MODEL_NAME, ALPHA_MATTING_OPTIONS), images))
+            start = time.perf_counter()
+            list(executor.map(lambda image: remove_background(image, MODEL_NAME, ALPHA_MATTING_OPTIONS), images))
+            thread_ms = round(1000 * (time.perf_counter() - start) / len(images), 1)
+        print(f"{args.threads} threads, warm:               {thread_ms} ms per image")
+    print(f"sessions kept loaded: {rembg_sessions.count_sessions(MODEL_NAME)}")
@@ -0,0 +1,75 @@
+"""Benchmarks job submission through a horde outage, with a thread per job against the bounded submit pool.
+
+Finished jobs keep arriving at a fixed rate while the fake horde answers every submit with a 503 for the
+duration of the outage. We report the peak of live threads, and how long it took for every job to be submitted.
+
+Usage: python -m benchmarks.submit [--jobs 100] [--job_interval 0.05] [--outage 5]
+"""
+import argparse
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+from worker.jobs.framework import HordeJobFramework
+from worker.jobs.submitter import job_submitter
+from worker.testing.fake_horde import FakeHorde, FakeHordeServer
+
+
+class FakeFinishedJob(HordeJobFramework):
+    """A job which is done generating and only needs to be submitted"""
+
+    def __init__(self, mm, bd, pop):
+        super().__init__(mm, bd, pop)
+        self.current_id = pop["id"]
+
+    def submit_job(self, endpoint="/api/v2/generate/submit"):
+        super().submit_job(endpoint=endpoint)
+
+    def prepare_submit_payload(self):
+        self.submit_dict = {"id": self.current_id, "generation": "R2", "seed": 0}
+
+
+class LegacyFinishedJob(FakeFinishedJob):
+    """Submits on a new thread per job, with the fixed retry sleeps we used to have"""
+
+    def start_submit_thread(self):
+        threading.Thread(target=self.submit_job).start()
+
+    def get_submit_retry_delay(self):
+        return 2
+
+
+def run(args, job_class):
+    horde = FakeHorde()
+    with FakeHordeServer(horde) as server:
+        bridge_data = SimpleNamespace(horde_url=server.url, api_key="0000000000", suppress_speed_warnings=True)
+        job_submitter.configure(max_threads=args.submit_threads, max_backlog=args.jobs)
+        horde.outage_until = time.monotonic() + args.outage
+        peak_threads = 0
+        start = time.monotonic()
+        for _ in range(args.jobs):
+            job = job_class(None, bridge_data, {"id": str(uuid.uuid4())})
+            job.start_submit_thread()
+            peak_threads = max(peak_threads, threading.active_count())
+            time.sleep(args.job_interval)
+        while len(horde.submits) < args.jobs and time.monotonic() - start < args.outage + 300:
+            peak_threads = max(peak_threads, threading.active_count())
+            time.sleep(0.05)
+        elapsed = time.monotonic() - start
+    return {
+        "submitted": len(horde.submits),
+        "peak_threads": peak_threads,
+        "seconds_to_drain": round(elapsed, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark job submission through a horde outage")
+    parser.add_argument("--jobs", type=int, default=100, help="How many finished jobs to submit")
+    parser.add_argument("--job_interval", type=float, default=0.05, help="Seconds between finished jobs")
+    parser.add_argument("--outage", type=float, default=5, help="Seconds the horde rejects submits for")
+    parser.add_argument("--submit_threads", type=int, default=2, help="Size of the submit pool")
+    args = parser.parse_args()
+    print(f"thread per job: {run(args, LegacyFinishedJob)}")
+    print(f"submit pool:    {run(args, FakeFinishedJob)}")
@@ -0,0 +1,115 @@
+"""Benchmarks the memory cost of uploading a large (e.g. upscaled) generation, for R2 and base64 submits.
+
+Compares the way we used to upload (BytesIO.getvalue(), base64 through a str, JSON serialized on every attempt)
+with the current upload path, against a local fake horde. Reports the peak of Python allocations while uploading,
+and how many bytes were copied along the way. Both paths encode in this process, so that only the upload
+path is compared.
+
+Usage: python -m benchmarks.upload [--size 2048]
+"""
+import argparse
+import base64
+import json
+import tracemalloc
+import uuid
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+from worker.jobs.encoder import ImageEncoder
+from worker.jobs.framework import HordeJobFramework
+from worker.sessions import http_session
+from worker.testing.fake_horde import FakeHorde, FakeHordeServer
+
+
+class UploadJob(HordeJobFramework):
+    """Just the upload and submit part of StableDiffusionHordeJob, without needing hordelib"""
+
+    def __init__(self, bd, image, r2_upload, encoder):
+        job_id = str(uuid.uuid4())
+        super().__init__(None, bd, {"id": job_id})
+        self.current_id = job_id
+        self.image = image
+        self.r2_upload = r2_upload and f"{bd.horde_url}/r2/upload/{job_id}"
+        self.encoder = encoder
+        self.generation_b64 = None
+
+    def submit_job(self, endpoint="/api/v2/generate/submit"):
+        super().submit_job(endpoint=endpoint)
+
+    def prepare_submit_payload(self):
+        encoded = self.encoder.encode(self.image, 95)
+        self.upload_bytes_copied += encoded.bytes_copied
+        try:
+            if self.r2_upload:
+                with encoded.open_upload_body() as upload_body:
+                    http_session.put(self.r2_upload, data=upload_body)
+            else:
+                if encoded.is_spooled():
+                    self.upload_bytes_copied += encoded.size
+                self.generation_b64 = base64.b64encode(encoded.get_buffer())
+                self.upload_bytes_copied += len(self.generation_b64)
+        finally:
+            encoded.close()
+        self.submit_dict = {"id": self.current_id, "seed": 0}
+        if self.r2_upload:
+            self.submit_dict["generation"] = "R2"
+
+    def serialize_submit_payload(self):
+        if self.generation_b64 is None:
+            return super().serialize_submit_payload()
+        payload = json.dumps(self.submit_dict).encode("utf-8")
+        payload = b"".join((b'{"generation": "', self.generation_b64, b'", ', payload[1:]))
+        self.generation_b64 = None
+        return payload
+
+
+def legacy_upload(bd, image, r2_upload):
+    """What prepare_submit_payload and submit_job used to do"""
+    job_id = str(uuid.uuid4())
+    buffer = BytesIO()
+    image.save(buffer, format="WebP", quality=95, method=0)
+    copied = buffer.tell()
+    if r2_upload:
+        http_session.put(f"{bd.horde_url}/r2/upload/{job_id}", data=buffer.getvalue())
+        generation = "R2"
+    else:
+        generation = base64.b64encode(buffer.getvalue()).decode("utf8")
+        copied += len(generation) * 2
+    submit_dict = {"id": job_id, "generation": generation, "seed": 0}
+    copied += len(json.dumps(submit_dict)) * 2
+    http_session.post(f"{bd.horde_url}/api/v2/generate/submit", json=submit_dict, headers={"apikey": bd.api_key})
+    return copied
+
+
+def measure(upload):
+    tracemalloc.start()
+    copied = upload()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"peak_mb": round(peak / 1024 / 1024, 1), "copied_mb": round(copied / 1024 / 1024, 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the memory cost of uploading a large generation")
+    parser.add_argument("--size", type=int, default=2048, help="Square size of the generated image")
+    args = parser.parse_args()
+    # Noise doesn't compress, which stands in for a worst case upscale
+    image = Image.fromarray(np.random.default_rng(42).integers(0, 255, (args.size, args.size, 3), dtype="uint8"))
+    with FakeHordeServer(FakeHorde()) as server:
+        bridge_data = SimpleNamespace(horde_url=server.url, api_key="0000000000", suppress_speed_warnings=True)
+        for r2_upload in (True, False):
+            label = "R2" if r2_upload else "base64"
+            print(f"{label + ', legacy:':<26}{measure(lambda: legacy_upload(bridge_data, image, r2_upload))}")
+            for spooled in (False, True):
+                encoder = ImageEncoder()
+                encoder.configure(threads=0, method=0, spool_threshold=0 if spooled else args.size * args.size * 4)
+
+                def upload(r2_upload=r2_upload, encoder=encoder):
+                    job = UploadJob(bridge_data, image, r2_upload, encoder)
+                    job.submit_job()
+                    return job.upload_bytes_copied
+
+                print(f"{label + ', current' + (', spooled' if spooled else '') + ':':<26}{measure(upload)}")
@@ -0,0 +1,69 @@
+"""Benchmarks the WebP encoding of the generated images, for each method and image size.
+
+Reports the encode time and size for every WebP method, which method "auto" picks for the latency budget,
+and the throughput of encoding a batch of images in the encode threads against the current thread.
+
+Usage: python -m benchmarks.webp_encode [--image path/to/image.png] [--sizes 512 1024 2048] [--quality 95]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from worker.jobs.encoder import ImageEncoder
+from worker.utils.webp import encode_webp
+
+
+def get_test_image(args, size):
+    if args.image:
+        return Image.open(args.image).convert("RGB").resize((size, size))
+    # Smooth gradients with some noise, which compresses more like a generation than pure noise does
+    rng = np.random.default_rng(42)
+    gradient = np.linspace(0, 200, size)
+    pixels = gradient[None, :, None] * 0.6 + gradient[:, None, None] * 0.4 + rng.normal(0, 12, (size, size, 3))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype("uint8"))
+
+
+def benchmark_methods(args, image):
+    results = {}
+    for method in range(7):
+        encoded, encode_time = encode_webp(image, args.quality, method)
+        results[method] = (round(encode_time, 3), encoded.size)
+    return results
+
+
+def benchmark_throughput(args, image, threads):
+    """Encodes the batch from as many threads as the submit threads would be, with the encoder on threads"""
+    encoder = ImageEncoder()
+    encoder.configure(threads=threads, method=4)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as submitters:
+        list(submitters.map(lambda _: encoder.encode(image, args.quality), range(args.batch)))
+    elapsed = time.perf_counter() - start
+    encoder.shutdown()
+    return round(args.batch / elapsed, 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark WebP encoding of the generated images")
+    parser.add_argument("--image", type=str, default=None, help="Image to encode, instead of a synthetic one")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048], help="Square sizes to test")
+    parser.add_argument("--quality", type=int, default=95, help="WebP quality")
+    parser.add_argument("--budget", type=float, default=1, help="Latency budget for the auto method, in seconds")
+    parser.add_argument("--batch", type=int, default=8, help="Images to encode for the throughput test")
+    args = parser.parse_args()
+    auto_encoder = ImageEncoder()
+    auto_encoder.configure(threads=0, latency_budget=args.budget)
+    for size in args.sizes:
+        image = get_test_image(args, size)
+        print(f"{size}x{size}:")
+        for method, (encode_time, encoded_bytes) in benchmark_methods(args, image).items():
+            print(f"    method {method}: {encode_time:>7}s {round(encoded_bytes / 1024, 1):>9} kb")
+        auto_encoder.encode(image, args.quality)
+        print(f"    auto picks method {auto_encoder.choose_method(size * size)} for a {args.budget}s budget")
+    image = get_test_image(args, args.sizes[-1])
+    print(f"Throughput encoding {args.sizes[-1]}x{args.sizes[-1]} images (images/s):")
+    print(f"    current thread: {benchmark_throughput(args, image, 0)}")
+    print(f"    2 encode threads: {benchmark_throughput(args, image, 2)}")
@@ -15,7 +15,7 @@ from hordelib.shared_model_manager import MODEL_CATEGORY_NAMES
 # isort: on
 
 from worker.bridge_data.interrogation import InterrogationBridgeData
-from worker.logger import logger, quiesce_logger, set_logger_verbosity
+from worker.logger import logger, quiesce_logger, set_logger_sinks, set_logger_verbosity
 from worker.workers.interrogation import InterrogationWorker
 
 if __name__ == "__main__":
@@ -24,6 +24,7 @@ if __name__ == "__main__":
 
     bridge_data = InterrogationBridgeData()
     bridge_data.reload_data()
+    set_logger_sinks(bridge_data.log_enqueue, bridge_data.log_json_file, bridge_data.log_rate_limit)
     SharedModelManager.load_model_managers(
         [
             MODEL_CATEGORY_NAMES.safety_checker,
@@ -7,7 +7,7 @@ from worker.utils.set_envs import set_worker_env_vars_from_config
 set_worker_env_vars_from_config()  # Get `cache_home` from `bridgeconfig.yaml` into the environment variable
 
 from worker.bridge_data.scribe import KoboldAIBridgeData  # noqa: E402
-from worker.logger import logger, quiesce_logger, set_logger_verbosity  # noqa: E402
+from worker.logger import logger, quiesce_logger, set_logger_sinks, set_logger_verbosity  # noqa: E402
 from worker.workers.scribe import ScribeWorker  # noqa: E402
 
 # isort: on
@@ -18,6 +18,7 @@ def main():
     quiesce_logger(args.quiet)
     bridge_data = KoboldAIBridgeData()
     bridge_data.reload_data()
+    set_logger_sinks(bridge_data.log_enqueue, bridge_data.log_json_file, bridge_data.log_rate_limit)
     try:
         worker = ScribeWorker(bridge_data)
         worker.start()
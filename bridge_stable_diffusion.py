@@ -17,7 +17,7 @@ from hordelib.consts import MODEL_CATEGORY_NAMES
 
 # isort: on
 from worker.bridge_data.stable_diffusion import StableDiffusionBridgeData
-from worker.logger import logger, quiesce_logger, set_logger_verbosity
+from worker.logger import logger, quiesce_logger, set_logger_sinks, set_logger_verbosity
 from worker.workers.stable_diffusion import StableDiffusionWorker
 
 
@@ -56,6 +56,7 @@ def main():
     bridge_data = StableDiffusionBridgeData()
     try:
         bridge_data.reload_data()
+        set_logger_sinks(bridge_data.log_enqueue, bridge_data.log_json_file, bridge_data.log_rate_limit)
 
         SharedModelManager.load_model_managers(
             [
@@ -4,14 +4,13 @@
 # Usage: model-stats.py [-h] [--horde] [--today] [--yesterday]
 import argparse
 import datetime
-import glob
-import mmap
-import re
 
 import requests
 import yaml
 from tqdm import tqdm
 
+from worker.log_stats import LogScanner
+
 # Location of stable horde worker bridge log
 LOG_FILE = "logs/bridge*.log"
 
@@ -25,12 +24,6 @@ PERIOD_HORDE_MONTH = 4
 PERIOD_KUDOS_HOUR = 5
 PERIOD_TEXT_HORDE_MONTH = 6
 
-# regex to identify model lines
-REGEX = re.compile(r".*(\d\d\d\d-\d\d-\d\d).*Starting generation: (.*) @")
-
-# regex to identify kudos lines
-KUDOS_REGEX = re.compile(r".*(\d\d\d\d-\d\d-\d\d \d\d:\d\d).* and contributed for (\d+\.\d+)")
-
 
 class LogStats:
     def __init__(self, period=PERIOD_ALL, logfile=LOG_FILE):
@@ -39,6 +32,7 @@ class LogStats:
         self.logfile = logfile
         self.period = period
         self.kudos = {}
+        self.model_kudos = {}
 
     def get_date(self):
         # Dates in log format for filtering
@@ -52,14 +46,6 @@ class LogStats:
             adate = adate.strftime("%Y-%m-%d")
         return adate
 
-    def get_num_lines(self, file_path):
-        with open(file_path, "r+") as fp:
-            buf = mmap.mmap(fp.fileno(), 0)
-            lines = 0
-            while buf.readline():
-                lines += 1
-            return lines
-
     def download_stats(self, period, model_type="img"):
         self.unused_models = []  # not relevant
 
@@ -87,41 +73,19 @@ class LogStats:
             self.download_stats("month", "text")
             return
 
-        # Identify all log files and total number of log lines
-        total_log_lines = sum(self.get_num_lines(logfile) for logfile in glob.glob(self.logfile))
-        progress = tqdm(total=total_log_lines, leave=True, unit=" lines", unit_scale=True)
-        for logfile in glob.glob(self.logfile):
-            with open(logfile, "rt", encoding="UTF-8", errors="ignore") as infile:
-                for line in infile:
-                    # Grab the lines we're interested in for models
-                    if regex := REGEX.match(line):
-                        if self.period in [PERIOD_TODAY, PERIOD_YESTERDAY] and regex.group(1) != self.get_date():
-                            continue
-                        # Extract model name
-                        model = regex.group(2)
-
-                        # Remember we used this model
-                        if model in self.unused_models:
-                            self.unused_models.remove(model)
-
-                        # Keep count of how many times we used a model
-                        if model in self.used_models:
-                            self.used_models[model] += 1
-                        else:
-                            self.used_models[model] = 1
-
-                    # Grab kudos lines
-                    # Grab the lines we're interested in
-                    if regex := KUDOS_REGEX.match(line):
-                        # Extract kudis and time
-                        timestamp = regex.group(1)[:-2]  # truncate to hour
-                        kudos = regex.group(2)
-                        if timestamp in self.kudos:
-                            self.kudos[timestamp] += float(kudos)
-                        else:
-                            self.kudos[timestamp] = float(kudos)
-
-                    progress.update()
+        # Only what was logged since the last run is scanned
+        scanner = LogScanner(self.logfile)
+        progress = tqdm(total=scanner.get_new_bytes(), leave=True, unit="B", unit_scale=True)
+        summary = scanner.scan(progress.update)
+        progress.close()
+        date = self.get_date() if self.period in [PERIOD_TODAY, PERIOD_YESTERDAY] else None
+        for model, (count, kudos) in summary.get_models(date).items():
+            # Remember we used this model
+            if model in self.unused_models:
+                self.unused_models.remove(model)
+            self.used_models[model] = count
+            self.model_kudos[model] = kudos
+        self.kudos = summary.get_kudos_per_hour()
 
     def print_stats(self):
         # Parse our log file if we haven't done that yet
@@ -141,7 +105,8 @@ class LogStats:
         total = sum(count for count, name in scores)
         for j, (count, name) in enumerate(scores, start=1):
             perc = round((count / total) * 100, 1)
-            print(f"{j:>2}. {name:<{max_len}} {perc}% ({count})")
+            kudos = f" {round(self.model_kudos[name])} kudos" if name in self.model_kudos else ""
+            print(f"{j:>2}. {name:<{max_len}} {perc}% ({count}){kudos}")
         print()
         if self.unused_models:
             print("The following models were not used at all:")
@@ -3,12 +3,11 @@
 # Usage: pop-stats.py [-h] [--today] [--yesterday]
 import argparse
 import datetime
-import glob
-import mmap
-import re
 
 from tqdm import tqdm
 
+from worker.log_stats import LogScanner
+
 # Location of stable horde worker bridge log
 LOG_FILE = "logs/bridge*.log"
 
@@ -18,9 +17,6 @@ PERIOD_TODAY = 1
 PERIOD_YESTERDAY = 2
 PERIOD_HOUR = 3
 
-# regex to identify model lines
-REGEX = re.compile(r".*(\d\d\d\d-\d\d-\d\d \d\d:\d\d).* Job pop took (\d+\.\d+).*node: (.*)\)")
-
 
 class LogStats:
     def __init__(self, period=PERIOD_ALL, logfile=LOG_FILE):
@@ -38,40 +34,18 @@ class LogStats:
             adate = adate.strftime("%Y-%m-%d")
         elif self.period == PERIOD_HOUR:
             adate = datetime.datetime.now()  # - datetime.timedelta(hours=1)
-            adate = adate.strftime("%Y-%m-%d %H:")
+            adate = adate.strftime("%Y-%m-%d %H")
         else:
             adate = None
         return adate
 
-    def get_num_lines(self, file_path):
-        with open(file_path, "r+") as fp:
-            buf = mmap.mmap(fp.fileno(), 0)
-            lines = 0
-            while buf.readline():
-                lines += 1
-            return lines
-
     def parse_log(self):
-        # Identify all log files and total number of log lines
-        total_log_lines = sum(self.get_num_lines(logfile) for logfile in glob.glob(self.logfile))
-        progress = tqdm(total=total_log_lines, leave=True, unit=" lines", unit_scale=True)
-        for logfile in glob.glob(self.logfile):
-            with open(logfile, "rt") as infile:
-                for line in infile:
-                    # Grab the lines we're interested in
-                    if regex := REGEX.match(line):
-                        if self.period and self.get_date() not in regex.group(1):
-                            continue
-
-                        # Extract kudis and time
-                        kudos = regex.group(2)
-                        node = regex.group(3).split(":")[0]
-                        if node in self.data:
-                            self.data[node] = [self.data[node][0] + float(kudos), self.data[node][1] + 1]
-                        else:
-                            self.data[node] = [float(kudos), 1]
-
-                    progress.update()
+        # Only what was logged since the last run is scanned
+        scanner = LogScanner(self.logfile)
+        progress = tqdm(total=scanner.get_new_bytes(), leave=True, unit="B", unit_scale=True)
+        summary = scanner.scan(progress.update)
+        progress.close()
+        self.data = summary.get_pop_times(self.get_date())
 
     def print_stats(self):
         # Parse our log file if we haven't done that yet
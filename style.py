@@ -30,6 +30,7 @@ os.chdir(workingDirectory)
 
 src = [
     "worker",
+    "benchmarks",
 ]
 
 ignore_src = [
@@ -1,20 +1,45 @@
 """The configuration of the bridge"""
+import copy
 import os
 import random
 import sys
 import threading
 
-import requests
 import yaml
 
 from worker.consts import BRIDGE_CONFIG_FILE, BRIDGE_VERSION
 from worker.logger import logger
+from worker.model_loader import model_loader
+from worker.sessions import http_session
+
+
+class BridgeDataSnapshot:
+    """A frozen copy of the bridge data, taken on each reload and shared by all the jobs and poppers
+    created until the next one, so that they don't each need their own deep copy"""
+
+    def __init__(self, bridge_data, version):
+        # Attributes which are never modified, so the snapshot can share them with the live bridge data
+        memo = {}
+        for attribute in bridge_data.snapshot_shared_attributes:
+            value = getattr(bridge_data, attribute, None)
+            if value is not None:
+                memo[id(value)] = value
+        self.__dict__.update(copy.deepcopy(vars(bridge_data), memo))
+        self.__dict__["version"] = version
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Bridge data snapshots are read-only. Can't set '{name}'")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Bridge data snapshots are read-only. Can't delete '{name}'")
 
 
 class BridgeDataTemplate:
     """Configuration object"""
 
     mutex = threading.Lock()
+    # Extend with the attributes holding large immutable objects, which snapshots can share instead of copying
+    snapshot_shared_attributes = ("args",)
 
     def __init__(self, args):
         random.seed()
@@ -44,7 +69,26 @@ class BridgeDataTemplate:
         self.require_upfront_kudos = os.environ.get("REQUIRE_UPFRONT_KUDOS", "false") == "true"
         self.stats_output_frequency = int(os.environ.get("STATS_OUTPUT_FREQUENCY", 30))
         self.disable_terminal_ui = os.environ.get("DISABLE_TERMINAL_UI", "false") == "true"
+        self.prefetch_jobs = os.environ.get("HORDE_PREFETCH_JOBS", "true") == "true"
+        self.http_timeout = int(os.environ.get("HORDE_HTTP_TIMEOUT", 30))
+        self.http_retries = int(os.environ.get("HORDE_HTTP_RETRIES", 3))
+        self.submit_threads = int(os.environ.get("HORDE_SUBMIT_THREADS", 2))
+        self.submit_backlog = int(os.environ.get("HORDE_SUBMIT_BACKLOG", 10))
+        self.rembg_sessions = int(os.environ.get("HORDE_REMBG_SESSIONS", 1))
+        self.rembg_idle_timeout = float(os.environ.get("HORDE_REMBG_IDLE_TIMEOUT", 300))
+        self.metrics_port = int(os.environ.get("HORDE_METRICS_PORT", 0))
+        self.metrics_host = os.environ.get("HORDE_METRICS_HOST", "127.0.0.1")
+        self.job_trace_file = os.environ.get("HORDE_JOB_TRACE_FILE", "")
+        self.job_trace_sample_rate = float(os.environ.get("HORDE_JOB_TRACE_SAMPLE_RATE", 1.0))
+        self.log_enqueue = os.environ.get("HORDE_LOG_ENQUEUE", "false") == "true"
+        self.log_json_file = os.environ.get("HORDE_LOG_JSON_FILE", "")
+        self.log_rate_limit = int(os.environ.get("HORDE_LOG_RATE_LIMIT", 60))
+        self.source_cache_size = float(os.environ.get("HORDE_SOURCE_CACHE_SIZE", 256))
+        self.source_cache_disk_size = float(os.environ.get("HORDE_SOURCE_CACHE_DISK_SIZE", 0))
+        self.source_cache_dir = os.environ.get("HORDE_SOURCE_CACHE_DIR", "source_cache")
+        self.model_load_threads = int(os.environ.get("HORDE_MODEL_LOAD_THREADS", 1))
         self.initialized = False
+        self.snapshot_version = 0
         self.username = None
         self.models_reloading = False
         self.max_models_to_download = 10
@@ -83,9 +127,10 @@ class BridgeDataTemplate:
         if self.args.max_power:
             self.max_power = self.args.max_power
         self.max_power = max(self.max_power, 2)
+        http_session.configure_from_bridge_data(self)
         if not self.initialized or previous_api_key != self.api_key:
             try:
-                user_req = requests.get(
+                user_req = http_session.get(
                     f"{self.horde_url}/api/v2/find_user",
                     headers={"apikey": self.api_key},
                     timeout=10,
@@ -97,6 +142,11 @@ class BridgeDataTemplate:
                 logger.warning(f"Server {self.horde_url} error during find_user. Setting username 'N/A'")
                 self.username = "N/A"
 
+    def snapshot(self):
+        """Returns a new read-only snapshot of the current configuration, with a new version"""
+        self.snapshot_version += 1
+        return BridgeDataSnapshot(self, self.snapshot_version)
+
     @logger.catch(reraise=True)
     def check_models(self, model_manager):
         """Check to see if we have the models needed"""
@@ -201,22 +251,22 @@ class BridgeDataTemplate:
         thread = threading.Thread(target=self._reload_models, args=(model_manager,), daemon=True)
         thread.start()
 
+    def get_model_demand(self):
+        """Returns how many jobs the horde has queued for each of the models we could load, to load the most wanted
+        first. Extend for the worker types which have such models"""
+        return {}
+
     @logger.catch(reraise=True)
     def _reload_models(self, model_manager):
-        with self.mutex:
-            model_names = self.model_names[:]
-        for model in model_manager.get_loaded_models_names():
-            if model not in model_names:
-                logger.init(f"{model}", status="Unloading")
-                model_manager.unload_model(model)
-        for model in model_names:
-            if model not in model_manager.get_loaded_models_names():
-                success = None
-                if model == "safety_checker":
-                    success = model_manager.load(model, cpu_only=True)
-                else:
-                    success = model_manager.load(model)
-                if not success:
-                    logger.init_err(f"{model}", status="Error")
+        try:
+            with self.mutex:
+                model_names = self.model_names[:]
+            model_loader.unload(model_manager, model_names)
+            loaded_models = model_manager.get_loaded_models_names()
+            demand = {}
+            if any(model not in loaded_models for model in model_names):
+                demand = self.get_model_demand()
+            model_loader.load(model_manager, model_names, demand)
             self.initialized = True
-        self.models_reloading = False
+        finally:
+            self.models_reloading = False
@@ -6,6 +6,7 @@ from loguru import logger
 
 from worker.argparser.scribe import args
 from worker.bridge_data.framework import BridgeDataTemplate
+from worker.sessions import http_session
 
 
 class KoboldAIBridgeData(BridgeDataTemplate):
@@ -53,7 +54,7 @@ class KoboldAIBridgeData(BridgeDataTemplate):
     def validate_kai(self):
         logger.debug("Retrieving settings from KoboldAI Client...")
         try:
-            req = requests.get(self.kai_url + "/api/latest/model")
+            req = http_session.get(self.kai_url + "/api/latest/model")
             self.model = req.json()["result"]
             # Normalize huggingface and local downloaded model names
             if "/" not in self.model:
@@ -64,9 +65,9 @@ class KoboldAIBridgeData(BridgeDataTemplate):
             # req = requests.get(self.kai_url + "/api/latest/config/max_length")
             # self.max_length = req.json()["value"]
             if self.model not in self.softprompts:
-                req = requests.get(self.kai_url + "/api/latest/config/soft_prompts_list")
+                req = http_session.get(self.kai_url + "/api/latest/config/soft_prompts_list")
                 self.softprompts[self.model] = [sp["value"] for sp in req.json()["values"]]
-            req = requests.get(self.kai_url + "/api/latest/config/soft_prompt")
+            req = http_session.get(self.kai_url + "/api/latest/config/soft_prompt")
             self.current_softprompt = req.json()["value"]
         except requests.exceptions.JSONDecodeError:
             logger.error(f"Server {self.kai_url} is up but does not appear to be a KoboldAI server.")
@@ -12,11 +12,20 @@ from worker.argparser.stable_diffusion import args
 from worker.bridge_data.framework import BridgeDataTemplate
 from worker.consts import KNOWN_INTERROGATORS, POST_PROCESSORS_HORDELIB_MODELS
 from worker.logger import logger
+from worker.sessions import http_session
 
 
 class StableDiffusionBridgeData(BridgeDataTemplate):
     """Configuration object"""
 
+    snapshot_shared_attributes = (
+        *BridgeDataTemplate.snapshot_shared_attributes,
+        "censor_image_sfw_worker",
+        "censor_image_censorlist",
+        "censor_image_sfw_request",
+        "censor_image_csam",
+    )
+
     def __init__(self):
         super().__init__(args)
         self._last_top_n_refresh = 0
@@ -43,6 +52,9 @@ class StableDiffusionBridgeData(BridgeDataTemplate):
         self.always_download = True
         self.dynamic_models = False
         self.number_of_dynamic_models = 0
+        self.residency_hysteresis = float(os.environ.get("HORDE_RESIDENCY_HYSTERESIS", 0.25))
+        self.residency_min_seconds = float(os.environ.get("HORDE_RESIDENCY_MIN_SECONDS", 600))
+        self.model_status_record_file = os.environ.get("HORDE_MODEL_STATUS_RECORD_FILE", "")
         self.max_lora_cache_size = int(os.environ.get("HORDE_MAX_LORA_CACHE", "10"))
         self.models_to_skip = os.environ.get("HORDE_SKIPPED_MODELNAMES", "stable_diffusion_inpainting").split(",")
         self.predefined_models = self.model_names.copy()
@@ -51,6 +63,10 @@ class StableDiffusionBridgeData(BridgeDataTemplate):
         self.ram_to_leave_free = os.environ.get("HORDE_RAM_TO_LEAVE_FREE", "50%")
         self.vram_to_leave_free = os.environ.get("HORDE_VRAM_TO_LEAVE_FREE", "50%")
         self.disable_disk_cache = os.environ.get("HORDE_DISABLE_DISK_CACHE", "false") == "true"
+        self.encode_threads = int(os.environ.get("HORDE_ENCODE_THREADS", 2))
+        self.webp_method = os.environ.get("HORDE_WEBP_METHOD", "auto")
+        self.webp_encode_budget = float(os.environ.get("HORDE_WEBP_ENCODE_BUDGET", 1))
+        self.upload_spool_size = float(os.environ.get("HORDE_UPLOAD_SPOOL_SIZE", 16))
         self.last_lora_check = None
         # Some config file options require us to actually set env vars to pass settings to third party systems
         # Where we load models from
@@ -213,7 +229,7 @@ class StableDiffusionBridgeData(BridgeDataTemplate):
         logger.info("Refreshing the list of all available models")
         response = None
         try:
-            response = requests.get(
+            response = http_session.get(
                 url="https://raw.githubusercontent.com/Haidra-Org/AI-Horde-image-model-reference/main/stable_diffusion.json",
                 timeout=10,
             )
@@ -261,6 +277,17 @@ class StableDiffusionBridgeData(BridgeDataTemplate):
 
         return models
 
+    def get_model_demand(self):
+        """Returns how many jobs the horde has queued for each image model"""
+        try:
+            req = http_session.get(f"{self.horde_url}/api/v2/status/models?type=image", timeout=10)
+            if req.ok:
+                return {model["name"]: model["queued"] for model in req.json()}
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            pass
+        logger.warning("Failed to retrieve the model queues. Loading the models in the configured order.")
+        return {}
+
     # Get the top n most popular models from the horde server
     def get_top_n_models(self, top_n, period="day"):
         model_list = []
@@ -281,7 +308,7 @@ class StableDiffusionBridgeData(BridgeDataTemplate):
             models = {}
             logger.info("Refreshing the most popular model data")
             try:
-                req = requests.get(f"{self.horde_url}/api/v2/stats/img/models")
+                req = http_session.get(f"{self.horde_url}/api/v2/stats/img/models")
                 models = req.json()[period] if req.ok else {}
             except requests.exceptions.RequestException:
                 logger.warning("Failed to retrieve the most popular models data.")
@@ -1,7 +1,11 @@
 """Post process images"""
+import threading
 import time
+import weakref
 
+import open_clip
 import regex as re
+import torch
 from hordelib.clip.interrogate import Interrogator
 from unidecode import unidecode
 
@@ -251,9 +255,76 @@ NSFW_MODEL_ADJUSTMENTS = [
     ("porn", 0.015),
     ("orgy", 0.01),
 ]
+
+
+class ClipTextFeatureCache:
+    """The normalized CLIP text embeddings of the CSAM vocabulary, as a single matrix kept on the model's device.
+    The vocabulary never changes between jobs, so it's encoded only once per CLIP model, instead of on every image.
+    Entries are dropped along with their model, and recomputed if the vocabulary changes."""
+
+    def __init__(self):
+        self.entries = weakref.WeakKeyDictionary()
+        self._mutex = threading.Lock()
+
+    def get_text_features(self, clip_model, words):
+        model = clip_model["model"]
+        with self._mutex:
+            entry = self.entries.get(model)
+            if entry and entry[0] == words:
+                return entry[1]
+        tokenize = clip_model.get("tokenizer", open_clip.tokenize)
+        with torch.no_grad(), get_autocast(clip_model["device"]):
+            text_features = model.encode_text(tokenize(list(words)).to(clip_model["device"])).float()
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+        with self._mutex:
+            self.entries[model] = (words, text_features)
+        return text_features
+
+
+clip_text_features = ClipTextFeatureCache()
+
+
+# What get_similarities() needs of the loaded CLIP model. A "tokenizer" is optional
+CLIP_MODEL_KEYS = ("model", "preprocess", "device")
+
+
+def can_encode_directly(clip_model):
+    """Whether the CLIP model is a dict we can encode the image and the vocabulary with ourselves"""
+    return isinstance(clip_model, dict) and all(key in clip_model for key in CLIP_MODEL_KEYS)
+
+
+def get_autocast(device):
+    device_type = torch.device(device).type
+    return torch.autocast(device_type, enabled=device_type == "cuda")
+
+
+def get_word_list():
+    """The vocabulary we compare each image against. It's a tuple, so that it can be compared to the cached one"""
+    return tuple(list(UNDERAGE_CONTEXT.keys()) + list(LEWD_CONTEXT.keys()) + CONTROL_WORDS + TEST_WORDS)
+
+
+def get_similarities(clip_model, image, words):
+    """Returns the cosine similarity of the image to each word: a single image encode and one matrix multiply"""
+    text_features = clip_text_features.get_text_features(clip_model, words)
+    with torch.no_grad(), get_autocast(clip_model["device"]):
+        image_input = clip_model["preprocess"](image).unsqueeze(0).to(clip_model["device"])
+        image_features = clip_model["model"].encode_image(image_input).float()
+    image_features /= image_features.norm(dim=-1, keepdim=True)
+    return dict(zip(words, (image_features @ text_features.T)[0].tolist()))
+
+
 weight_remover = re.compile(r"\((.*?):\d+\.\d+\)")
 whitespace_remover = re.compile(r"(\s(\w)){3,}\b")
 whitespace_converter = re.compile(r"([^\w\s]|_)")
+whitespace_collapser = re.compile(r"\s+")
+non_ascii_finder = re.compile(r"[^\x00-\x7f]+")
+# What whitespace_converter does to ASCII text, as a table for str.translate
+ascii_whitespace_converter = {
+    code: " " for code in range(128) if whitespace_converter.fullmatch(chr(code)) is not None
+}
+# The normalized prompt is ASCII, so lowering it once is exact and spares each boost a case insensitive search.
+# The boost patterns are all lower case already.
+prompt_boost_regexes = [re.compile(entry["regex"].pattern) for entry in PROMPT_BOOSTS]
 
 
 def check_for_csam(clip_model, image, prompt, model_info=None):
@@ -267,46 +338,136 @@ def check_for_csam(clip_model, image, prompt, model_info=None):
     if not model_tags:
         model_tags = []
     poc_start = time.time()
-    interrogator = Interrogator(clip_model)
-
-    word_list = list(UNDERAGE_CONTEXT.keys()) + list(LEWD_CONTEXT.keys()) + CONTROL_WORDS + TEST_WORDS
-    similarity_result = interrogator(image=image, text_array=word_list, similarity=True)["default"]
+    word_list = get_word_list()
+    if can_encode_directly(clip_model):
+        similarity_result = get_similarities(clip_model, image, word_list)
+    else:
+        # A CLIP model we don't know how to drive directly. The interrogator re-encodes the vocabulary every time
+        logger.debug("Falling back to the CLIP interrogator for the CSAM check")
+        interrogator = Interrogator(clip_model)
+        similarity_result = interrogator(image=image, text_array=list(word_list), similarity=True)["default"]
     poc_elapsed_time = time.time() - poc_start
     prompt, negprompt = normalize_prompt(prompt)
+    prompt_boosts = find_prompt_boosts(prompt)
+    # The adjustments are made again on the original similarities to explain them, only if anything is found
+    original_similarities = dict(similarity_result)
+    adjust_similarities(similarity_result, negprompt, prompt_boosts, model_nsfw, model_tags)
+    found_uc = [u_c for u_c in UNDERAGE_CONTEXT if similarity_result[u_c] > UNDERAGE_CONTEXT[u_c]]
+    critical_uc = [u_c for u_c in UNDERAGE_CRITICAL if similarity_result[u_c] > UNDERAGE_CRITICAL[u_c]]
+    found_lewd = [l_c for l_c in LEWD_CONTEXT if similarity_result[l_c] > LEWD_CONTEXT[l_c]]
     prompt_tweaks = {}
+    model_tweaks = {}
+    adjustments = {}
+    if found_uc or critical_uc or found_lewd:
+        adjust_similarities(
+            original_similarities,
+            negprompt,
+            prompt_boosts,
+            model_nsfw,
+            model_tags,
+            prompt_tweaks=prompt_tweaks,
+            model_tweaks=model_tweaks,
+            adjustments=adjustments,
+        )
+    found_uc = [
+        {
+            "word": u_c,
+            "similarity": similarity_result[u_c],
+            "threshold": UNDERAGE_CONTEXT[u_c],
+            "prompt_tweaks": prompt_tweaks.get(u_c),
+            "model_tweaks": model_tweaks.get(u_c),
+            "adjustments": adjustments.get(u_c),
+        }
+        for u_c in found_uc
+    ]
+    # When the value for some underage context is too high, it goes critical and we triple the suspicion
+    for u_c in critical_uc:
+        found_uc.extend(
+            (
+                {
+                    "word": u_c,
+                    "similarity": similarity_result[u_c],
+                    "threshold": UNDERAGE_CRITICAL[u_c],
+                    "prompt_tweaks": prompt_tweaks.get(u_c),
+                    "adjustments": adjustments.get(u_c),
+                    "model_tweaks": model_tweaks.get(u_c),
+                    "critical": True,
+                },
+                {
+                    "word": u_c,
+                    "similarity": similarity_result[u_c],
+                    "threshold": UNDERAGE_CRITICAL[u_c],
+                    "prompt_tweaks": prompt_tweaks.get(u_c),
+                    "adjustments": adjustments.get(u_c),
+                    "model_tweaks": model_tweaks.get(u_c),
+                    "critical": True,
+                },
+            ),
+        )
+    found_lewd = [
+        {
+            "word": l_c,
+            "similarity": similarity_result[l_c],
+            "threshold": LEWD_CONTEXT[l_c],
+            "prompt_tweaks": prompt_tweaks.get(l_c),
+            "adjustments": adjustments.get(l_c),
+            "model_tweaks": model_tweaks.get(l_c),
+        }
+        for l_c in found_lewd
+    ]
+    is_csam = bool(len(found_uc) >= 3 and found_lewd)
+    logger.debug(f"Similarity Result after {poc_elapsed_time} seconds - Result = {is_csam}")
+    return is_csam, similarity_result, {"found_uc": found_uc, "found_lewd": found_lewd}
+
+
+def adjust_similarities(
+    similarity_result,
+    negprompt,
+    prompt_boosts,
+    model_nsfw,
+    model_tags,
+    prompt_tweaks=None,
+    model_tweaks=None,
+    adjustments=None,
+):
+    """Adjusts the similarities in place, by the prompt, the model and the control words.
+    Records which rules changed each word in the tweak dicts given"""
     for entry in NEGPROMPT_BOOSTS:
         if negprompt and entry in negprompt:
             for adjust_word in UNDERAGE_CONTEXT:
-                add_value_to_dict_array(prompt_tweaks, adjust_word, entry)
+                if prompt_tweaks is not None:
+                    add_value_to_dict_array(prompt_tweaks, adjust_word, entry)
                 similarity_result[adjust_word] += 0.005
     for entry in NEGPROMPT_DEBUFFS:
         if negprompt and entry in negprompt:
             for adjust_word in UNDERAGE_CONTEXT:
-                add_value_to_dict_array(prompt_tweaks, adjust_word, entry)
+                if prompt_tweaks is not None:
+                    add_value_to_dict_array(prompt_tweaks, adjust_word, entry)
                 similarity_result[adjust_word] -= 0.005
-    for entry in PROMPT_BOOSTS:
-        if prompt_re := entry["regex"].search(prompt):
+    for entry, prompt_boost in zip(PROMPT_BOOSTS, prompt_boosts):
+        if prompt_boost is not None:
             for adjust_word in entry["adjustments"]:
                 #  The below prevents us from increasing the plural and the singlar above the threshold
                 # due to the boost. This prevents us from hitting the threshold with something like
                 # teen + teens due to boosts
                 if adjust_word in PAIRS and similarity_result[PAIRS[adjust_word]] > UNDERAGE_CONTEXT[adjust_word]:
                     continue
-                add_value_to_dict_array(prompt_tweaks, adjust_word, prompt_re.group())
+                if prompt_tweaks is not None:
+                    add_value_to_dict_array(prompt_tweaks, adjust_word, prompt_boost)
                 similarity_result[adjust_word] += entry["adjustments"][adjust_word]
     # For some reason clip associates infant with pregnant women a lot.
     # So to avoid censoring pregnant women, when they're drawn we reduce
     # the weight of "infant"
-    model_tweaks = {}
     if model_nsfw:
         for adjust_word, similarity_adjustment in NSFW_MODEL_ADJUSTMENTS:
-            add_value_to_dict_array(model_tweaks, adjust_word, "nsfw")
+            if model_tweaks is not None:
+                add_value_to_dict_array(model_tweaks, adjust_word, "nsfw")
             similarity_result[adjust_word] += similarity_adjustment
     for tag in [tag for tag in MODEL_TAG_ADJUSTMENTS if tag in model_tags]:
         for adjust_word, similarity_adjustment in MODEL_TAG_ADJUSTMENTS[tag]:
-            add_value_to_dict_array(model_tweaks, adjust_word, tag)
+            if model_tweaks is not None:
+                add_value_to_dict_array(model_tweaks, adjust_word, tag)
             similarity_result[adjust_word] += similarity_adjustment
-    adjustments = {}
     for control in CONTROL_WORD_ADJUSTMENTS:
         control_word, threshold = control["control"]
         # logger.info([similarity_result[control_word],control_word,threshold])
@@ -315,59 +476,8 @@ def check_for_csam(clip_model, image, prompt, model_info=None):
                 if adjust_word in PAIRS and similarity_result[PAIRS[adjust_word]] > UNDERAGE_CONTEXT[adjust_word]:
                     continue
                 similarity_result[adjust_word] += similarity_adjustment
-                add_value_to_dict_array(adjustments, adjust_word, control_word)
-    found_uc = [
-        {
-            "word": u_c,
-            "similarity": similarity_result[u_c],
-            "threshold": UNDERAGE_CONTEXT[u_c],
-            "prompt_tweaks": prompt_tweaks.get(u_c),
-            "model_tweaks": model_tweaks.get(u_c),
-            "adjustments": adjustments.get(u_c),
-        }
-        for u_c in UNDERAGE_CONTEXT
-        if similarity_result[u_c] > UNDERAGE_CONTEXT[u_c]
-    ]
-    # When the value for some underage context is too high, it goes critical and we triple the suspicion
-    for u_c in UNDERAGE_CRITICAL:
-        if similarity_result[u_c] > UNDERAGE_CRITICAL[u_c]:
-            found_uc.extend(
-                (
-                    {
-                        "word": u_c,
-                        "similarity": similarity_result[u_c],
-                        "threshold": UNDERAGE_CRITICAL[u_c],
-                        "prompt_tweaks": prompt_tweaks.get(u_c),
-                        "adjustments": adjustments.get(u_c),
-                        "model_tweaks": model_tweaks.get(u_c),
-                        "critical": True,
-                    },
-                    {
-                        "word": u_c,
-                        "similarity": similarity_result[u_c],
-                        "threshold": UNDERAGE_CRITICAL[u_c],
-                        "prompt_tweaks": prompt_tweaks.get(u_c),
-                        "adjustments": adjustments.get(u_c),
-                        "model_tweaks": model_tweaks.get(u_c),
-                        "critical": True,
-                    },
-                ),
-            )
-    found_lewd = [
-        {
-            "word": l_c,
-            "similarity": similarity_result[l_c],
-            "threshold": LEWD_CONTEXT[l_c],
-            "prompt_tweaks": prompt_tweaks.get(l_c),
-            "adjustments": adjustments.get(l_c),
-            "model_tweaks": model_tweaks.get(l_c),
-        }
-        for l_c in LEWD_CONTEXT
-        if similarity_result[l_c] > LEWD_CONTEXT[l_c]
-    ]
-    is_csam = bool(len(found_uc) >= 3 and found_lewd)
-    logger.debug(f"Similarity Result after {poc_elapsed_time} seconds - Result = {is_csam}")
-    return is_csam, similarity_result, {"found_uc": found_uc, "found_lewd": found_lewd}
+                if adjustments is not None:
+                    add_value_to_dict_array(adjustments, adjust_word, control_word)
 
 
 def normalize_prompt(prompt):
@@ -375,28 +485,39 @@ def normalize_prompt(prompt):
     negprompt = None
     if "###" in prompt:
         prompt, negprompt = prompt.split("###", 1)
-    prompt = weight_remover.sub(r"\1", prompt)
-    prompt = whitespace_converter.sub(" ", prompt)
-    for match in re.finditer(whitespace_remover, prompt):
-        trim_match = match.group(0).strip()
-        replacement = re.sub(r"\s+", "", trim_match)
-        prompt = prompt.replace(trim_match, replacement)
-    prompt = re.sub(r"\s+", " ", prompt)
-    # Remove all accents
-    prompt = unidecode(prompt)
+    prompt = normalize_text(prompt)
     if negprompt:
-        negprompt = weight_remover.sub(r"\1", negprompt)
-        negprompt = whitespace_converter.sub(" ", negprompt)
-        for match in re.finditer(whitespace_remover, negprompt):
-            trim_match = match.group(0).strip()
-            replacement = re.sub(r"\s+", "", trim_match)
-            negprompt = negprompt.replace(trim_match, replacement)
-        negprompt = re.sub(r"\s+", " ", negprompt)
-        # Remove all accents
-        negprompt = unidecode(negprompt)
+        negprompt = normalize_text(negprompt)
     return prompt, negprompt
 
 
+def normalize_text(text):
+    text = weight_remover.sub(r"\1", text)
+    text = text.translate(ascii_whitespace_converter)
+    if not text.isascii():
+        text = whitespace_converter.sub(" ", text)
+    for match in whitespace_remover.finditer(text):
+        trim_match = match.group(0).strip()
+        replacement = whitespace_collapser.sub("", trim_match)
+        text = text.replace(trim_match, replacement)
+    text = whitespace_collapser.sub(" ", text)
+    # Remove all accents. unidecode transliterates one character at a time, so only the non ASCII runs need it
+    return non_ascii_finder.sub(lambda match: unidecode(match.group()), text)
+
+
+def find_prompt_boosts(prompt):
+    """Returns, for each of the PROMPT_BOOSTS, the text of its first match in the prompt, or None"""
+    if not prompt.isascii():
+        return [match.group() if (match := entry["regex"].search(prompt)) else None for entry in PROMPT_BOOSTS]
+    lowered_prompt = prompt.lower()
+    found = []
+    for boost_regex in prompt_boost_regexes:
+        match = boost_regex.search(lowered_prompt)
+        # Lowering ASCII keeps the positions, so we can report the text as it was written
+        found.append(prompt[match.start() : match.end()] if match else None)
+    return found
+
+
 def add_value_to_dict_array(dict_to_modify, array_key, value):
     """Adds a value to an array stored in a dict key
     If the key does not exist, it is created
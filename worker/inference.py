@@ -0,0 +1,188 @@
+"""The inference backends, shared by everything in this process.
+
+The jobs don't call hordelib directly, but the configured backend:
+- "hordelib" runs the models on the GPU. hordelib must have been initialised before its first use.
+  It's what the worker always uses.
+- "synthetic" makes up the images on the CPU, without any model, taking as long as its latency model says.
+  It's there to benchmark and profile the rest of the worker on machines without a GPU, against the fake horde,
+  so it isn't a bridge option: only the benchmarks configure it.
+"""
+import hashlib
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from worker.logger import logger
+
+
+class HordeLibBackend:
+    """Runs the inference with hordelib. A single instance per process, instead of one per job"""
+
+    def __init__(self):
+        # Imported here, as it can only be imported once initialised
+        from hordelib.horde import HordeLib
+
+        self.hordelib = HordeLib()
+
+    def basic_inference(self, payload):
+        return self.hordelib.basic_inference(payload)
+
+    def image_upscale(self, payload):
+        return self.hordelib.image_upscale(payload)
+
+    def image_facefix(self, payload):
+        return self.hordelib.image_facefix(payload)
+
+    def is_image_nsfw(self, image):
+        from hordelib.safety_checker import is_image_nsfw
+
+        return is_image_nsfw(image)
+
+    def check_for_csam(self, clip_model, image, prompt, model_info=None):
+        from worker import csam
+
+        return csam.check_for_csam(clip_model, image, prompt, model_info)
+
+    def is_model_loaded(self, model):
+        from hordelib.shared_model_manager import SharedModelManager
+
+        return SharedModelManager.manager.is_model_loaded(model)
+
+    def load_model(self, model):
+        from hordelib.shared_model_manager import SharedModelManager
+
+        return SharedModelManager.manager.load(model)
+
+
+class SyntheticBackend:
+    """Makes up images of the requested size. The same payload always makes the same image, so that runs can be
+    compared. They're smooth colours with some grain, which encode about like generations do.
+
+    A generation takes overhead + megapixelsteps / speed seconds, with only the denoising_strength share of the
+    steps for img2img, and half as many again for hires_fix. Each can be up to `jitter` shorter or longer.
+    Upscaling takes upscale_seconds per megapixel of the upscaled image, face fixing facefix_seconds, and each
+    safety check safety_seconds. It sleeps all that time, leaving the GIL to the other threads like the GPU does.
+    """
+
+    def __init__(
+        self,
+        speed=3.0,
+        overhead=0.2,
+        jitter=0.0,
+        upscale_seconds=0.1,
+        facefix_seconds=0.5,
+        safety_seconds=0.05,
+    ):
+        self.speed = speed
+        self.overhead = overhead
+        self.jitter = jitter
+        self.upscale_seconds = upscale_seconds
+        self.facefix_seconds = facefix_seconds
+        self.safety_seconds = safety_seconds
+
+    @staticmethod
+    def get_rng(payload):
+        key = f"{payload.get('prompt')}|{payload.get('seed')}|{payload.get('model')}"
+        return np.random.default_rng(int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "little"))
+
+    def get_inference_seconds(self, payload, rng):
+        steps = payload.get("ddim_steps", 50)
+        if payload.get("source_image") and payload.get("source_processing") == "img2img":
+            steps *= payload.get("denoising_strength", 1.0)
+        if payload.get("hires_fix"):
+            steps *= 1.5
+        megapixelsteps = payload["width"] * payload["height"] * steps / 1e6
+        seconds = self.overhead + megapixelsteps / self.speed
+        return seconds * (1 + self.jitter * rng.uniform(-1, 1))
+
+    def basic_inference(self, payload):
+        rng = self.get_rng(payload)
+        time.sleep(self.get_inference_seconds(payload, rng))
+        width, height = payload["width"], payload["height"]
+        colours = Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)).resize(
+            (width, height),
+            Image.BICUBIC,
+        )
+        pixels = np.asarray(colours, dtype=np.int16) + rng.integers(-12, 13, (height, width, 3), dtype=np.int16)
+        return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    def image_upscale(self, payload):
+        image = payload["source_image"]
+        scale = 2 if "x2" in payload["model"] else 4
+        size = (image.width * scale, image.height * scale)
+        time.sleep(self.upscale_seconds * size[0] * size[1] / 1e6)
+        return image.resize(size, Image.NEAREST)
+
+    def image_facefix(self, payload):
+        time.sleep(self.facefix_seconds)
+        return payload["source_image"].copy()
+
+    def is_image_nsfw(self, image):  # noqa: ARG002
+        time.sleep(self.safety_seconds)
+        return False
+
+    def check_for_csam(self, clip_model, image, prompt, model_info=None):  # noqa: ARG002
+        time.sleep(self.safety_seconds)
+        return False, [], {}
+
+    def is_model_loaded(self, model):  # noqa: ARG002
+        return True
+
+    def load_model(self, model):  # noqa: ARG002
+        return True
+
+
+class Inference:
+    """Hands the inference over to the configured backend, which is created on first use"""
+
+    backends = {"hordelib": HordeLibBackend, "synthetic": SyntheticBackend}
+
+    def __init__(self):
+        self.name = "hordelib"
+        self.options = {}
+        self.backend = None
+        self._mutex = threading.Lock()
+
+    def configure(self, name=None, **options):
+        """Chooses the backend, by name, and the options it's created with"""
+        with self._mutex:
+            if name is not None and name not in self.backends:
+                logger.warning(f"Unknown inference backend '{name}'. Keeping '{self.name}'.")
+                return
+            name = name or self.name
+            if name != self.name or options != self.options:
+                self.name = name
+                self.options = options
+                self.backend = None
+
+    def get_backend(self):
+        with self._mutex:
+            if self.backend is None:
+                self.backend = self.backends[self.name](**self.options)
+            return self.backend
+
+    def basic_inference(self, payload):
+        return self.get_backend().basic_inference(payload)
+
+    def image_upscale(self, payload):
+        return self.get_backend().image_upscale(payload)
+
+    def image_facefix(self, payload):
+        return self.get_backend().image_facefix(payload)
+
+    def is_image_nsfw(self, image):
+        return self.get_backend().is_image_nsfw(image)
+
+    def check_for_csam(self, clip_model, image, prompt, model_info=None):
+        return self.get_backend().check_for_csam(clip_model, image, prompt, model_info)
+
+    def is_model_loaded(self, model):
+        return self.get_backend().is_model_loaded(model)
+
+    def load_model(self, model):
+        return self.get_backend().load_model(model)
+
+
+inference = Inference()
@@ -0,0 +1,170 @@
+"""Downloads and decodes the source images of the jobs"""
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, UnidentifiedImageError
+
+from worker.jobs.source_cache import source_cache
+from worker.logger import logger
+from worker.sessions import http_session
+
+
+class ImageDownloader:
+    """Downloads the source images of a job concurrently, and decodes each one as soon as it's downloaded,
+    while the others are still downloading. The same source, e.g. the image of several interrogation forms,
+    is only downloaded once.
+
+    Each download streams into a single buffer, preallocated when the size is announced, and is abandoned
+    as soon as it goes over max_size, whether the size was announced or not.
+
+    When the size the image will be used at is known, JPEGs are decoded straight at the smallest scale
+    (1/2, 1/4 or 1/8) still at least that big, which is much faster than decoding them at full size.
+
+    The images go through the source_cache, so that those sent again with later jobs aren't downloaded
+    or decoded again."""
+
+    # The most bytes a source image can have
+    max_size = 5120000
+    chunk_size = 64 * 1024
+    # Seconds to connect, and to wait for each chunk
+    timeout = 2
+
+    def __init__(self, threads=4):
+        self.threads = threads
+        self.executor = None
+        self._mutex = threading.Lock()
+
+    def get_executor(self):
+        with self._mutex:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="SourceDownload")
+            return self.executor
+
+    def download(self, url):
+        """Returns the bytes at the url, or None if they could not be downloaded or are too big"""
+        try:
+            with http_session.get(url, stream=True, timeout=self.timeout) as response:
+                if not response.ok:
+                    logger.error(f"Could not download source image {url} ({response.status_code})")
+                    return None
+                size = int(response.headers.get("Content-Length") or 0)
+                if size > self.max_size:
+                    logger.error(f"Provided image ({url}) cannot be larger than 5Mb")
+                    return None
+                # The announced size is only a hint: it's wrong for compressed responses
+                data = bytearray(size)
+                received = 0
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if received + len(chunk) > self.max_size:
+                        logger.error(f"Provided image ({url}) cannot be larger than 5Mb")
+                        return None
+                    data[received : received + len(chunk)] = chunk
+                    received += len(chunk)
+                del data[received:]
+        # pylint: disable=broad-except
+        except Exception as err:
+            logger.error(err)
+            return None
+        if not data:
+            logger.error(f"Could not download source image from R2 {url}. Skipping source image.")
+            return None
+        return data
+
+    def decode(self, data, size=None):
+        """Returns the image as RGBA if it has 4 bands, else as RGB, or None if it isn't an image.
+        With a size, JPEGs are reduced while decoding, down to no smaller than it"""
+        try:
+            img = Image.open(BytesIO(data))
+            mode = "RGBA" if len(img.getbands()) == 4 else "RGB"
+            if size:
+                img.draft(mode, size)
+            return img.convert(mode)
+        except (UnidentifiedImageError, OSError, ValueError) as err:
+            logger.error(f"Error when creating image: {err}.")
+            return None
+
+    def fetch(self, source, size=None):
+        """Returns the decoded image of a url or of base64 encoded bytes, or None.
+        The image is a copy of the cached one, which the job is free to change"""
+        if not source:
+            return None
+        if source.startswith(("https://", "http://")):
+            return self.fetch_url(source, size)
+        try:
+            data = base64.b64decode(source.encode("utf-8"))
+        # pylint: disable=broad-except
+        except Exception as err:
+            logger.warning(f"Could not decode source image from base 64  with error: '{err}'. Skipping source image.")
+            return None
+        content_hash = source_cache.get_hash(data)
+        img = source_cache.get_image(content_hash, size)
+        if img is not None:
+            source_cache.record("memory")
+            return img
+        source_cache.record("miss")
+        return self.decode_cached(content_hash, data, size)
+
+    def fetch_url(self, url, size=None):
+        content_hash = source_cache.get_url_hash(url)
+        if content_hash is not None:
+            img = source_cache.get_image(content_hash, size)
+            if img is not None:
+                source_cache.record("memory")
+                return img
+            data = source_cache.read(content_hash)
+            if data is not None:
+                source_cache.record("disk")
+                return self.decode_cached(content_hash, data, size)
+        data = self.download(url)
+        if data is None:
+            source_cache.record("miss")
+            logger.warning(f"Could not download source image from R2 {url}. Skipping source image.")
+            return None
+        content_hash = source_cache.get_hash(data)
+        # The same image at another url
+        img = source_cache.get_image(content_hash, size)
+        if img is not None:
+            source_cache.record("memory")
+        else:
+            source_cache.record("miss")
+            img = self.decode_cached(content_hash, data, size)
+            if not img:
+                logger.error("Non-image data when downloading image! Ignoring")
+                return None
+        source_cache.put_url(url, content_hash)
+        source_cache.write(url, content_hash, data)
+        return img
+
+    def decode_cached(self, content_hash, data, size=None):
+        """Decodes the image and caches it, returning a copy of it"""
+        img = self.decode(data, size)
+        if img is None:
+            return None
+        if source_cache.put_image(content_hash, size, img):
+            return img.copy()
+        return img
+
+    def fetch_all(self, sources, size=None):
+        """Returns the decoded image, or None, of each of the sources, fetched concurrently.
+        Every image is a copy of its own, even of the sources given several times"""
+        unique_sources = list(dict.fromkeys(source for source in sources if source))
+        if len(unique_sources) <= 1:
+            images = {source: self.fetch(source, size) for source in unique_sources}
+        else:
+            executor = self.get_executor()
+            images = dict(zip(unique_sources, executor.map(lambda source: self.fetch(source, size), unique_sources)))
+        # Each use of the same source gets its own image, as they may be changed concurrently
+        fetched = []
+        seen = set()
+        for source in sources:
+            img = images.get(source) if source else None
+            if img is not None and source in seen:
+                img = img.copy()
+            seen.add(source)
+            fetched.append(img)
+        return fetched
+
+
+image_downloader = ImageDownloader()
@@ -0,0 +1,123 @@
+"""Encodes the generated images for upload, on a bounded pool of threads"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from worker.logger import logger
+from worker.metrics import metrics
+from worker.utils.webp import EncodedImage, encode_webp
+
+
+class ImageEncoder:
+    """Encodes images to WebP on a small pool of threads, so that a burst of finished jobs can't have every submit
+    thread encoding at once and starve inference of CPU. Pillow releases the GIL while it encodes, so the other
+    worker threads keep running meanwhile, and the image and its bytes never have to be copied to another process.
+
+    The WebP method (0 is fastest, 6 is smallest) can be fixed, or chosen per image. With "auto", we pick
+    the slowest method whose estimated encode time for the image's pixel count still fits the latency budget.
+    The estimates start from a per megapixel cost table and are calibrated by every encode we observe,
+    as the actual speed depends on the CPU of each worker.
+
+    The censor images are static, so their encoded bytes are cached and never encoded twice.
+
+    Encoded images bigger than the spool threshold are written to a temporary file, so that they don't sit in
+    the worker's memory until they're uploaded.
+    """
+
+    # Rough seconds per megapixel for each WebP method, measured at quality 95
+    method_costs = {0: 0.15, 1: 0.2, 2: 0.2, 3: 0.3, 4: 0.3, 5: 0.35, 6: 0.9}
+    # How much each observed encode moves the calibration
+    calibration_weight = 0.2
+
+    def __init__(self):
+        self.executor = None
+        self.threads = 2
+        self.method = "auto"
+        self.latency_budget = 1.0
+        self.spool_threshold = 16 * 1024 * 1024
+        # Observed encode time over the estimated one, so that the cost table fits this machine
+        self.speed_factor = 1.0
+        self.cache = {}
+        self._mutex = threading.Lock()
+
+    def configure(self, threads=None, method=None, latency_budget=None, spool_threshold=None):
+        with self._mutex:
+            if spool_threshold is not None:
+                self.spool_threshold = spool_threshold
+            if method is not None:
+                self.method = method if method == "auto" else min(max(int(method), 0), 6)
+            if latency_budget is not None:
+                self.latency_budget = float(latency_budget)
+            if threads is not None and threads != self.threads:
+                self.threads = threads
+                if self.executor:
+                    # Encodes in progress finish on the old pool
+                    self.executor.shutdown(wait=False)
+                    self.executor = None
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.configure(
+            threads=bridge_data.encode_threads,
+            method=bridge_data.webp_method,
+            latency_budget=bridge_data.webp_encode_budget,
+            spool_threshold=int(bridge_data.upload_spool_size * 1024 * 1024),
+        )
+
+    def get_executor(self):
+        with self._mutex:
+            if self.executor is None and self.threads > 0:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="ImageEncoder")
+            return self.executor
+
+    def shutdown(self):
+        """Waits for the encodes in progress, and stops the encode threads. They're started again when needed"""
+        with self._mutex:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+    def estimate_encode_time(self, pixels, method):
+        return self.method_costs[method] * pixels / 1_000_000 * self.speed_factor
+
+    def choose_method(self, pixels):
+        """Returns the WebP method to use for an image with this many pixels"""
+        if self.method != "auto":
+            return self.method
+        for method in sorted(self.method_costs, reverse=True):
+            if self.estimate_encode_time(pixels, method) <= self.latency_budget:
+                return method
+        return 0
+
+    def calibrate(self, pixels, method, encode_time):
+        estimate = self.method_costs[method] * pixels / 1_000_000
+        if estimate <= 0:
+            return
+        self.speed_factor += self.calibration_weight * (encode_time / estimate - self.speed_factor)
+
+    def encode(self, image, quality, cache_key=None):
+        """Returns the image encoded as WebP, as an EncodedImage. Its close() should be called once it's uploaded.
+        Images which never change (e.g. the censor images) should pass a cache_key, to only be encoded once"""
+        if cache_key is not None and (cache_key, quality) in self.cache:
+            cached = self.cache[(cache_key, quality)]
+            # A new wrapper over the same bytes, which didn't cost any copy this time
+            return EncodedImage(data=cached.data, size=cached.size)
+        pixels = image.width * image.height
+        method = self.choose_method(pixels)
+        executor = self.get_executor()
+        if executor:
+            encoded, encode_time = executor.submit(encode_webp, image, quality, method, self.spool_threshold).result()
+        else:
+            encoded, encode_time = encode_webp(image, quality, method, self.spool_threshold)
+        self.calibrate(pixels, method, encode_time)
+        metrics.observe("horde_worker_encode_seconds", encode_time)
+        logger.debug(
+            f"Encoded {image.width}x{image.height} image to WebP with method {method} "
+            f"in {round(encode_time, 2)} seconds ({round(encoded.size / 1024, 1)} kb"
+            f"{', spooled to disk' if encoded.is_spooled() else ''})",
+        )
+        # Spooled files are deleted after their upload, so they can't be cached
+        if cache_key is not None and not encoded.is_spooled():
+            self.cache[(cache_key, quality)] = encoded
+        return encoded
+
+
+image_encoder = ImageEncoder()
@@ -1,25 +1,35 @@
 """Get and process a job from the horde"""
 import contextlib
-import copy
 import json
-import sys
-import threading
+import random
 import time
 
 import requests
 
 from worker.enums import JobStatus
-from worker.logger import logger
+from worker.jobs.submitter import job_submitter
+from worker.logger import log_stage, logger
+from worker.sessions import http_session
+from worker.stats import bridge_stats
+from worker.tracing import JobTimeline, job_tracer
 
 
 class HordeJobFramework:
     """Get and process a job from the horde"""
 
     retry_interval = 1
+    # Jobs older than this (in seconds) are always considered stale
+    max_job_lifetime = 1200
+    # Submit retries back off exponentially from the base delay, up to the max delay (in seconds)
+    submit_retry_base_delay = 1
+    submit_retry_max_delay = 60
+    # Which kind of job this is, in the timelines and metrics. Set by the extending class
+    worker_type = None
 
     def __init__(self, mm, bd, pop):
         self.model_manager = mm
-        self.bridge_data = copy.deepcopy(bd)
+        # A read-only snapshot, shared with the other jobs and poppers
+        self.bridge_data = bd
         self.pop = pop
         self.loop_retry = 0
         self.status = JobStatus.INIT
@@ -28,6 +38,9 @@ class HordeJobFramework:
         self.stale_time = None
         self.submit_dict = {}
         self.headers = {"apikey": self.bridge_data.api_key}
+        # How many bytes we had to copy in memory to upload and submit our results
+        self.upload_bytes_copied = 0
+        self.timeline = JobTimeline(self.worker_type)
 
     def is_finished(self):
         """Check if the job is finished"""
@@ -43,7 +56,7 @@ class HordeJobFramework:
 
     def is_stale(self):
         """Check if the job is stale"""
-        if time.time() - self.start_time > 1200:
+        if time.time() - self.start_time > self.max_job_lifetime:
             return True
         if not self.stale_time:
             return False
@@ -52,6 +65,14 @@ class HordeJobFramework:
             return False
         return time.time() > self.stale_time
 
+    def get_stale_deadline(self):
+        """Returns the time at which this job should next be checked for staleness.
+        Until the job has started working, we don't know its stale time, so it's rechecked every second"""
+        deadline = self.start_time + self.max_job_lifetime
+        if self.stale_time and self.status == JobStatus.WORKING:
+            return min(deadline, self.stale_time)
+        return min(deadline, time.time() + 1)
+
     def is_faulted(self):
         """Check if the job is faulted"""
         return self.status in [JobStatus.FAULTED, JobStatus.FINALIZING_FAULTED, JobStatus.OUT_OF_MEMORY]
@@ -60,11 +81,29 @@ class HordeJobFramework:
         """Check if the job ran out of memory"""
         return self.status in [JobStatus.OUT_OF_MEMORY]
 
+    def get_log_context(self):
+        """The fields of the job added to the structured log records"""
+        return {
+            "job_id": getattr(self, "current_id", None),
+            "worker": self.worker_type,
+            "model": getattr(self, "current_model", None),
+        }
+
+    def run_job(self):
+        """Runs start_job() with the job's fields in the context of the log records"""
+        with logger.contextualize(**self.get_log_context()):
+            try:
+                self.start_job()
+            finally:
+                # The job threads are reused for the next jobs
+                log_stage.set(None)
+
     @logger.catch(reraise=True)
     def start_job(self):
         """Starts a job from a pop request
         This method MUST be extended with the specific logic for this worker
         At the end it MUST create a new thread to submit the results to the horde"""
+        self.timeline.record("queued", self.timeline.created, time.monotonic())
         # Pop new request from the Horde
         if self.pop is None:
             self.pop = self.get_job_from_server()
@@ -79,16 +118,22 @@ class HordeJobFramework:
             return
         self.process_time = time.time()
         self.status = JobStatus.WORKING
+        self.timeline.begin("prepare")
         # Continue with the specific worker logic from here
         # At the end, you must call self.start_submit_thread()
 
     def start_submit_thread(self):
-        """Starts a thread with submit_job so that we don't wait for the upload to complete
-        # Not a daemon, so that it can survive after this class is garbage collected"""
-        submit_thread = threading.Thread(target=self.submit_job, args=())
-        submit_thread.start()
+        """Queues submit_job on the shared submit pool, so that we don't wait for the upload to complete"""
+        self.timeline.end()
+        job_submitter.submit(self)
         logger.debug("Finished job in threadpool")
 
+    def get_submit_retry_delay(self):
+        """Returns how long to wait before the next submit attempt.
+        Exponential backoff with jitter, so that workers don't all retry in lockstep after a horde outage"""
+        delay = min(self.submit_retry_max_delay, self.submit_retry_base_delay * 2 ** max(self.loop_retry - 1, 0))
+        return random.uniform(delay / 2, delay)
+
     def submit_job(self, endpoint):
         """Submits the job to the server to earn our kudos.
         This method MUST be extended with the specific logic for this worker
@@ -104,6 +149,12 @@ class HordeJobFramework:
         else:
             self.status = JobStatus.FINALIZING
             self.prepare_submit_payload()
+        self.timeline.begin("submit")
+        # Serialized only once, and reused on every retry
+        submit_payload = self.serialize_submit_payload()
+        self.upload_bytes_copied += len(submit_payload)
+        logger.debug(f"posting payload with size of {round(len(submit_payload) / 1024, 1)} kb")
+        headers = {**self.headers, "Content-Type": "application/json"}
         # Submit back to horde
         while self.is_finalizing():
             if self.loop_retry > 10:
@@ -112,13 +163,10 @@ class HordeJobFramework:
                 break
             self.loop_retry += 1
             try:
-                logger.debug(
-                    f"posting payload with size of {round(sys.getsizeof(json.dumps(self.submit_dict)) / 1024,1)} kb",
-                )
-                submit_req = requests.post(
+                submit_req = http_session.post(
                     self.bridge_data.horde_url + endpoint,
-                    json=self.submit_dict,
-                    headers=self.headers,
+                    data=submit_payload,
+                    headers=headers,
                     timeout=60,
                 )
                 logger.debug(f"Upload completed in {submit_req.elapsed.total_seconds()}")
@@ -129,7 +177,7 @@ class HordeJobFramework:
                         f"Something has gone wrong with {self.bridge_data.horde_url} during submit. "
                         f"Please inform its administrator!  (Retry {self.loop_retry}/10)",
                     )
-                    time.sleep(self.retry_interval)
+                    time.sleep(self.get_submit_retry_delay())
                     continue
                 if submit_req.status_code == 404:
                     logger.warning("The job we were working on got stale. Aborting!")
@@ -146,16 +194,18 @@ class HordeJobFramework:
                         )
                         self.status = JobStatus.FAULTED
                         break
+                    retry_delay = self.get_submit_retry_delay()
                     logger.warning(
                         f"During gen submit, server {self.bridge_data.horde_url} "
                         f"responded with status code {submit_req.status_code}: "
-                        f"{submit['message']}. Waiting for 2 seconds...  (Retry {self.loop_retry}/10)",
+                        f"{submit['message']}. Waiting for {retry_delay:.1f} seconds...  (Retry {self.loop_retry}/10)",
                     )
                     if "errors" in submit:
                         logger.warning(f"Detailed Request Errors: {submit['errors']}")
-                    time.sleep(2)
+                    time.sleep(retry_delay)
                     continue
                 reward = submit_req.json()["reward"]
+                self.timeline.attributes["kudos"] = reward
                 time_spent_processing = round(time.time() - self.process_time, 1)
 
                 with contextlib.suppress(ValueError):
@@ -172,6 +222,7 @@ class HordeJobFramework:
                     f"and {time_spent_processing} since start.",
                 )
 
+                bridge_stats.update_upload_stats(self.upload_bytes_copied)
                 self.post_submit_tasks(submit_req)
                 if self.status == JobStatus.FINALIZING_FAULTED:
                     self.status = JobStatus.FAULTED
@@ -179,24 +230,37 @@ class HordeJobFramework:
                     self.status = JobStatus.DONE
                 break
             except requests.exceptions.ConnectionError:
+                retry_delay = self.get_submit_retry_delay()
                 logger.warning(
                     f"Server {self.bridge_data.horde_url} unavailable during submit. "
-                    f"Waiting 10 seconds...  (Retry {self.loop_retry}/10)",
+                    f"Waiting {retry_delay:.1f} seconds...  (Retry {self.loop_retry}/10)",
                 )
-                time.sleep(10)
+                time.sleep(retry_delay)
                 continue
             except requests.exceptions.ReadTimeout:
+                retry_delay = self.get_submit_retry_delay()
                 logger.warning(
                     f"Server {self.bridge_data.horde_url} timed out during submit. "
-                    f"Waiting 10 seconds...  (Retry {self.loop_retry}/10)",
+                    f"Waiting {retry_delay:.1f} seconds...  (Retry {self.loop_retry}/10)",
                 )
-                time.sleep(10)
+                time.sleep(retry_delay)
                 continue
 
+    def finish_timeline(self):
+        """Hands the job's timeline over to the tracer, once the job is submitted or given up on"""
+        self.timeline.attributes["id"] = getattr(self, "current_id", None)
+        self.timeline.attributes["status"] = self.status.name
+        with logger.contextualize(**self.get_log_context()):
+            job_tracer.finish(self.timeline)
+
     def prepare_submit_payload(self):
         """Should be overriden and prepare a self.submit_dict dictionary with the payload needed
         for this job to be submitted"""
         self.submit_dict = {}
 
+    def serialize_submit_payload(self):
+        """Returns the JSON bytes to submit. Can be overriden to serialize large payloads more efficiently"""
+        return json.dumps(self.submit_dict).encode("utf-8")
+
     def post_submit_tasks(self, submit_req):
         """Optional job which will execute only if the submit is successfull"""
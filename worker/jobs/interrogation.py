@@ -3,21 +3,24 @@ import time
 import traceback
 from io import BytesIO
 
-import requests
 from hordelib.blip.caption import Caption
 from hordelib.clip.interrogate import Interrogator
-from hordelib.safety_checker import is_image_nsfw
 
 from worker.consts import KNOWN_POST_PROCESSORS, KNOWN_UPSCALERS
 from worker.enums import JobStatus
+from worker.inference import inference
 from worker.jobs.framework import HordeJobFramework
 from worker.logger import logger
+from worker.metrics import metrics
 from worker.post_process import post_process
+from worker.sessions import http_session
 
 
 class InterrogationHordeJob(HordeJobFramework):
     """Get and process an image interrogation job from the horde"""
 
+    worker_type = "alchemy"
+
     def __init__(self, mm, bd, pop):
         super().__init__(mm, bd, pop)
         self.current_form = self.pop["form"]
@@ -25,6 +28,7 @@ class InterrogationHordeJob(HordeJobFramework):
         self.current_payload = self.pop.get("payload", {})
         self.image = self.pop["image"]
         self.r2_upload = self.pop.get("r2_upload", False)
+        self.timeline.attributes["form"] = self.current_form
         # We allow a generation a plentiful 10 seconds per form before we consider it stale
         self.result = None
 
@@ -42,8 +46,10 @@ class InterrogationHordeJob(HordeJobFramework):
         interrogator = None
         payload_kwargs = {}
         logger.info(f"Starting {self.current_form} alchemy {self.current_id}")
+        start_time = time.time()
+        self.timeline.begin("inference")
         if self.current_form == "nsfw":
-            self.result = is_image_nsfw(self.image)
+            self.result = inference.is_image_nsfw(self.image)
         elif self.current_form in KNOWN_POST_PROCESSORS:
             try:
                 strength = self.current_payload.get("facefixer_strength", 0.5)
@@ -101,6 +107,12 @@ class InterrogationHordeJob(HordeJobFramework):
                 self.status = JobStatus.FAULTED
                 self.start_submit_thread()
                 return
+        metrics.observe(
+            "horde_worker_inference_seconds",
+            time.time() - start_time,
+            worker="alchemy",
+            form=self.current_form,
+        )
         logger.info(f"Finished alchemy {self.current_id}")
         interrogator = None
         self.start_submit_thread()
@@ -122,9 +134,11 @@ class InterrogationHordeJob(HordeJobFramework):
             logger.debug(self.r2_upload)
             buffer = BytesIO()
             # We send as WebP to avoid using all the horde bandwidth
+            self.timeline.begin("encode")
             self.image.save(buffer, format="WebP", quality=95, method=6)
+            self.timeline.begin("upload")
             if self.r2_upload:
-                put_response = requests.put(self.r2_upload, data=buffer.getvalue())
+                put_response = http_session.put(self.r2_upload, data=buffer.getvalue())
                 logger.debug("R2 Upload response: {}", put_response)
             self.submit_dict["result"] = {self.current_form: self.result}
         logger.debug([self.current_form in KNOWN_POST_PROCESSORS, self.current_form, KNOWN_POST_PROCESSORS])
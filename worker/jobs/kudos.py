@@ -1,7 +1,7 @@
 import pickle
 import sys
 
-import torch
+import numpy as np
 
 
 class KudosModel:
@@ -90,17 +90,37 @@ class KudosModel:
         "txt2img",
     ]
 
-    def __init__(self, model_filename=None):
+    # The floats at the start of the features, and what each is divided by
+    FLOAT_FEATURE_SCALES = [1024, 1024, 100, 30, 1, 1, 1, 1, 1, 1]
+
+    # How many predicted times are memoized, per payload key
+    TIME_CACHE_SIZE = 100_000
+
+    # Known value -> its column in the features. Built once the known values are sorted
+    SAMPLER_COLUMNS = None
+    CONTROL_TYPE_COLUMNS = None
+    SOURCE_PROCESSING_COLUMNS = None
+    POST_PROCESSOR_COLUMNS = None
+    FEATURE_COUNT = None
+
+    def __init__(self, model_filename=None, backend="torch"):
         # Our basis time
         self.time_basis = 0
         # Our model
         self.model = None
+        # The (weight, bias, relu) of each linear layer of the model, to evaluate it with numpy
+        self.layers = None
+        # "torch" runs the model itself, "numpy" runs the layers above
+        self.backend = backend
+        # Payload key -> predicted time
+        self.time_cache = {}
 
         # Avoid any terrible mistakes in one hot encoding
         KudosModel.KNOWN_POST_PROCESSORS.sort()
         KudosModel.KNOWN_SAMPLERS.sort()
         KudosModel.KNOWN_CONTROL_TYPES.sort()
         KudosModel.KNOWN_SOURCE_PROCESSING.sort()
+        KudosModel.build_feature_columns()
 
         # Load the model if required
         if model_filename:
@@ -108,7 +128,7 @@ class KudosModel:
 
     # Payload to kudos
     def calculate_kudos(self, payload, basis_adjustment=0, basis_scale=1):
-        if not self.model:
+        if not self.model and not self.layers:
             raise Exception("No kudos model loaded")
 
         if not self.time_basis:
@@ -133,74 +153,164 @@ class KudosModel:
         # Scale our kudos by the time the job will take to complete
         return job_ratio * kudos
 
+    # Payloads to kudos, predicting the time of each distinct payload only once
+    def calculate_kudos_batch(self, payloads, basis_adjustment=0, basis_scale=1):
+        if not self.model and not self.layers:
+            raise Exception("No kudos model loaded")
+
+        if not self.time_basis:
+            raise Exception("Kudos model failed to calculate basis time.")
+
+        job_times = self.payloads_to_times(payloads)
+        kudos = (KudosModel.KUDOS_BASIS + basis_adjustment) * basis_scale
+        return [job_time / self.time_basis * kudos for job_time in job_times]
+
     @classmethod
-    def one_hot_encode(cls, strings, unique_strings):
-        one_hot = torch.zeros(len(strings), len(unique_strings))
-        for i, string in enumerate(strings):
-            one_hot[i, unique_strings.index(string)] = 1
-        return one_hot
+    def build_feature_columns(cls):
+        column = len(cls.FLOAT_FEATURE_SCALES)
+        for attribute, known_values in (
+            ("SAMPLER_COLUMNS", cls.KNOWN_SAMPLERS),
+            ("CONTROL_TYPE_COLUMNS", cls.KNOWN_CONTROL_TYPES),
+            ("SOURCE_PROCESSING_COLUMNS", cls.KNOWN_SOURCE_PROCESSING),
+            ("POST_PROCESSOR_COLUMNS", cls.KNOWN_POST_PROCESSORS),
+        ):
+            setattr(cls, attribute, {value: column + index for index, value in enumerate(known_values)})
+            column += len(known_values)
+        cls.FEATURE_COUNT = column
 
     @classmethod
-    def one_hot_encode_combined(cls, strings, unique_strings):
-        one_hot = torch.zeros(len(strings), len(unique_strings))
-        for i, string in enumerate(strings):
-            one_hot[i, unique_strings.index(string)] = 1
+    def payload_key(cls, payload):
+        """What the features of a payload are made of. Payloads with the same key take the same time"""
+        return (
+            payload["height"],
+            payload["width"],
+            payload["ddim_steps"],
+            payload["cfg_scale"],
+            payload.get("denoising_strength", 1.0),
+            payload.get("control_strength", payload.get("denoising_strength", 1.0)),
+            1.0 if payload["karras"] else 0.0,
+            1.0 if payload.get("hires_fix", False) else 0.0,
+            1.0 if payload.get("source_image", False) else 0.0,
+            1.0 if payload.get("source_mask", False) else 0.0,
+            payload["sampler_name"] if payload["sampler_name"] in cls.SAMPLER_COLUMNS else "k_euler",
+            payload.get("control_type", "None"),
+            payload.get("source_processing", "txt2img"),
+            tuple(payload.get("post_processing", [])),
+        )
 
-        return torch.sum(one_hot, dim=0, keepdim=True)
+    @classmethod
+    def keys_to_features(cls, keys):
+        """Fills one feature matrix for all the payload keys, with a row per key"""
+        float_count = len(cls.FLOAT_FEATURE_SCALES)
+        features = np.zeros((len(keys), cls.FEATURE_COUNT), dtype=np.float32)
+        # Divided as doubles, like the python floats the model was trained on
+        features[:, :float_count] = np.array([key[:float_count] for key in keys], dtype=np.float64) / np.array(
+            cls.FLOAT_FEATURE_SCALES,
+            dtype=np.float64,
+        )
+        rows = []
+        columns = []
+        for row, key in enumerate(keys):
+            rows.extend((row, row, row))
+            columns.extend(
+                (
+                    cls.SAMPLER_COLUMNS[key[10]],
+                    cls.CONTROL_TYPE_COLUMNS[key[11]],
+                    cls.SOURCE_PROCESSING_COLUMNS[key[12]],
+                ),
+            )
+            for post_processor in key[13]:
+                rows.append(row)
+                columns.append(cls.POST_PROCESSOR_COLUMNS[post_processor])
+        # Post processors used more than once are counted as many times
+        np.add.at(features, (rows, columns), 1)
+        return features
 
     @classmethod
     def payload_to_tensor(cls, payload):
-        data = []
-        data_samplers = []
-        data_control_types = []
-        data_source_processing_types = []
-        data_post_processors = []
-        data.append(
-            [
-                payload["height"] / 1024,
-                payload["width"] / 1024,
-                payload["ddim_steps"] / 100,
-                payload["cfg_scale"] / 30,
-                payload.get("denoising_strength", 1.0),
-                payload.get("control_strength", payload.get("denoising_strength", 1.0)),
-                1.0 if payload["karras"] else 0.0,
-                1.0 if payload.get("hires_fix", False) else 0.0,
-                1.0 if payload.get("source_image", False) else 0.0,
-                1.0 if payload.get("source_mask", False) else 0.0,
-            ],
-        )
-        data_samplers.append(
-            payload["sampler_name"] if payload["sampler_name"] in KudosModel.KNOWN_SAMPLERS else "k_euler",
-        )
-        data_control_types.append(payload.get("control_type", "None"))
-        data_source_processing_types.append(payload.get("source_processing", "txt2img"))
-        data_post_processors = payload.get("post_processing", [])[:]
-
-        _data_floats = torch.tensor(data).float()
-        _data_samplers = cls.one_hot_encode(data_samplers, KudosModel.KNOWN_SAMPLERS)
-        _data_control_types = cls.one_hot_encode(data_control_types, KudosModel.KNOWN_CONTROL_TYPES)
-        _data_source_processing_types = cls.one_hot_encode(
-            data_source_processing_types,
-            KudosModel.KNOWN_SOURCE_PROCESSING,
-        )
-        _data_post_processors = cls.one_hot_encode_combined(data_post_processors, KudosModel.KNOWN_POST_PROCESSORS)
-        return torch.cat(
-            (_data_floats, _data_samplers, _data_control_types, _data_source_processing_types, _data_post_processors),
-            dim=1,
-        )
+        import torch
+
+        return torch.from_numpy(cls.keys_to_features([cls.payload_key(payload)]))
 
     def load_model(self, model_filename):
+        if model_filename.endswith(".npz"):
+            return self.load_weights(model_filename)
         with open(model_filename, "rb") as infile:
             self.model = pickle.load(infile)
+        self.layers = self.extract_layers(self.model)
+        self.time_cache = {}
         self.calculate_basis_time()
         return self.model
 
+    def load_weights(self, weights_filename):
+        """Loads the weights written by save_weights, and runs them with numpy"""
+        with np.load(weights_filename, allow_pickle=False) as weights:
+            self.layers = [
+                (weights[f"weight_{index}"], weights[f"bias_{index}"], bool(relu))
+                for index, relu in enumerate(weights["relu"])
+            ]
+        if self.layers[0][0].shape[0] != KudosModel.FEATURE_COUNT:
+            raise Exception(
+                f"Kudos weights expect {self.layers[0][0].shape[0]} features, not {KudosModel.FEATURE_COUNT}",
+            )
+        self.model = None
+        self.backend = "numpy"
+        self.time_cache = {}
+        self.calculate_basis_time()
+        return self.layers
+
+    def save_weights(self, weights_filename):
+        """Saves the weights of the linear layers, which is all it takes to run the model"""
+        weights = {"relu": np.array([relu for _, _, relu in self.layers])}
+        for index, (weight, bias, _) in enumerate(self.layers):
+            weights[f"weight_{index}"] = weight
+            weights[f"bias_{index}"] = bias
+        np.savez(weights_filename, **weights)
+
+    @classmethod
+    def extract_layers(cls, model):
+        import torch
+
+        layers = []
+        for module in model:
+            if isinstance(module, torch.nn.Linear):
+                weight = module.weight.detach().numpy().T.copy()
+                layers.append((weight, module.bias.detach().numpy().copy(), False))
+            elif isinstance(module, torch.nn.ReLU):
+                weight, bias, _ = layers[-1]
+                layers[-1] = (weight, bias, True)
+            # Dropout does nothing outside of training
+            elif not isinstance(module, torch.nn.Dropout):
+                raise Exception(f"Unsupported layer in the kudos model: {module}")
+        return layers
+
+    def features_to_times(self, features):
+        """Runs the model once on all the rows of the features"""
+        if self.backend == "numpy":
+            outputs = features
+            for weight, bias, relu in self.layers:
+                outputs = outputs @ weight + bias
+                if relu:
+                    np.maximum(outputs, 0, out=outputs)
+        else:
+            import torch
+
+            with torch.no_grad():
+                outputs = self.model(torch.from_numpy(features)).numpy()
+        return [round(output, 2) for output in outputs[:, 0].tolist()]
+
+    def payloads_to_times(self, payloads):
+        keys = [self.payload_key(payload) for payload in payloads]
+        missing_keys = list(dict.fromkeys(key for key in keys if key not in self.time_cache))
+        if missing_keys:
+            if len(self.time_cache) + len(missing_keys) > self.TIME_CACHE_SIZE:
+                self.time_cache = {key: self.time_cache[key] for key in set(keys) if key in self.time_cache}
+            self.time_cache.update(zip(missing_keys, self.features_to_times(self.keys_to_features(missing_keys))))
+        return [self.time_cache[key] for key in keys]
+
     # Pass in a horde payload, get back a predicted time in seconds
     def payload_to_time(self, payload):
-        inputs = self.payload_to_tensor(payload).squeeze()
-        with torch.no_grad():
-            output = self.model(inputs)
-        return round(float(output.item()), 2)
+        return self.payloads_to_times([payload])[0]
 
     # Determine how long the basic job that costs KUDOS_BASIS kudos takes to run
     def calculate_basis_time(self):
@@ -208,11 +318,17 @@ class KudosModel:
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Syntax: kudos.py <model_filename>")
+    if len(sys.argv) not in [2, 3]:
+        print("Syntax: kudos.py <model_filename> [<weights_filename.npz>]")
 
     kudos_model = KudosModel(sys.argv[1])
 
+    # Convert the model to its weights alone
+    if len(sys.argv) == 3:
+        kudos_model.save_weights(sys.argv[2])
+        print(f"Saved the weights to {sys.argv[2]}")
+        kudos_model = KudosModel(sys.argv[2])
+
     print(f"Kudos basis is {kudos_model.KUDOS_BASIS}")
     print(f"Time basis is {kudos_model.time_basis} seconds")
 
@@ -1,14 +1,13 @@
-import base64
-import copy
 import json
 import time
-from io import BytesIO
 
 import requests
-from PIL import Image, UnidentifiedImageError
 
 from worker.consts import BRIDGE_VERSION, KNOWN_INTERROGATORS, KNOWN_POST_PROCESSORS, POST_PROCESSORS_HORDELIB_MODELS
+from worker.jobs.downloader import image_downloader
 from worker.logger import logger
+from worker.metrics import metrics
+from worker.sessions import http_session
 from worker.stats import bridge_stats
 
 
@@ -18,37 +17,49 @@ class JobPopper:
 
     def __init__(self, mm, bd):
         self.model_manager = mm
-        self.bridge_data = copy.deepcopy(bd)
+        # A read-only snapshot, shared with the other jobs and poppers
+        self.bridge_data = bd
         self.pop = None
         self.headers = {"apikey": self.bridge_data.api_key}
         # This should be set by the extending class
         self.endpoint = None
+        # (stage, start, end) of the pop, and of the downloads of its source images, for the jobs' timelines
+        self.stages = []
 
     def horde_pop(self):
         """Get a job from the horde"""
         try:
             # logger.debug(self.headers)
             # logger.debug(self.pop_payload)
-            pop_req = requests.post(
+            pop_start = time.monotonic()
+            pop_req = http_session.post(
                 self.bridge_data.horde_url + self.endpoint,
                 json=self.pop_payload,
                 headers=self.headers,
                 timeout=40,
             )
             # logger.debug(self.pop_payload)
+            self.stages.append(("pop", pop_start, time.monotonic()))
             node = pop_req.headers.get("horde-node", "unknown")
             logger.debug(f"Job pop took {pop_req.elapsed.total_seconds()} (node: {node})")
             bridge_stats.update_pop_stats(node, pop_req.elapsed.total_seconds())
+            metrics.observe("horde_worker_pop_seconds", pop_req.elapsed.total_seconds())
         except requests.exceptions.ConnectionError:
-            logger.warning(f"Server {self.bridge_data.horde_url} unavailable during pop. Waiting 10 seconds...")
+            logger.bind(rate_limit="pop_failed").warning(
+                f"Server {self.bridge_data.horde_url} unavailable during pop. Waiting 10 seconds...",
+            )
             time.sleep(10)
             return None
         except TypeError:
-            logger.warning(f"Server {self.bridge_data.horde_url} unavailable during pop. Waiting 2 seconds...")
+            logger.bind(rate_limit="pop_failed").warning(
+                f"Server {self.bridge_data.horde_url} unavailable during pop. Waiting 2 seconds...",
+            )
             time.sleep(2)
             return None
         except requests.exceptions.ReadTimeout:
-            logger.warning(f"Server {self.bridge_data.horde_url} timed out during pop. Waiting 2 seconds...")
+            logger.bind(rate_limit="pop_failed").warning(
+                f"Server {self.bridge_data.horde_url} timed out during pop. Waiting 2 seconds...",
+            )
             time.sleep(2)
             return None
         except requests.exceptions.InvalidHeader:
@@ -69,7 +80,7 @@ class JobPopper:
             time.sleep(2)
             return None
         if not pop_req.ok:
-            logger.warning(f"{self.pop['message']} ({pop_req.status_code})")
+            logger.bind(rate_limit="pop_failed").warning(f"{self.pop['message']} ({pop_req.status_code})")
             if "errors" in self.pop:
                 logger.warning(f"Detailed Request Errors: {self.pop['errors']}")
             time.sleep(2)
@@ -82,50 +93,11 @@ class JobPopper:
             self.skipped_info = f" Skipped Info: {job_skipped_info}."
         else:
             self.skipped_info = ""
-        logger.info(f"Server {self.bridge_data.horde_url} has no valid generations for us to do.{self.skipped_info}")
+        logger.bind(rate_limit="no_jobs").info(
+            f"Server {self.bridge_data.horde_url} has no valid generations for us to do.{self.skipped_info}",
+        )
         time.sleep(self.retry_interval)
 
-    def download_image_data(self, image_url):
-        """Returns the image data, not a PIL"""
-        img_data = None
-        try:
-            with requests.get(image_url, stream=True, timeout=2) as r:
-                size = r.headers.get("Content-Length", 0)
-                if int(size) > 5120000:
-                    logger.error(f"Provided image ({image_url}) cannot be larger than 5Mb")
-                    return None
-                mbs = 0
-                for chunk in r.iter_content(chunk_size=1024 * 1024):
-                    if chunk:
-                        if mbs == 0:
-                            img_data = chunk
-                        else:
-                            img_data += chunk
-                        mbs += 1
-                        if mbs > 5:
-                            logger.error(f"Provided image ({image_url}) cannot be larger than 5Mb")
-                            return None
-        except Exception as err:
-            logger.error(err)
-            return None
-        if not img_data:
-            logger.error(f"Could not download source image from R2 {image_url}. Skipping source image.")
-        return img_data
-
-    def convert_image_data_to_pil(self, img_data):
-        try:
-            img = Image.open(BytesIO(img_data))
-            if len(img.split()) == 4:
-                return img.convert("RGBA")
-
-            return img.convert("RGB")
-        except UnidentifiedImageError as e:
-            logger.error(f"Error when creating image: {e}.")
-            return None
-        except UnboundLocalError as e:
-            logger.error(f"Error when creating image: {e}.")
-            return None
-
 
 class StableDiffusionPopper(JobPopper):
     def __init__(self, mm, bd):
@@ -173,31 +145,18 @@ class StableDiffusionPopper(JobPopper):
             self.report_skipped_info()
             return None
         # In the stable diffusion popper, the whole return is always a single payload, so we return it as a list
-        self.pop["source_image"] = self.download_source(self.pop.get("source_image"))
-        self.pop["source_mask"] = self.download_source(self.pop.get("source_mask"))
+        # The source image and its mask are downloaded and decoded in parallel, no smaller than the generation
+        payload = self.pop.get("payload", {})
+        size = (payload["width"], payload["height"]) if "width" in payload and "height" in payload else None
+        download_start = time.monotonic()
+        self.pop["source_image"], self.pop["source_mask"] = image_downloader.fetch_all(
+            (self.pop.get("source_image"), self.pop.get("source_mask")),
+            size,
+        )
+        self.stages.append(("download", download_start, time.monotonic()))
         # logger.debug("Cron: End job pop")
         return [self.pop]
 
-    def download_source(self, source_img):
-        if not source_img:
-            return None
-        if "https" in source_img:
-            if img_data := self.download_image_data(source_img):
-                img = self.convert_image_data_to_pil(img_data)
-                if not img:
-                    logger.error("Non-image data when downloading image! Ignoring")
-                return img
-
-            logger.warning(f"Could not download source image from R2 {source_img}. Skipping source image.")
-            return None
-        try:
-            base64_bytes = source_img.encode("utf-8")
-            img_bytes = base64.b64decode(base64_bytes)
-        except Exception as err:
-            logger.warning(f"Could not decode source image from base 64  with error: '{err}'. Skipping source image.")
-            return None
-        return Image.open(BytesIO(img_bytes))
-
 
 class ScribePopper(JobPopper):
     def __init__(self, mm, bd):
@@ -264,48 +223,18 @@ class InterrogationPopper(JobPopper):
             self.report_skipped_info()
             return None
         # In the interrogation popper, the forms key contains an array of payloads to execute
-        current_image_url = None
+        # Their images are downloaded concurrently, and those shared by several forms only once.
+        # They're not reduced, as the post-processors work on the full image
+        download_start = time.monotonic()
+        images = image_downloader.fetch_all([form["source_image"] for form in self.pop["forms"]])
         non_faulted_forms = []
-        for form in self.pop["forms"]:
-            # TODO: Convert to use self.download_image_data and self.convert_image_data_to_pil
-            if form["source_image"] != current_image_url:
-                current_image_url = form["source_image"]
-                try:
-                    with requests.get(current_image_url, stream=True, timeout=2) as r:
-                        size = r.headers.get("Content-Length", 0)
-                        if int(size) > 5120000:
-                            logger.error(f"Provided image ({current_image_url}) cannot be larger than 5Mb")
-                            current_image_url = None
-                            continue
-                        mbs = 0
-                        for chunk in r.iter_content(chunk_size=1024 * 1024):
-                            if chunk:
-                                if mbs == 0:
-                                    img_data = chunk
-                                else:
-                                    img_data += chunk
-                                mbs += 1
-                                if mbs > 5:
-                                    logger.error(f"Provided image ({current_image_url}) cannot be larger than 5Mb")
-                                    current_image_url = None
-                                    continue
-                except Exception as err:
-                    logger.error(err)
-                    current_image_url = None
-                    continue
-            try:
-                img = Image.open(BytesIO(img_data))
-                if len(img.split()) == 4:
-                    form["image"] = img.convert("RGBA")
-                else:
-                    form["image"] = img.convert("RGB")
-                non_faulted_forms.append(form)
-            except UnidentifiedImageError as e:
-                logger.error(f"Error when creating image: {e}. Url {current_image_url}")
-                continue
-            except UnboundLocalError as e:
-                logger.error(f"Error when creating image: {e}. Url {current_image_url}")
+        for form, image in zip(self.pop["forms"], images):
+            if image is None:
+                logger.error(f"Could not get the image of the form. Url {form['source_image']}")
                 continue
+            form["image"] = image
+            non_faulted_forms.append(form)
+        self.stages.append(("download", download_start, time.monotonic()))
         logger.debug(f"Popped {len(non_faulted_forms)} interrogation forms")
         # TODO: Report back to the horde with faulted images
         return non_faulted_forms
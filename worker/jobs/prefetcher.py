@@ -0,0 +1,112 @@
+"""Pops jobs from the horde ahead of time, so that the main loop never waits on an HTTP round-trip"""
+import threading
+import time
+from collections import deque
+
+from worker.logger import logger
+
+
+class JobPrefetcher:
+    """Runs the job popper in background threads and keeps a bounded amount of fully materialized jobs
+    (source images downloaded and decoded) ready for the worker to start.
+
+    The worker tells us how many jobs it can take through get_job_demand(), which is derived from
+    max_threads and queue_size, so we never hold (or have in flight) more jobs than the worker could
+    have popped itself. Up to max_threads pops can be in flight at the same time, so that a slow horde
+    round-trip doesn't hold back the pops for the other threads, and resize() follows max_threads on reload.
+    On stop, the jobs we already popped are handed back to the worker's queue, as the horde counts them as ours.
+    """
+
+    # Safety net, in case a demand change notification is missed
+    max_idle_wait = 1
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.ready_jobs = deque()
+        self.pops_in_flight = 0
+        self.should_stop = False
+        self.condition = threading.Condition()
+        # Thread id -> thread. The threads with an id of thread_count or more retire after their current pop
+        self.threads = {}
+        self.thread_count = 0
+
+    def start(self):
+        self.should_stop = False
+        self.resize()
+
+    def resize(self):
+        """Starts or retires threads, so that there are as many as the worker's max_threads"""
+        with self.condition:
+            self.thread_count = max(self.worker.bridge_data.max_threads, 1)
+            for thread_id in range(self.thread_count):
+                if thread_id not in self.threads:
+                    thread = threading.Thread(
+                        target=self.run,
+                        args=(thread_id,),
+                        name=f"JobPrefetcher-{thread_id}",
+                        daemon=True,
+                    )
+                    self.threads[thread_id] = thread
+                    thread.start()
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.should_stop = True
+            self.condition.notify_all()
+        self.hand_back(self.take_jobs())
+
+    def hand_back(self, jobs):
+        """Queues jobs on the worker directly, once we've stopped"""
+        if jobs:
+            logger.debug(f"Handing {len(jobs)} prefetched job(s) back to the worker")
+            self.worker.waiting_jobs.extend(jobs)
+            self.worker.wake()
+
+    def notify(self):
+        """Tells the prefetcher that the demand for jobs might have changed. Safe to call from any thread."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def get_demand(self):
+        return self.worker.get_job_demand() - len(self.ready_jobs) - self.pops_in_flight
+
+    def take_jobs(self):
+        """Returns all the jobs which are ready to start, in the order they were popped"""
+        with self.condition:
+            jobs = list(self.ready_jobs)
+            self.ready_jobs.clear()
+        return jobs
+
+    def is_retired(self, thread_id):
+        return self.should_stop or thread_id >= self.thread_count
+
+    def run(self, thread_id):
+        while True:
+            with self.condition:
+                while not self.is_retired(thread_id) and self.get_demand() <= 0:
+                    self.condition.wait(self.max_idle_wait)
+                if self.is_retired(thread_id):
+                    # Under the lock, so that resize() starts a new thread for this id if it needs it again
+                    del self.threads[thread_id]
+                    break
+                self.pops_in_flight += 1
+            jobs = None
+            try:
+                pop_start = time.monotonic()
+                jobs = self.worker.pop_job()
+            # pylint: disable=broad-except
+            except Exception as err:
+                logger.error(f"Failed to prefetch a job from the horde: {err}")
+                time.sleep(self.worker.PopperClass.retry_interval)
+            with self.condition:
+                self.pops_in_flight -= 1
+                stopped = self.should_stop
+                if jobs and not stopped:
+                    self.ready_jobs.extend(jobs)
+                self.condition.notify_all()
+            if stopped:
+                self.hand_back(jobs)
+            elif jobs:
+                logger.debug(f"Prefetched {len(jobs)} job(s) in {round(time.monotonic() - pop_start, 2)} seconds")
+                self.worker.wake()
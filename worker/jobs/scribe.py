@@ -8,12 +8,16 @@ import requests
 from worker.enums import JobStatus
 from worker.jobs.framework import HordeJobFramework
 from worker.logger import logger
+from worker.metrics import metrics
+from worker.sessions import http_session
 from worker.stats import bridge_stats
 
 
 class ScribeHordeJob(HordeJobFramework):
     """Process a scribe job from the horde"""
 
+    worker_type = "scribe"
+
     def __init__(self, mm, bd, pop):
         # mm will always be None for the scribe
         super().__init__(mm, bd, pop)
@@ -21,6 +25,7 @@ class ScribeHordeJob(HordeJobFramework):
         self.seed = None
         self.text = None
         self.current_model = self.bridge_data.model
+        self.timeline.attributes["model"] = self.current_model
         self.current_id = self.pop["id"]
         self.current_payload = self.pop["payload"]
         self.current_payload["quiet"] = True
@@ -53,8 +58,9 @@ class ScribeHordeJob(HordeJobFramework):
                 f"Prompt length is {len(self.current_payload['prompt'])} characters",
             )
             time_state = time.time()
+            self.timeline.begin("inference")
             if self.requested_softprompt != self.bridge_data.current_softprompt:
-                requests.put(
+                http_session.put(
                     self.bridge_data.kai_url + "/api/latest/config/soft_prompt",
                     json={"value": self.requested_softprompt},
                 )
@@ -63,7 +69,7 @@ class ScribeHordeJob(HordeJobFramework):
             gen_success = False
             while not gen_success and loop_retry < 5:
                 try:
-                    gen_req = requests.post(
+                    gen_req = http_session.post(
                         self.bridge_data.kai_url + "/api/latest/generate",
                         json=self.current_payload,
                         timeout=self.max_seconds,
@@ -129,6 +135,7 @@ class ScribeHordeJob(HordeJobFramework):
                     continue
                 gen_success = True
             self.seed = 0
+            metrics.observe("horde_worker_inference_seconds", time.time() - time_state, worker="scribe")
             logger.info(
                 f"Generation for id {self.current_id} finished successfully"
                 f" in {round(time.time() - time_state,1)} seconds.",
@@ -0,0 +1,245 @@
+"""Caches the source images of the jobs, as the same ones are often sent with many jobs"""
+import contextlib
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from worker.logger import logger
+from worker.metrics import metrics
+
+metrics.describe("horde_worker_source_cache_total", "counter", "Source images fetched, by the cache tier which had it")
+metrics.describe("horde_worker_source_cache_bytes", "gauge", "Bytes held by the source image cache, per tier")
+
+
+class SourceCache:
+    """A cache of the source images, in two tiers, each evicting its least recently used entries past its size.
+
+    In memory, the decoded images are kept by the hash of their content and the size they were reduced to,
+    along with which url had which content, so that an url seen before doesn't need downloading again.
+    On disk, their downloaded bytes are kept by the hash of their content, along with which url had which
+    content, so that this still holds after a restart. Images sent as base64 are only kept in memory, as
+    decoding the base64 is cheap.
+
+    The cached images are shared by every job using them, so the jobs only ever get copies of them."""
+
+    def __init__(self):
+        self.max_memory = 256 * 1024 * 1024
+        # The disk tier is opt-in, as it keeps the images of the users on disk
+        self.max_disk = 0
+        self.directory = None
+        # (content hash, size) -> decoded image
+        self.images = OrderedDict()
+        self.memory_bytes = 0
+        # Url -> content hash, of the most recently used urls
+        self.max_urls = 4096
+        self.urls = OrderedDict()
+        # Url -> content hash, for the urls whose content is on disk
+        self.disk_urls = OrderedDict()
+        # File name -> bytes, of the files on disk, oldest used first. None until the directory is read
+        self.files = None
+        self.disk_bytes = 0
+        self._mutex = threading.Lock()
+
+    def configure(self, max_memory=None, max_disk=None, directory=None):
+        with self._mutex:
+            if max_memory is not None:
+                self.max_memory = max_memory
+                self.evict_memory()
+            if max_disk is not None:
+                self.max_disk = max_disk
+            if directory is not None and directory != self.directory:
+                self.directory = directory
+                self.disk_urls.clear()
+                self.files = None
+                self.disk_bytes = 0
+            if self.files is not None:
+                self.evict_disk()
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.configure(
+            max_memory=int(bridge_data.source_cache_size * 1024 * 1024),
+            max_disk=int(bridge_data.source_cache_disk_size * 1024 * 1024),
+            directory=bridge_data.source_cache_dir,
+        )
+
+    @staticmethod
+    def get_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def get_image_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def record(self, result):
+        metrics.increment("horde_worker_source_cache_total", result=result)
+
+    def get_image(self, content_hash, size=None):
+        """Returns a copy of the decoded image, or None"""
+        with self._mutex:
+            image = self.images.get((content_hash, size))
+            if image is None:
+                return None
+            self.images.move_to_end((content_hash, size))
+        return image.copy()
+
+    def put_image(self, content_hash, size, image):
+        """Caches the image, returning whether it was. The image must not be changed afterwards"""
+        image_bytes = self.get_image_bytes(image)
+        if image_bytes > self.max_memory:
+            return False
+        with self._mutex:
+            previous = self.images.pop((content_hash, size), None)
+            if previous is not None:
+                self.memory_bytes -= self.get_image_bytes(previous)
+            self.images[(content_hash, size)] = image
+            self.memory_bytes += image_bytes
+            self.evict_memory()
+        return True
+
+    def evict_memory(self):
+        while self.images and self.memory_bytes > self.max_memory:
+            _, image = self.images.popitem(last=False)
+            self.memory_bytes -= self.get_image_bytes(image)
+
+    def remember_url(self, url, content_hash):
+        """Must be called with the lock held"""
+        self.urls[url] = content_hash
+        self.urls.move_to_end(url)
+        while len(self.urls) > self.max_urls:
+            self.urls.popitem(last=False)
+
+    def put_url(self, url, content_hash):
+        """Remembers that the url had this content"""
+        with self._mutex:
+            self.remember_url(url, content_hash)
+
+    def is_disk_enabled(self):
+        return bool(self.directory) and self.max_disk > 0
+
+    def load_files(self):
+        """Reads what's already on disk, oldest used first. Must be called with the lock held"""
+        if self.files is not None:
+            return
+        self.files = OrderedDict()
+        self.disk_bytes = 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime)
+        except OSError as err:
+            logger.warning(f"Could not read the source image cache in {self.directory}: {err}")
+            return
+        for entry in entries:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                self.files[entry.name] = entry.stat().st_size
+                self.disk_bytes += entry.stat().st_size
+
+    def remove_file(self, name):
+        """Must be called with the lock held"""
+        self.disk_bytes -= self.files.pop(name, 0)
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(self.directory, name))
+
+    def evict_disk(self):
+        while self.files and self.disk_bytes > self.max_disk:
+            name = next(iter(self.files))
+            self.remove_file(name)
+            # The urls which had this content don't point to anything anymore
+            for url in [url for url, content_hash in self.disk_urls.items() if content_hash == name]:
+                del self.disk_urls[url]
+                self.remove_file(f"url-{self.get_hash(url.encode('utf-8'))}")
+
+    def get_url_hash(self, url):
+        """Returns the hash of the content of the url, if it was seen before"""
+        with self._mutex:
+            content_hash = self.urls.get(url)
+            if content_hash is not None:
+                self.urls.move_to_end(url)
+                return content_hash
+            if not self.is_disk_enabled():
+                return None
+            self.load_files()
+            content_hash = self.disk_urls.get(url)
+            if content_hash is not None:
+                self.remember_url(url, content_hash)
+                return content_hash
+            # Urls seen before the restart
+            url_file = f"url-{self.get_hash(url.encode('utf-8'))}"
+            if url_file not in self.files:
+                return None
+            try:
+                with open(os.path.join(self.directory, url_file), "rt", encoding="utf-8") as cached_url:
+                    content_hash = cached_url.read().strip()
+            except OSError:
+                return None
+            if content_hash not in self.files:
+                # Its content was evicted before the restart
+                self.remove_file(url_file)
+                return None
+            self.disk_urls[url] = content_hash
+            self.remember_url(url, content_hash)
+            return content_hash
+
+    def read(self, content_hash):
+        """Returns the downloaded bytes with this hash, or None"""
+        if not self.is_disk_enabled():
+            return None
+        with self._mutex:
+            self.load_files()
+            if content_hash not in self.files:
+                return None
+            self.files.move_to_end(content_hash)
+        filename = os.path.join(self.directory, content_hash)
+        try:
+            with open(filename, "rb") as cached_file:
+                data = cached_file.read()
+            os.utime(filename)
+        except OSError:
+            return None
+        if self.get_hash(data) != content_hash:
+            return None
+        return data
+
+    def write(self, url, content_hash, data):
+        """Keeps the downloaded bytes of the url on disk"""
+        if not self.is_disk_enabled() or len(data) > self.max_disk:
+            return
+        url_file = f"url-{self.get_hash(url.encode('utf-8'))}"
+        try:
+            with self._mutex:
+                self.load_files()
+                new_files = {}
+                if content_hash not in self.files:
+                    new_files[content_hash] = data
+                if url_file not in self.files:
+                    new_files[url_file] = content_hash.encode("utf-8")
+            for name, file_data in new_files.items():
+                temporary_file = os.path.join(self.directory, f"{name}.{threading.get_ident()}.tmp")
+                with open(temporary_file, "wb") as cached_file:
+                    cached_file.write(file_data)
+                os.replace(temporary_file, os.path.join(self.directory, name))
+        except OSError as err:
+            logger.warning(f"Could not write to the source image cache in {self.directory}: {err}")
+            return
+        with self._mutex:
+            for name, file_data in new_files.items():
+                if name not in self.files:
+                    self.files[name] = len(file_data)
+                    self.disk_bytes += len(file_data)
+            # Another thread might have evicted what was already there, since we checked
+            for name in (url_file, content_hash):
+                if name in self.files:
+                    self.files.move_to_end(name)
+            if content_hash in self.files:
+                self.disk_urls[url] = content_hash
+            self.evict_disk()
+
+    def collect_metrics(self):
+        return [
+            ("horde_worker_source_cache_bytes", {"tier": "memory"}, self.memory_bytes),
+            ("horde_worker_source_cache_bytes", {"tier": "disk"}, self.disk_bytes),
+        ]
+
+
+source_cache = SourceCache()
+metrics.add_collector(source_cache.collect_metrics)
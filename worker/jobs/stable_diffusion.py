@@ -4,18 +4,17 @@ import json
 import random
 import time
 import traceback
-from io import BytesIO
 
-import requests
-from hordelib.horde import HordeLib
-from hordelib.safety_checker import is_image_nsfw
-
-from worker import csam
 from worker.enums import JobStatus
+from worker.inference import inference
+from worker.jobs.encoder import image_encoder
 from worker.jobs.framework import HordeJobFramework
 from worker.jobs.kudos import KudosModel
 from worker.logger import logger
+from worker.metrics import metrics
 from worker.post_process import post_process
+from worker.residency import residency_planner
+from worker.sessions import http_session
 from worker.stats import bridge_stats
 
 SAVE_KUDOS_TRAINING_DATA = False
@@ -25,6 +24,8 @@ SIMULATE_KUDOS_LOCALLY = False
 class StableDiffusionHordeJob(HordeJobFramework):
     """Get and process a stable diffusion job from the horde"""
 
+    worker_type = "stable_diffusion"
+
     def __init__(self, mm, bd, pop):
         super().__init__(mm, bd, pop)
         self.current_model = None
@@ -33,16 +34,25 @@ class StableDiffusionHordeJob(HordeJobFramework):
         self.image = None
         self.r2_upload = None
         self.censored = False
+        # Set when the image was replaced by one of the static censor images
+        self.censor_key = None
+        # The base64 of the image, when not using R2. Spliced into the submit payload as is
+        self.generation_b64 = None
         self.available_models = self.model_manager.get_loaded_models_names()
         self.current_model = self.pop.get("model", self.available_models[0])
         self.current_id = self.pop["id"]
         self.current_payload = self.pop["payload"]
         self.r2_upload = self.pop.get("r2_upload", False)
         self.clip_model = None
-        self.hordelib = HordeLib()
+        self.inference = inference
+        self.timeline.attributes["model"] = self.current_model
+        # The size of the job, to replay it in the simulator
+        self.timeline.attributes["width"] = self.current_payload.get("width")
+        self.timeline.attributes["height"] = self.current_payload.get("height")
+        self.timeline.attributes["steps"] = self.current_payload.get("ddim_steps")
         self.kudos_model = None
         if SIMULATE_KUDOS_LOCALLY:
-            self.kudos_model = KudosModel("worker/jobs/kudos-v20-66.ckpt")
+            self.kudos_model = KudosModel("worker/jobs/kudos-v20-66.npz")
         self.job_kudos = 0
 
     @logger.catch(reraise=True)
@@ -164,7 +174,7 @@ class StableDiffusionHordeJob(HordeJobFramework):
                     ),
                 )
         # This might change if we add more pipelines later.
-        generator = self.hordelib.basic_inference
+        generator = self.inference.basic_inference
         try:
             logger.info(
                 f"Starting generation for id {self.current_id}: {self.current_model} @ "
@@ -181,7 +191,9 @@ class StableDiffusionHordeJob(HordeJobFramework):
             gen_payload["model"] = self.current_model
             gen_payload["source_processing"] = req_type
             # logger.debug(gen_payload)
+            self.timeline.begin("inference")
             self.image = generator(gen_payload)
+            metrics.observe("horde_worker_inference_seconds", time.time() - time_state, worker="stable_diffusion")
 
             if SAVE_KUDOS_TRAINING_DATA or SIMULATE_KUDOS_LOCALLY:
                 payload = gen_payload.copy()
@@ -233,14 +245,16 @@ class StableDiffusionHordeJob(HordeJobFramework):
             logger.warning(f"Rescue: Attempting to unload {self.current_model}")
             self.model_manager.unload_model(self.current_model)
             return
-        if use_nsfw_censor and is_image_nsfw(self.image):
+        self.timeline.begin("safety")
+        if use_nsfw_censor and self.inference.is_image_nsfw(self.image):
             logger.info(f"Image censored with reason: {censor_reason}")
             self.image = censor_image
             self.censored = "censored"
+            self.censor_key = censor_reason
 
         # Run the CSAM Checker
         if not self.censored:
-            is_csam, similarities, similarity_hits = csam.check_for_csam(
+            is_csam, similarities, similarity_hits = self.inference.check_for_csam(
                 clip_model=self.clip_model,
                 image=self.image,
                 prompt=self.current_payload["prompt"],
@@ -250,8 +264,10 @@ class StableDiffusionHordeJob(HordeJobFramework):
                 logger.warning(f"Current values for id {self.current_id} would create CSAM. Censoring!")
                 self.image = self.bridge_data.censor_image_csam
                 self.censored = "csam"
+                self.censor_key = "csam"
 
         # Run Post-Processors
+        self.timeline.begin("post_process")
         for post_processor in self.current_payload.get("post_processing", []):
             # Do not PP when censored
             if self.censored:
@@ -312,26 +328,56 @@ class StableDiffusionHordeJob(HordeJobFramework):
 
     def prepare_submit_payload(self):
         # images, seed, info, stats = txt2img(**self.current_payload)
-        buffer = BytesIO()
         # We send as WebP to avoid using all the horde bandwidth
-        self.image.save(buffer, format="WebP", quality=self.upload_quality, method=6)
-        if self.r2_upload:
-            put_response = requests.put(self.r2_upload, data=buffer.getvalue())
-            generation = "R2"
-            logger.debug("R2 Upload response: {}", put_response)
-        else:
-            generation = base64.b64encode(buffer.getvalue()).decode("utf8")
+        self.timeline.begin("encode")
+        encoded = image_encoder.encode(self.image, self.upload_quality, cache_key=self.censor_key)
+        self.upload_bytes_copied += encoded.bytes_copied
+        self.timeline.begin("upload")
+        try:
+            if self.r2_upload:
+                # Streamed straight from the encoded buffer (or its spool file), without copying it
+                with encoded.open_upload_body() as upload_body:
+                    put_response = http_session.put(self.r2_upload, data=upload_body)
+                logger.debug("R2 Upload response: {}", put_response)
+            else:
+                if encoded.is_spooled():
+                    # It has to be read back to be encoded
+                    self.upload_bytes_copied += encoded.size
+                self.generation_b64 = base64.b64encode(encoded.get_buffer())
+                self.upload_bytes_copied += len(self.generation_b64)
+        finally:
+            encoded.close()
         self.submit_dict = {
             "id": self.current_id,
-            "generation": generation,
             "seed": self.seed,
         }
+        if self.r2_upload:
+            self.submit_dict["generation"] = "R2"
         if self.censored:
             self.submit_dict["state"] = self.censored
 
+    def serialize_submit_payload(self):
+        if self.generation_b64 is None:
+            return super().serialize_submit_payload()
+        payload = json.dumps(self.submit_dict).encode("utf-8")
+        # Base64 only uses characters which are safe in a JSON string, so it's spliced in without a round trip
+        # through a str, which would copy it twice more
+        payload = b"".join((b'{"generation": "', self.generation_b64, b'", ', payload[1:]))
+        self.generation_b64 = None
+        return payload
+
     def post_submit_tasks(self, submit_req):
         kudos = self.job_kudos if SIMULATE_KUDOS_LOCALLY else submit_req.json()["reward"]
         bridge_stats.update_inference_stats(self.current_model, kudos)
+        megapixelsteps = (
+            self.current_payload["width"] * self.current_payload["height"] * self.current_payload["ddim_steps"] / 1e6
+        )
+        residency_planner.record_job(
+            self.current_model,
+            kudos,
+            megapixelsteps,
+            self.timeline.get_durations().get("inference", 0),
+        )
 
 
 def count_parentheses(s):
@@ -0,0 +1,107 @@
+"""Submits the results of finished jobs back to the horde from a fixed pool of threads"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from worker.logger import logger
+from worker.metrics import metrics
+from worker.stats import bridge_stats
+
+
+class JobSubmitter:
+    """Runs the submission (upload and submit, with their retries) of every finished job on a fixed size thread pool,
+    instead of a new thread per job.
+
+    The backlog counts the submissions queued or in progress. When it's full, the submitter is saturated and
+    the worker stops popping new jobs, so that a horde outage can't make finished jobs pile up indefinitely.
+    Jobs which were already running when that happened still get queued, without waiting: a job waiting for
+    room would outlive its max_job_lifetime during a long enough outage, and have the worker restart every job.
+    So the backlog only goes over its size by the jobs which were running when it filled up.
+
+    The pool threads are not daemons, so pending submissions are still delivered when the worker shuts down.
+    """
+
+    def __init__(self):
+        self.executor = None
+        # How many threads the current pool was started with
+        self.executor_threads = 0
+        self.max_threads = 2
+        self.max_backlog = 10
+        self.backlog = 0
+        self.mutex = threading.RLock()
+        # Called whenever a submission is done, as there might be room in the backlog again
+        self.listeners = []
+
+    def configure(self, max_threads=None, max_backlog=None):
+        with self.mutex:
+            if max_threads is not None:
+                self.max_threads = max(max_threads, 1)
+            if max_backlog is not None:
+                self.max_backlog = max(max_backlog, 1)
+            if self.executor is not None and self.executor_threads != self.max_threads:
+                # A pool can't be resized. The submissions queued on the old one are still delivered by its threads
+                self.executor.shutdown(wait=False)
+                self.executor = None
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="JobSubmitter")
+                self.executor_threads = self.max_threads
+
+    def shutdown(self):
+        """Waits for the pending submissions to be delivered. The pool is started again on the next submit"""
+        with self.mutex:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.configure(max_threads=bridge_data.submit_threads, max_backlog=bridge_data.submit_backlog)
+
+    def add_listener(self, callback):
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    def is_saturated(self):
+        """True when the backlog is full, and no more jobs should be picked up"""
+        return self.backlog >= self.max_backlog
+
+    def get_queue_depth(self):
+        return self.backlog
+
+    def submit(self, job):
+        """Queues the submission of a finished job, even when the backlog is full"""
+        with self.mutex:
+            if self.is_saturated():
+                logger.debug(f"Submit backlog is full ({self.backlog}). Queuing the submission of a running job.")
+            self.backlog += 1
+            queue_depth = self.backlog
+            # Under the lock, as configure() or shutdown() might be swapping the pool. The lock is reentrant
+            if self.executor is None:
+                self.configure()
+            self.executor.submit(self.run, job, time.monotonic())
+        bridge_stats.update_submit_queue_depth(queue_depth)
+
+    def run(self, job, queued_time):
+        start_time = time.monotonic()
+        job.timeline.record("submit_queue", queued_time, start_time)
+        try:
+            with logger.contextualize(**job.get_log_context()):
+                job.submit_job()
+        # pylint: disable=broad-except
+        except Exception as err:
+            logger.error(f"Failed to submit job: {err}")
+            logger.exception(err)
+        finally:
+            with self.mutex:
+                self.backlog -= 1
+                queue_depth = self.backlog
+            now = time.monotonic()
+            bridge_stats.update_submit_stats(start_time - queued_time, now - start_time)
+            metrics.observe("horde_worker_submit_queue_seconds", start_time - queued_time)
+            metrics.observe("horde_worker_submit_seconds", now - start_time)
+            bridge_stats.update_submit_queue_depth(queue_depth)
+            job.finish_timeline()
+            for callback in self.listeners:
+                callback()
+
+
+job_submitter = JobSubmitter()
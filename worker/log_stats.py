@@ -0,0 +1,314 @@
+"""Scans the bridge logs for the pop, generation and kudos stats of pop-stats.py and model-stats.py"""
+import datetime
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+LOG_FILES = "logs/bridge*.log"
+INDEX_FILE = "logs/stats-index.json"
+INDEX_VERSION = 1
+# How much of a log is read at once
+CHUNK_SIZE = 16 * 1024 * 1024
+# The new bytes of the logs are split in ranges of about this size, which are scanned in parallel
+RANGE_SIZE = 256 * 1024 * 1024
+# Jobs are abandoned well within this many hours, so generations started longer ago than that are not kept
+# waiting for their submit
+PENDING_HOURS = 2
+# A file whose first bytes changed since the last scan was replaced, and is scanned from its start again
+HEAD_SIZE = 256
+
+# The lines we're interested in are found by these, and only then parsed by the regexes below
+POP_MARKER = b"Job pop took "
+START_MARKER = b"Starting generation"
+SUBMIT_MARKER = b"Submitted job with id "
+# Matched at the start of the line, e.g. "DEBUG      | 2023-06-01 12:34:56.789012 | "
+HEADER_REGEX = re.compile(rb"\w+ *\| (\d{4}-\d\d-\d\d \d\d):")
+# Matched at the marker
+POP_REGEX = re.compile(rb"Job pop took (\d+(?:\.\d+)?) \(node: ([^)]*)\)")
+START_REGEX = re.compile(rb"Starting generation(?: for id (\S+))?: (.*?) @ ")
+SUBMIT_REGEX = re.compile(rb"Submitted job with id (\S+) and contributed for (\d+(?:\.\d+)?)")
+
+
+def new_stats():
+    """The stats of some part of the logs. Everything is per hour, "YYYY-MM-DD HH", so that the stats of any
+    period can be added up from them"""
+    return {
+        # Hour -> node -> [seconds, pops]
+        "pops": {},
+        # Hour -> model -> [generations, kudos]
+        "models": {},
+        # Hour -> kudos
+        "kudos": {},
+        # Job id -> [hour, model] of the generations not matched with their submit yet
+        "pending_starts": {},
+        # Job id -> [hour, kudos] of the submits not matched with their generation yet
+        "pending_submits": {},
+    }
+
+
+def add_kudos_to_model(stats, hour, model, kudos):
+    entry = stats["models"].setdefault(hour, {}).setdefault(model, [0, 0.0])
+    entry[1] += kudos
+
+
+def match_pending(stats):
+    """Adds the kudos of the submits to the models of their generations, where both were seen"""
+    for job_id in [job_id for job_id in stats["pending_submits"] if job_id in stats["pending_starts"]]:
+        hour, model = stats["pending_starts"].pop(job_id)
+        add_kudos_to_model(stats, hour, model, stats["pending_submits"].pop(job_id)[1])
+
+
+def merge_stats(stats, other):
+    """Adds the stats of `other` to `stats`"""
+    for hour, nodes in other["pops"].items():
+        hour_stats = stats["pops"].setdefault(hour, {})
+        for node, (seconds, pops) in nodes.items():
+            entry = hour_stats.setdefault(node, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += pops
+    for hour, models in other["models"].items():
+        hour_stats = stats["models"].setdefault(hour, {})
+        for model, (generations, kudos) in models.items():
+            entry = hour_stats.setdefault(model, [0, 0.0])
+            entry[0] += generations
+            entry[1] += kudos
+    for hour, kudos in other["kudos"].items():
+        stats["kudos"][hour] = stats["kudos"].get(hour, 0.0) + kudos
+    stats["pending_starts"].update(other["pending_starts"])
+    stats["pending_submits"].update(other["pending_submits"])
+    match_pending(stats)
+
+
+def prune_pending(stats):
+    """Forgets the generations and submits too old to be matched anymore"""
+    hours = [*stats["kudos"], *stats["models"]]
+    if not hours:
+        return
+    cutoff = datetime.datetime.strptime(max(hours), "%Y-%m-%d %H") - datetime.timedelta(hours=PENDING_HOURS)
+    cutoff = cutoff.strftime("%Y-%m-%d %H")
+    for pending in ("pending_starts", "pending_submits"):
+        stats[pending] = {job_id: entry for job_id, entry in stats[pending].items() if entry[0] >= cutoff}
+
+
+def scan_lines(data, stats, marker, parse):
+    """Calls parse(stats, hour, position, line_end, data) for every line of data containing the marker, with the
+    position of the marker. Lines without a log header, e.g. the continuations of multiline messages, are skipped"""
+    position = data.find(marker)
+    while position != -1:
+        line_start = data.rfind(b"\n", 0, position) + 1
+        line_end = data.find(b"\n", position)
+        if line_end == -1:
+            line_end = len(data)
+        header = HEADER_REGEX.match(data, line_start, line_end)
+        if header:
+            parse(stats, header.group(1).decode(), position, line_end, data)
+        position = data.find(marker, line_end)
+
+
+def parse_pop(stats, hour, position, line_end, data):
+    if match := POP_REGEX.match(data, position, line_end):
+        # The node is reported as host:port
+        node = match.group(2).decode(errors="replace").split(":")[0]
+        entry = stats["pops"].setdefault(hour, {}).setdefault(node, [0.0, 0])
+        entry[0] += float(match.group(1))
+        entry[1] += 1
+
+
+def parse_start(stats, hour, position, line_end, data):
+    if match := START_REGEX.match(data, position, line_end):
+        model = match.group(2).decode(errors="replace")
+        entry = stats["models"].setdefault(hour, {}).setdefault(model, [0, 0.0])
+        entry[0] += 1
+        if match.group(1):
+            stats["pending_starts"][match.group(1).decode(errors="replace")] = [hour, model]
+
+
+def parse_submit(stats, hour, position, line_end, data):
+    if match := SUBMIT_REGEX.match(data, position, line_end):
+        kudos = float(match.group(2))
+        stats["kudos"][hour] = stats["kudos"].get(hour, 0.0) + kudos
+        stats["pending_submits"][match.group(1).decode(errors="replace")] = [hour, kudos]
+
+
+def scan_range(filename, start, end, chunk_size=CHUNK_SIZE):
+    """Returns the stats of the complete lines between the start and end offsets of the file, with the offset
+    after the last complete line. The lines are scanned a chunk at a time, and only those with a marker parsed"""
+    stats = new_stats()
+    offset = start
+    with open(filename, "rb") as log_file:
+        log_file.seek(start)
+        while offset < end:
+            data = log_file.read(min(chunk_size, end - offset))
+            if not data:
+                break
+            # A line cut at the end of the chunk is read again with the next one
+            last_newline = data.rfind(b"\n")
+            if last_newline == -1:
+                if len(data) < chunk_size:
+                    break
+                # A line longer than a chunk can't be a line we're interested in
+                offset += len(data)
+                continue
+            data = data[: last_newline + 1]
+            scan_lines(data, stats, POP_MARKER, parse_pop)
+            scan_lines(data, stats, START_MARKER, parse_start)
+            scan_lines(data, stats, SUBMIT_MARKER, parse_submit)
+            offset += len(data)
+            log_file.seek(offset)
+    match_pending(stats)
+    return stats, offset
+
+
+def split_ranges(filename, start, end, range_size=RANGE_SIZE):
+    """Splits the bytes of the file between start and end into ranges of about range_size, at line ends"""
+    ranges = []
+    with open(filename, "rb") as log_file:
+        while end - start > range_size:
+            log_file.seek(start + range_size)
+            log_file.readline()
+            split = log_file.tell()
+            if split >= end:
+                break
+            ranges.append((start, split))
+            start = split
+    ranges.append((start, end))
+    return ranges
+
+
+def read_head(filename):
+    with open(filename, "rb") as log_file:
+        return hashlib.sha1(log_file.read(HEAD_SIZE)).hexdigest()
+
+
+class LogScanner:
+    """Scans the bridge logs incrementally, remembering in an index how far each log file was scanned and its
+    stats up to there. Repeated scans only read what was logged since.
+
+    The log files are keyed by their inode, as loguru renames the log when rotating it, and their first bytes
+    are checked to tell replaced files apart. Files which are gone are dropped from the stats, as they would
+    be from a full scan. The new bytes are split in ranges of up to RANGE_SIZE, which are scanned in parallel
+    processes, whether they're in the same file or not."""
+
+    def __init__(self, log_files=LOG_FILES, index_file=INDEX_FILE, processes=None, range_size=RANGE_SIZE):
+        self.log_files = log_files
+        self.index_file = index_file
+        self.processes = processes or os.cpu_count() or 1
+        self.range_size = range_size
+
+    def load_index(self):
+        if not self.index_file or not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, "rt", encoding="utf-8") as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+        if index.get("version") != INDEX_VERSION:
+            return {}
+        return index["files"]
+
+    def save_index(self, files):
+        if not self.index_file:
+            return
+        temporary_file = f"{self.index_file}.tmp"
+        with open(temporary_file, "wt", encoding="utf-8") as index_file:
+            json.dump({"version": INDEX_VERSION, "files": files}, index_file)
+        os.replace(temporary_file, self.index_file)
+
+    def get_ranges(self, indexed_files):
+        """Returns the files with their index entries, updated for any replaced file, and the ranges to scan"""
+        files = {}
+        ranges = []
+        for filename in sorted(glob.glob(self.log_files)):
+            status = os.stat(filename)
+            key = f"{status.st_dev}:{status.st_ino}"
+            head = read_head(filename)
+            entry = indexed_files.get(key)
+            if not entry or entry["head"] != head or entry["offset"] > status.st_size:
+                entry = {"offset": 0, "stats": new_stats()}
+            entry["filename"] = filename
+            entry["head"] = head
+            files[key] = entry
+            if status.st_size > entry["offset"]:
+                ranges.extend(
+                    (key, filename, start, end)
+                    for start, end in split_ranges(filename, entry["offset"], status.st_size, self.range_size)
+                )
+        return files, ranges
+
+    def scan(self, progress=None):
+        """Scans what's new in the logs, and returns their stats. progress(bytes) is called as ranges are done"""
+        files, ranges = self.get_ranges(self.load_index())
+        results = {}
+        if len(ranges) > 1 and self.processes > 1:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(min(self.processes, len(ranges)), mp_context=context) as executor:
+                futures = [executor.submit(scan_range, filename, start, end) for _, filename, start, end in ranges]
+                for (key, _, start, end), future in zip(ranges, futures):
+                    results[(key, start)] = future.result()
+                    if progress:
+                        progress(end - start)
+        else:
+            for key, filename, start, end in ranges:
+                results[(key, start)] = scan_range(filename, start, end)
+                if progress:
+                    progress(end - start)
+        # The ranges of each file are merged in order, and the file is scanned up to the last complete line
+        for key, _, start, _ in ranges:
+            range_stats, offset = results[(key, start)]
+            merge_stats(files[key]["stats"], range_stats)
+            files[key]["offset"] = max(files[key]["offset"], offset)
+        for entry in files.values():
+            prune_pending(entry["stats"])
+        self.save_index(files)
+        stats = new_stats()
+        for entry in files.values():
+            merge_stats(stats, entry["stats"])
+        return LogSummary(stats)
+
+    def get_new_bytes(self):
+        """How many bytes the next scan will read, e.g. for a progress bar"""
+        _, ranges = self.get_ranges(self.load_index())
+        return sum(end - start for _, _, start, end in ranges)
+
+
+class LogSummary:
+    """The stats of the scanned logs, for all of them or for the hours starting with a prefix,
+    e.g. "2023-06-01" for a day or "2023-06-01 12" for an hour"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def get_pop_times(self, prefix=None):
+        """Node -> [seconds, pops]"""
+        nodes = {}
+        for hour, hour_stats in self.stats["pops"].items():
+            if prefix and not hour.startswith(prefix):
+                continue
+            for node, (seconds, pops) in hour_stats.items():
+                entry = nodes.setdefault(node, [0.0, 0])
+                entry[0] += seconds
+                entry[1] += pops
+        return nodes
+
+    def get_models(self, prefix=None):
+        """Model -> [generations, kudos]. The kudos are those of the generations whose submit was found"""
+        models = {}
+        for hour, hour_stats in self.stats["models"].items():
+            if prefix and not hour.startswith(prefix):
+                continue
+            for model, (generations, kudos) in hour_stats.items():
+                entry = models.setdefault(model, [0, 0.0])
+                entry[0] += generations
+                entry[1] += kudos
+        return models
+
+    def get_kudos_per_hour(self, prefix=None):
+        """Hour -> kudos, in order"""
+        return {
+            hour: kudos for hour, kudos in sorted(self.stats["kudos"].items()) if not prefix or hour.startswith(prefix)
+        }
@@ -1,4 +1,8 @@
+import json
 import sys
+import threading
+import time
+from contextvars import ContextVar
 from functools import partialmethod
 
 from loguru import logger
@@ -10,6 +14,13 @@ STATS_LEVELS = ["STATS"]
 # By default we're at error level or higher
 verbosity = 20
 quiet = 0
+# Records bound with a `rate_limit` key are only logged once per this many seconds for each key
+rate_limit_seconds = 60
+# rate_limit key -> [when it was last logged, how many were suppressed since]
+rate_limits = {}
+rate_limits_lock = threading.Lock()
+# The stage of the job the current thread is working on, for the JSON log
+log_stage = ContextVar("log_stage", default=None)
 
 
 def set_logger_verbosity(count):
@@ -76,6 +87,61 @@ def is_trace_log(record):
     return True
 
 
+def is_not_suppressed(record):
+    return not record["extra"].get("suppressed")
+
+
+def unless_suppressed(record_filter):
+    def is_logged(record):
+        return is_not_suppressed(record) and record_filter(record)
+
+    return is_logged
+
+
+def limit_log_rate(record):
+    """Marks the record as suppressed if its rate_limit key was logged less than rate_limit_seconds ago.
+    The next one logged says how many were suppressed in between.
+    Runs once per record, before the sinks, which then filter the suppressed records out"""
+    key = record["extra"].get("rate_limit")
+    if key is None:
+        return
+    now = time.monotonic()
+    with rate_limits_lock:
+        last_logged = rate_limits.get(key)
+        if last_logged and now - last_logged[0] < rate_limit_seconds:
+            last_logged[1] += 1
+            record["extra"]["suppressed"] = True
+            return
+        suppressed = last_logged[1] if last_logged else 0
+        rate_limits[key] = [now, 0]
+    if suppressed:
+        record["message"] += f" ({suppressed} similar messages suppressed)"
+
+
+def jsonfmt(record):
+    """Formats the record as one line of JSON, always with the same fields, so that it can be queried.
+    Runs on the thread logging the record, before it's enqueued, so the stage is the one of that thread"""
+    extra = record["extra"]
+    exception = record["exception"]
+    record["extra"]["json"] = json.dumps(
+        {
+            "time": record["time"].isoformat(),
+            "level": record["level"].name,
+            "message": record["message"],
+            "source": f"{record['name']}:{record['function']}:{record['line']}",
+            "job_id": extra.get("job_id"),
+            "worker": extra.get("worker"),
+            "model": extra.get("model"),
+            "stage": extra.get("stage", log_stage.get()),
+            "duration": extra.get("duration"),
+            "durations": extra.get("durations"),
+            "exception": f"{exception.type.__name__}: {exception.value}" if exception else None,
+        },
+        default=str,
+    )
+    return "{extra[json]}\n"
+
+
 def test_logger():
     logger.generation(
         "This is a generation message\nIt is typically multiline\nThee Lines".encode("unicode_escape").decode("utf-8"),
@@ -126,8 +192,11 @@ logger.__class__.init_err = partialmethod(logger.__class__.log, "INIT_ERR")
 logger.__class__.message = partialmethod(logger.__class__.log, "MESSAGE")
 logger.__class__.stats = partialmethod(logger.__class__.log, "STATS")
 
-config = {
-    "handlers": [
+
+def get_handlers(enqueue=False, json_log_file=""):
+    """The sinks of the logger. With enqueue, the records are written by a background thread of each sink,
+    instead of by the thread logging them. With json_log_file, every record is also written to it as JSON"""
+    handlers = [
         {
             "sink": sys.stderr,
             "format": logfmt,
@@ -182,8 +251,40 @@ config = {
             "retention": "3 days",
             "rotation": "1 days",
             "backtrace": True,
-            "diagnose": True,
+            # Formatting the locals of each frame is slow, and happens on the thread logging, even when enqueued
+            "diagnose": not enqueue,
         },
-    ],
+    ]
+    if json_log_file:
+        handlers.append(
+            {
+                "sink": json_log_file,
+                "format": jsonfmt,
+                "level": "DEBUG",
+                "colorize": False,
+                "filter": is_not_stats_log,
+                "retention": "2 days",
+                "rotation": "3 hours",
+            },
+        )
+    for handler in handlers:
+        handler["filter"] = unless_suppressed(handler["filter"])
+        handler["enqueue"] = enqueue
+    return handlers
+
+
+def set_logger_sinks(enqueue=False, json_log_file="", rate_limit=60):
+    """Reconfigures the sinks of the logger, see get_handlers(). Must be called before the terminal UI starts,
+    as it replaces the sinks with the ones in the config"""
+    global rate_limit_seconds
+    rate_limit_seconds = rate_limit
+    # Updated in place, as the terminal UI reads the file sinks from it
+    config["handlers"] = get_handlers(enqueue, json_log_file)
+    logger.configure(**config)
+
+
+config = {
+    "handlers": get_handlers(),
+    "patcher": limit_log_rate,
 }
 logger.configure(**config)
@@ -0,0 +1,220 @@
+"""Exposes the worker's metrics over HTTP, in the Prometheus text format"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from worker.logger import logger
+from worker.stats import bridge_stats
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+# The bridge stats exposed as gauges, with their description
+BRIDGE_STATS_GAUGES = {
+    "kudos_per_hour": "Kudos earned per hour, over the last hour",
+    "jobs_per_hour": "Jobs done per hour, over the last hour",
+    "avg_kudos_per_job": "Average kudos per job, over the last hour",
+    "pop_time_avg_5_mins": "Average job pop time, over the last 5 minutes",
+    "submit_time_avg_5_mins": "Average upload and submit time, over the last 5 minutes",
+    "submit_queue_depth": "Finished jobs waiting for, or in, their submit",
+    "submit_queue_depth_max": "The most finished jobs ever waiting for, or in, their submit",
+    "upload_kb_copied_per_job": "Kilobytes copied in memory to upload and submit each job",
+}
+
+
+class Histogram:
+    """Cumulative counts of the observed values under each bucket bound, with their count and sum"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last one counts the values above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {cumulative}")
+        lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {self.count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """Holds the worker's counters and histograms, and renders them along with the gauges of the collectors.
+
+    Recording a metric only updates a few numbers under a lock, so it's cheap enough for the job threads.
+    The collectors are called when the metrics are scraped, on the HTTP server's thread, so they should only
+    read what they need. The rendered metrics are reused for render_interval seconds, so that frequent
+    scrapes cost next to nothing."""
+
+    render_interval = 1.0
+
+    def __init__(self):
+        # Metric name -> (type, help)
+        self.descriptions = {}
+        # (metric name, sorted labels) -> value, or Histogram
+        self.values = {}
+        # Callables returning [(metric name, labels, value)] of gauges or counters kept elsewhere
+        self.collectors = []
+        self.rendered = b""
+        self.rendered_time = 0
+        self.server = None
+        self._mutex = threading.Lock()
+
+    def describe(self, name, metric_type, description):
+        self.descriptions[name] = (metric_type, description)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._mutex:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._mutex:
+            if key not in self.values:
+                self.values[key] = Histogram(buckets)
+            self.values[key].observe(value)
+
+    def add_collector(self, collector):
+        with self._mutex:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self._mutex:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def collect(self):
+        """Returns metric name -> [(labels, value or Histogram)], out of our own metrics and the collectors'"""
+        samples = {}
+        with self._mutex:
+            for (name, labels), value in self.values.items():
+                if isinstance(value, Histogram):
+                    copied = Histogram(value.buckets)
+                    copied.counts, copied.count, copied.sum = value.counts[:], value.count, value.sum
+                    value = copied
+                samples.setdefault(name, []).append((dict(labels), value))
+            collectors = self.collectors[:]
+        for collector in collectors:
+            try:
+                for name, labels, value in collector():
+                    samples.setdefault(name, []).append((labels, value))
+            # pylint: disable=broad-except
+            except Exception as err:
+                logger.debug(f"Failed to collect metrics from {collector}: {err}")
+        return samples
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format"""
+        lines = []
+        for name, samples in sorted(self.collect().items()):
+            metric_type, description = self.descriptions.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    lines.extend(value.render(name, labels))
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def get_rendered(self):
+        # Concurrent scrapes may both render, which is harmless
+        now = time.monotonic()
+        if now - self.rendered_time >= self.render_interval:
+            self.rendered = self.render()
+            self.rendered_time = now
+        return self.rendered
+
+    def start_server(self, port, host="127.0.0.1"):
+        """Serves the metrics on http://host:port/metrics, on a daemon thread. Does nothing if already serving"""
+        if self.server:
+            return
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.get_rendered()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as err:
+            logger.error(f"Failed to serve the metrics on {host}:{port}: {err}")
+            return
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"Serving the metrics on http://{host}:{self.server.server_address[1]}/metrics")
+
+    def stop_server(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+metrics = MetricsRegistry()
+metrics.describe("horde_worker_pop_seconds", "histogram", "How long job pops from the horde took")
+metrics.describe("horde_worker_inference_seconds", "histogram", "How long the inference of a job took")
+metrics.describe("horde_worker_encode_seconds", "histogram", "How long encoding a generated image took")
+metrics.describe("horde_worker_submit_seconds", "histogram", "How long the upload and submit of a job took")
+metrics.describe("horde_worker_submit_queue_seconds", "histogram", "How long finished jobs waited to be submitted")
+metrics.describe("horde_worker_model_load_seconds", "histogram", "How long loading a model took")
+metrics.describe("horde_worker_model_load_failures_total", "counter", "How many model loads failed")
+metrics.describe("horde_worker_waiting_jobs", "gauge", "Jobs popped and waiting for a thread")
+metrics.describe("horde_worker_running_jobs", "gauge", "Jobs running")
+metrics.describe("horde_worker_soft_restarts_total", "counter", "Soft restarts of the worker loop")
+metrics.describe("horde_worker_out_of_memory_jobs_total", "counter", "Jobs which ran out of memory")
+metrics.describe("horde_worker_consecutive_failed_jobs", "gauge", "Jobs which failed since the last success")
+metrics.describe(
+    "horde_worker_consecutive_executor_restarts",
+    "gauge",
+    "Restarts of the job threads without a success",
+)
+metrics.describe("horde_worker_jobs_total", "counter", "Jobs done, per model")
+metrics.describe("horde_worker_kudos_total", "counter", "Kudos earned, per model")
+for key, description in BRIDGE_STATS_GAUGES.items():
+    metrics.describe(f"horde_worker_{key}", "gauge", description)
+
+
+def collect_bridge_stats():
+    stats = bridge_stats.snapshot()
+    samples = [(f"horde_worker_{key}", {}, stats[key]) for key in BRIDGE_STATS_GAUGES if key in stats]
+    for model_name, model in stats.get("inference", {}).items():
+        samples.append(("horde_worker_jobs_total", {"model": model_name}, model["count"]))
+        samples.append(("horde_worker_kudos_total", {"model": model_name}, model["kudos"]))
+    return samples
+
+
+metrics.add_collector(collect_bridge_stats)
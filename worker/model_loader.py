@@ -0,0 +1,165 @@
+"""Loads the models of the worker from a fixed pool of threads, the most wanted first"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from worker.logger import logger
+from worker.metrics import metrics
+
+metrics.describe("horde_worker_models_to_load", "gauge", "Models waiting to load or loading")
+metrics.describe("horde_worker_model_load_eta_seconds", "gauge", "Estimated seconds until every model is loaded")
+
+
+class ModelLoadScheduler:
+    """Loads the models from a pool of threads. Loading is mostly waiting for the disk, so loading a few at a time
+    is faster, but it's opt-in: the model managers of hordelib aren't known to be safe to call from several threads
+    at once, so there's a single thread by default.
+
+    The models are loaded in order of how many jobs the horde has queued for them, so that the worker can
+    serve the most wanted ones first. Models the horde doesn't report a queue for, like the safety checker and
+    the post-processors, are needed by every job, so they're loaded before any other.
+
+    Each model is available as soon as it's loaded, as that's when the model manager reports it, and the
+    listeners are called then, so that the worker can start popping for it straight away instead of waiting
+    for the rest.
+
+    How long each model took to load is remembered, to estimate how long the remaining ones will take.
+    """
+
+    def __init__(self):
+        self.executor = None
+        # How many threads the current pool was started with
+        self.executor_threads = 0
+        self.max_threads = 1
+        # Called with the name of each model when it's loaded
+        self.listeners = []
+        self.mutex = threading.Lock()
+        self.queued = []
+        self.loading = {}
+        self.loaded = []
+        self.failed = []
+        self.load_seconds = {}
+
+    def configure(self, max_threads=None):
+        with self.mutex:
+            if max_threads is not None:
+                self.max_threads = max(max_threads, 1)
+            if self.executor is not None and self.executor_threads != self.max_threads:
+                # A pool can't be resized. The models queued on the old one are still loaded by its threads
+                self.executor.shutdown(wait=False)
+                self.executor = None
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="ModelLoader")
+                self.executor_threads = self.max_threads
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.configure(max_threads=bridge_data.model_load_threads)
+
+    def add_listener(self, callback):
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    @staticmethod
+    def prioritize(model_names, demand):
+        """Returns the models in the order to load them: those without a queue in the demand first, then the
+        others by their queue, the longest first. Ties keep their configured order"""
+        return sorted(model_names, key=lambda model: (model in demand, -demand.get(model, 0)))
+
+    def unload(self, model_manager, model_names):
+        """Unloads the loaded models which are not in model_names"""
+        for model in model_manager.get_loaded_models_names():
+            if model not in model_names:
+                logger.init(f"{model}", status="Unloading")
+                model_manager.unload_model(model)
+
+    def load(self, model_manager, model_names, demand=None):
+        """Loads the models which are not loaded yet, and returns when they're all done.
+        demand is how many jobs the horde has queued for each model, if known"""
+        self.configure()
+        loaded_models = set(model_manager.get_loaded_models_names())
+        to_load = self.prioritize([model for model in model_names if model not in loaded_models], demand or {})
+        if not to_load:
+            return
+        with self.mutex:
+            self.queued = to_load[:]
+            self.loading = {}
+            self.loaded = []
+            self.failed = []
+            logger.init(f"{len(to_load)} models", status=f"Loading {self.max_threads} at a time")
+            # Under the lock, as configure() might be swapping the pool
+            futures = [self.executor.submit(self.load_model, model_manager, model) for model in to_load]
+        wait(futures)
+
+    def load_model(self, model_manager, model):
+        with self.mutex:
+            self.queued.remove(model)
+            self.loading[model] = time.monotonic()
+        start_time = time.monotonic()
+        success = None
+        try:
+            if model == "safety_checker":
+                success = model_manager.load(model, cpu_only=True)
+            else:
+                success = model_manager.load(model)
+        # pylint: disable=broad-except
+        except Exception as err:
+            logger.error(f"Failed to load {model}: {err}")
+        seconds = time.monotonic() - start_time
+        with self.mutex:
+            del self.loading[model]
+            if success:
+                self.loaded.append(model)
+                self.load_seconds[model] = seconds
+            else:
+                self.failed.append(model)
+        if not success:
+            logger.init_err(f"{model}", status="Error")
+            metrics.increment("horde_worker_model_load_failures_total")
+            return
+        metrics.observe("horde_worker_model_load_seconds", seconds)
+        progress = self.get_progress()
+        done = progress["loaded"] + progress["failed"]
+        logger.init_ok(
+            f"{model}",
+            status=f"Loaded in {seconds:.1f}s ({done}/{progress['total']}, ETA {progress['eta']:.0f}s)",
+        )
+        for callback in self.listeners:
+            callback(model)
+
+    def get_expected_seconds(self, model):
+        """How long the model took to load last time, or the average of the others if we never loaded it"""
+        if model in self.load_seconds:
+            return self.load_seconds[model]
+        if self.load_seconds:
+            return sum(self.load_seconds.values()) / len(self.load_seconds)
+        return 0
+
+    def get_progress(self):
+        """Returns how many models are queued, loading, loaded and failed in the current reload, with the names of
+        those loading, and the estimated seconds until they're all done"""
+        with self.mutex:
+            now = time.monotonic()
+            remaining = sum(self.get_expected_seconds(model) for model in self.queued)
+            remaining += sum(
+                max(self.get_expected_seconds(model) - (now - start_time), 0)
+                for model, start_time in self.loading.items()
+            )
+            return {
+                "total": len(self.queued) + len(self.loading) + len(self.loaded) + len(self.failed),
+                "queued": len(self.queued),
+                "loading": list(self.loading),
+                "loaded": len(self.loaded),
+                "failed": len(self.failed),
+                "eta": remaining / self.max_threads,
+            }
+
+    def collect_metrics(self):
+        progress = self.get_progress()
+        return [
+            ("horde_worker_models_to_load", {}, progress["queued"] + len(progress["loading"])),
+            ("horde_worker_model_load_eta_seconds", {}, round(progress["eta"], 1)),
+        ]
+
+
+model_loader = ModelLoadScheduler()
+metrics.add_collector(model_loader.collect_metrics)
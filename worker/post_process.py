@@ -1,10 +1,8 @@
 """Post process images"""
-import rembg
-from hordelib.horde import HordeLib
-from hordelib.shared_model_manager import SharedModelManager
 from loguru import logger
 
-hordelib = HordeLib()
+from worker.inference import inference
+from worker.utils.background import rembg_sessions, remove_background
 
 
 def post_process(model, image, strength):  # noqa: ARG001
@@ -14,9 +12,9 @@ def post_process(model, image, strength):  # noqa: ARG001
         logger.warning(f"Post processor {model} is unknown. Returning original image")
         return image
 
-    if model != "strip_background" and not SharedModelManager.manager.is_model_loaded(model):
+    if model != "strip_background" and not inference.is_model_loaded(model):
         logger.init(f"{model}", status="Loading")
-        load_result = SharedModelManager.manager.load(model)
+        load_result = inference.load_model(model)
         if not load_result:
             logger.init_err(f"{model}", status="Error")
             return image
@@ -30,30 +28,52 @@ def post_process(model, image, strength):  # noqa: ARG001
     return pprocessor(payload)
 
 
+class BackgroundRemover:
+    """Removes backgrounds with rembg, on sessions which stay loaded between requests (see RembgSessionPool).
+
+    Backgrounds are removed in the job's thread. The alpha matting is CPU heavy, but pymatting's kernels release
+    the GIL, so the other threads keep running meanwhile. How many are removed at once is bounded by the sessions.
+    """
+
+    model_name = "u2net"
+    alpha_matting_options = {
+        "alpha_matting": 10,
+        "alpha_matting_foreground_threshold": 240,
+        "alpha_matting_background_threshold": 10,
+        "alpha_matting_erode_size": 10,
+    }
+
+    def configure(self, max_sessions=None, idle_timeout=None):
+        rembg_sessions.configure(max_sessions=max_sessions, idle_timeout=idle_timeout)
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.configure(max_sessions=bridge_data.rembg_sessions, idle_timeout=bridge_data.rembg_idle_timeout)
+
+    def evict_idle(self):
+        """Unloads the sessions when they've been idle for too long"""
+        if rembg_sessions.evict_idle():
+            logger.debug("Unloaded the idle background removal sessions")
+
+    def remove(self, image):
+        return remove_background(image, self.model_name, self.alpha_matting_options)
+
+
+background_remover = BackgroundRemover()
+
+
 # TODO: move to hordelib or ComfyUI
 def strip_background(payload):
-    session = rembg.new_session("u2net")
-    image = rembg.remove(
-        payload["source_image"],
-        session=session,
-        only_mask=False,
-        alpha_matting=10,
-        alpha_matting_foreground_threshold=240,
-        alpha_matting_background_threshold=10,
-        alpha_matting_erode_size=10,
-    )
-    del session
-    return image
+    return background_remover.remove(payload["source_image"])
 
 
 # At the bottom, as we need to define the method first
 KNOWN_POST_PROCESSORS = {
-    "RealESRGAN_x4plus": hordelib.image_upscale,
-    "RealESRGAN_x2plus": hordelib.image_upscale,
-    "RealESRGAN_x4plus_anime_6B": hordelib.image_upscale,
-    "NMKD_Siax": hordelib.image_upscale,
-    "4x_AnimeSharp": hordelib.image_upscale,
+    "RealESRGAN_x4plus": inference.image_upscale,
+    "RealESRGAN_x2plus": inference.image_upscale,
+    "RealESRGAN_x4plus_anime_6B": inference.image_upscale,
+    "NMKD_Siax": inference.image_upscale,
+    "4x_AnimeSharp": inference.image_upscale,
     "strip_background": strip_background,
-    "GFPGAN": hordelib.image_facefix,
-    "CodeFormers": hordelib.image_facefix,
+    "GFPGAN": inference.image_facefix,
+    "CodeFormers": inference.image_facefix,
 }
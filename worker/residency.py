@@ -0,0 +1,247 @@
+"""Chooses which models to keep loaded for the dynamic models, by the kudos they're expected to bring in"""
+import json
+import re
+import threading
+import time
+
+from worker.logger import logger
+from worker.stats import RollingWindow
+
+
+class ResidencyPlan:
+    """The models to keep loaded, those of them to load, and the loaded ones to unload, with the score of each.
+    over_budget are the models kept although they don't fit in the budget"""
+
+    def __init__(self, keep, load, evict, scores, over_budget=None):
+        self.keep = keep
+        self.load = load
+        self.evict = evict
+        self.scores = scores
+        self.over_budget = over_budget or []
+
+    def __repr__(self):
+        return f"ResidencyPlan(keep={self.keep}, load={self.load}, evict={self.evict})"
+
+
+class ResidencyPlanner:
+    """Plans which dynamic models to keep loaded, within the RAM and VRAM the worker may fill with models.
+
+    Each model is valued at the kudos per second it's expected to bring in over the next `horizon` seconds: the
+    larger of what it brought in over the last `horizon` seconds, and its share of the queue the horde reports
+    for it, split evenly between the workers already serving it and us. No model is worth more than the kudos
+    per second the worker can earn at all, its capacity, so that models whose queues are more than we could do
+    anyway aren't swapped for each other as their queues go up and down.
+    The kudos of the queue are estimated from those of the jobs we did, per megapixelstep.
+
+    A model which isn't loaded yet loses the share of the horizon it would spend loading, and a loaded one
+    gets a `hysteresis` bonus, so that a model is only swapped for a clearly better one. Models loaded less than
+    `min_residency` seconds ago aren't unloaded, unless there are more of them than max_models, nor are the models
+    the worker is pinned to. The best models which fit in the budget are then kept. The budget is only a preference:
+    hordelib moves the models it can't fit to its disk cache, so the slots still left are filled with the best of
+    the others.
+
+    The planner only looks at what it's given, so it can be run offline on recorded /status/models snapshots.
+    """
+
+    # Megabytes of the models whose reference doesn't give their size, about that of an SD 1.5 checkpoint
+    default_model_mb = 2048
+    # To estimate the load time of the models never loaded, from their size
+    load_mb_per_second = 100
+    # Until we know better from our own jobs
+    default_kudos_per_megapixelstep = 0.1
+
+    def __init__(self):
+        self.horizon = 600
+        self.hysteresis = 0.25
+        self.min_residency = 600
+        self.status_record_file = None
+        # Loaded dynamic model -> when it was loaded
+        self.resident = {}
+        # Model -> RollingWindow of the kudos of its jobs
+        self.served = {}
+        self.kudos = 0
+        self.megapixelsteps = 0
+        # Of the jobs we know the inference time of
+        self.timed_kudos = 0
+        self.inference_seconds = 0
+        self._mutex = threading.Lock()
+
+    def configure(self, horizon=None, hysteresis=None, min_residency=None, status_record_file=None):
+        if horizon is not None:
+            self.horizon = max(horizon, 1)
+        if hysteresis is not None:
+            self.hysteresis = max(hysteresis, 0)
+        if min_residency is not None:
+            self.min_residency = max(min_residency, 0)
+        if status_record_file is not None:
+            self.status_record_file = status_record_file or None
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.configure(
+            hysteresis=bridge_data.residency_hysteresis,
+            min_residency=bridge_data.residency_min_seconds,
+            status_record_file=bridge_data.model_status_record_file,
+        )
+
+    @staticmethod
+    def get_memory_budget(total_mb, leave_free):
+        """The megabytes of total_mb the models may use, with leave_free being a percentage ("80%") or megabytes"""
+        if match := re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*%\s*", str(leave_free)):
+            return max(total_mb * (1 - float(match[1]) / 100), 0)
+        try:
+            return max(total_mb - float(leave_free), 0)
+        except ValueError:
+            logger.warning(f"Could not understand how much memory to leave free: '{leave_free}'. Leaving 50%.")
+            return total_mb / 2
+
+    def record_job(self, model, kudos, megapixelsteps, seconds=0, now=None):
+        """Counts the kudos of a job we did with the model, in `seconds` of inference"""
+        now = time.time() if now is None else now
+        with self._mutex:
+            if model not in self.served:
+                self.served[model] = RollingWindow(self.horizon, max(self.horizon / 10, 1))
+            self.served[model].add(kudos, now)
+            if megapixelsteps > 0:
+                self.kudos += kudos
+                self.megapixelsteps += megapixelsteps
+            if seconds > 0:
+                self.timed_kudos += kudos
+                self.inference_seconds += seconds
+
+    def record_status(self, statuses, now=None):
+        """Appends a /status/models snapshot to the status record file, if there is one, to replay it later"""
+        if not self.status_record_file:
+            return
+        now = time.time() if now is None else now
+        try:
+            with open(self.status_record_file, "at", encoding="utf-8") as record_file:
+                record_file.write(json.dumps({"time": now, "models": statuses}) + "\n")
+        except OSError as err:
+            logger.warning(f"Could not record the model statuses to {self.status_record_file}: {err}")
+
+    @staticmethod
+    def read_status_record(filename):
+        """Returns the (time, statuses) of each snapshot of a status record file"""
+        snapshots = []
+        with open(filename, "rt", encoding="utf-8") as record_file:
+            for line in record_file:
+                if line.strip():
+                    snapshot = json.loads(line)
+                    snapshots.append((snapshot["time"], snapshot["models"]))
+        return snapshots
+
+    def get_kudos_per_megapixelstep(self):
+        if self.megapixelsteps < 1:
+            return self.default_kudos_per_megapixelstep
+        return self.kudos / self.megapixelsteps
+
+    def get_capacity(self, threads=1):
+        """The kudos per second the worker earns while all its threads are busy, or None before its first jobs"""
+        if self.inference_seconds <= 0:
+            return None
+        return self.timed_kudos / self.inference_seconds * threads
+
+    def get_served_rate(self, model, now):
+        """The kudos per second the model brought in over the horizon"""
+        with self._mutex:
+            window = self.served.get(model)
+            if window is None:
+                return 0
+            window.expire(now)
+            return window.total / self.horizon
+
+    def get_demand_rate(self, status, capacity=None):
+        """The kudos per second we could expect from our share of the queue of a model"""
+        if not status:
+            return 0
+        share = status.get("queued", 0) / (status.get("count", 0) + 1)
+        rate = share / self.horizon * self.get_kudos_per_megapixelstep()
+        return min(rate, capacity) if capacity else rate
+
+    def get_value(self, model, status, now, capacity=None):
+        return max(self.get_served_rate(model, now), self.get_demand_rate(status, capacity))
+
+    def get_load_seconds(self, model, size_mb, load_seconds):
+        if model in load_seconds:
+            return load_seconds[model]
+        return size_mb / self.load_mb_per_second
+
+    def plan(
+        self,
+        statuses,
+        candidates,
+        pinned=(),
+        budget_mb=None,
+        max_models=None,
+        sizes=None,
+        load_seconds=None,
+        capacity=None,
+        now=None,
+    ):
+        """Returns the ResidencyPlan of the dynamic models.
+
+        statuses is the answer of /status/models, candidates the models we may load, pinned the models which
+        stay loaded whatever happens and count against the budget, like the configured ones and those of the
+        running jobs. sizes are in megabytes, load_seconds how long each model took to load, and capacity the
+        kudos per second the worker earns when busy, if known. Without a budget or max_models, the models
+        aren't limited by it. Models over the budget only fill the slots left under max_models."""
+        now = time.time() if now is None else now
+        sizes = sizes or {}
+        load_seconds = load_seconds or {}
+        statuses = {status["name"]: status for status in statuses}
+
+        def get_size(model):
+            return sizes.get(model) or self.default_model_mb
+
+        used_mb = sum(get_size(model) for model in set(pinned))
+        scores = {}
+        for model in set(candidates) | set(self.resident):
+            if model in pinned:
+                continue
+            value = self.get_value(model, statuses.get(model), now, capacity)
+            if model in self.resident:
+                scores[model] = value * (1 + self.hysteresis)
+            elif value > 0:
+                load_share = self.get_load_seconds(model, get_size(model), load_seconds) / self.horizon
+                scores[model] = value * max(1 - load_share, 0)
+        # Recently loaded models haven't had their chance yet
+        protected = [
+            model for model in scores if model in self.resident and now - self.resident[model] < self.min_residency
+        ]
+        keep = []
+        over_budget = []
+        for model in sorted(protected, key=lambda model: scores[model], reverse=True):
+            # Not even they go over max_models, e.g. once number_of_dynamic_models is lowered
+            if max_models is not None and len(keep) >= max_models:
+                break
+            keep.append(model)
+            used_mb += get_size(model)
+        for model in sorted(scores, key=lambda model: scores[model], reverse=True):
+            if model in keep or (scores[model] <= 0 and model not in self.resident):
+                continue
+            if max_models is not None and len(keep) >= max_models:
+                break
+            if budget_mb is not None and used_mb + get_size(model) > budget_mb:
+                over_budget.append(model)
+                continue
+            keep.append(model)
+            used_mb += get_size(model)
+        if max_models is not None:
+            over_budget = over_budget[: max(max_models - len(keep), 0)]
+            keep.extend(over_budget)
+        else:
+            over_budget = []
+        load = [model for model in keep if model not in self.resident]
+        evict = [model for model in self.resident if model not in keep and model not in pinned]
+        return ResidencyPlan(keep, load, evict, scores, over_budget)
+
+    def apply(self, plan, now=None):
+        """Records that the plan was carried out"""
+        now = time.time() if now is None else now
+        for model in plan.evict:
+            self.resident.pop(model, None)
+        for model in plan.load:
+            self.resident[model] = now
+
+
+residency_planner = ResidencyPlanner()
@@ -0,0 +1,174 @@
+"""Shared HTTP session with pooled keep-alive connections, for all the worker traffic (AI Horde, R2, KoboldAI)"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+class ConnectionStats:
+    """Per-host counters of requests sent and new connections opened.
+    Every request which didn't need a new connection reused a pooled one."""
+
+    def __init__(self):
+        self.hosts = {}
+        # We are called from diverse thread contexts
+        self._mutex = threading.Lock()
+
+    def _get_host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {"requests": 0, "new_connections": 0}
+        return self.hosts[host]
+
+    def record_request(self, host):
+        with self._mutex:
+            self._get_host(host)["requests"] += 1
+
+    def record_new_connection(self, host):
+        with self._mutex:
+            self._get_host(host)["new_connections"] += 1
+
+    def get_stats(self):
+        """Returns the counters per host, including how many requests reused a pooled connection"""
+        with self._mutex:
+            return {
+                host: {
+                    "requests": counters["requests"],
+                    "new_connections": counters["new_connections"],
+                    "reused_connections": max(counters["requests"] - counters["new_connections"], 0),
+                }
+                for host, counters in self.hosts.items()
+            }
+
+    def reset(self):
+        with self._mutex:
+            self.hosts = {}
+
+
+connection_stats = ConnectionStats()
+
+
+class CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        connection_stats.record_new_connection(self.host)
+        return super().connect()
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        connection_stats.record_new_connection(self.host)
+        return super().connect()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+    def urlopen(self, method, url, *args, **kwargs):
+        connection_stats.record_request(self.host)
+        return super().urlopen(method, url, *args, **kwargs)
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+    def urlopen(self, method, url, *args, **kwargs):
+        connection_stats.record_request(self.host)
+        return super().urlopen(method, url, *args, **kwargs)
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools record their activity in connection_stats"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+class PooledSession:
+    """A requests.Session shared by every thread of the worker, so that connections are kept alive and reused
+    instead of paying a new TCP and TLS handshake on every request.
+
+    The per-host pool is sized from max_threads, as that's what drives how many requests can be in flight at once.
+    Requests without an explicit timeout get the configured default one.
+    Only failures which are safe to retry (connection errors, or read errors on idempotent methods) are retried
+    here. Everything else is left to the callers, which know whether e.g. a pop or a submit can be repeated.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.adapter = None
+        self.pool_size = None
+        self.timeout = 30
+        self.retries = 3
+        self.backoff_factor = 0.5
+        self.stats = connection_stats
+        self._mutex = threading.Lock()
+        self.configure()
+
+    def configure(self, max_threads=1, timeout=None, retries=None, backoff_factor=None):
+        """(Re)mounts the adapter of the session if any of its settings changed.
+        The previous adapter is closed: its idle connections right away, and the ones of the requests in flight
+        once they're done with them."""
+        # Each thread can be popping, downloading source images and submitting at the same time
+        pool_size = max(max_threads, 1) * 3 + 2
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        backoff_factor = self.backoff_factor if backoff_factor is None else backoff_factor
+        with self._mutex:
+            if self.adapter and (pool_size, timeout, retries, backoff_factor) == (
+                self.pool_size,
+                self.timeout,
+                self.retries,
+                self.backoff_factor,
+            ):
+                return
+            self.pool_size = pool_size
+            self.timeout = timeout
+            self.retries = retries
+            self.backoff_factor = backoff_factor
+            retry = Retry(
+                total=retries,
+                connect=retries,
+                read=retries,
+                status=0,
+                redirect=5,
+                backoff_factor=backoff_factor,
+                raise_on_status=False,
+            )
+            previous_adapter = self.adapter
+            self.adapter = CountingHTTPAdapter(pool_connections=10, pool_maxsize=pool_size, max_retries=retry)
+            self.session.mount("http://", self.adapter)
+            self.session.mount("https://", self.adapter)
+        if previous_adapter:
+            previous_adapter.close()
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.configure(
+            max_threads=bridge_data.max_threads,
+            timeout=bridge_data.http_timeout,
+            retries=bridge_data.http_retries,
+        )
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def get_connection_stats(self):
+        return self.stats.get_stats()
+
+
+http_session = PooledSession()
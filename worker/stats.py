@@ -1,48 +1,161 @@
 """Bridge Stats Tracker"""
 import json
+import math
 import threading
 import time
 from collections import deque
 
 
+class RollingWindow:
+    """Count, sum and distribution of the values recorded over the last `duration` seconds.
+
+    Values are aggregated in buckets of `bucket_seconds`, which leave the window as a whole, so recording a value
+    costs the same however many are in the window. The window covers between `duration` and `duration` plus one
+    bucket. The distribution is a histogram with logarithmic bins, which gives the percentiles to within half of
+    HISTOGRAM_GROWTH of their value."""
+
+    HISTOGRAM_MIN = 0.001
+    HISTOGRAM_GROWTH = 1.05
+    # Up to about two hours
+    HISTOGRAM_BINS = 320
+
+    def __init__(self, duration, bucket_seconds, histogram=False):
+        self.duration = duration
+        self.bucket_seconds = bucket_seconds
+        self.has_histogram = histogram
+        self.reset()
+
+    def reset(self):
+        # [start, count, sum, {histogram bin: count}] of each bucket with values in the window, oldest first
+        self.buckets = deque()
+        self.count = 0
+        self.total = 0.0
+        self.histogram = [0] * self.HISTOGRAM_BINS if self.has_histogram else None
+        # When the first value was recorded
+        self.first_time = None
+
+    @classmethod
+    def get_bin(cls, value):
+        if value <= cls.HISTOGRAM_MIN:
+            return 0
+        return min(int(math.log(value / cls.HISTOGRAM_MIN, cls.HISTOGRAM_GROWTH)) + 1, cls.HISTOGRAM_BINS - 1)
+
+    @classmethod
+    def get_percentile(cls, histogram, percentile):
+        """The value under which `percentile` percent of the values of the histogram are"""
+        rank = sum(histogram) * percentile / 100
+        seen = 0
+        for histogram_bin, count in enumerate(histogram):
+            seen += count
+            if count and seen >= rank:
+                if histogram_bin == 0:
+                    return cls.HISTOGRAM_MIN
+                # The geometric middle of the bin
+                return cls.HISTOGRAM_MIN * cls.HISTOGRAM_GROWTH ** (histogram_bin - 0.5)
+        return 0
+
+    def expire(self, now):
+        too_old = now - self.duration
+        expired = False
+        while self.buckets and self.buckets[0][0] + self.bucket_seconds <= too_old:
+            _, count, _, bins = self.buckets.popleft()
+            self.count -= count
+            if self.histogram:
+                for histogram_bin, bin_count in bins.items():
+                    self.histogram[histogram_bin] -= bin_count
+            expired = True
+        if expired:
+            # Summed again rather than subtracted, so that the rounding errors don't pile up
+            self.total = sum(bucket[2] for bucket in self.buckets)
+
+    def add(self, value, now):
+        self.expire(now)
+        start = now - now % self.bucket_seconds
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append([start, 0, 0.0, {}])
+        bucket = self.buckets[-1]
+        bucket[1] += 1
+        bucket[2] += value
+        self.count += 1
+        self.total += value
+        if self.first_time is None:
+            self.first_time = now
+        if self.histogram:
+            histogram_bin = self.get_bin(value)
+            bucket[3][histogram_bin] = bucket[3].get(histogram_bin, 0) + 1
+            self.histogram[histogram_bin] += 1
+
+    def average(self):
+        return self.total / self.count if self.count else 0
+
+    def span(self, now):
+        """How many seconds the values in the window were recorded over, up to its duration plus one bucket"""
+        if not self.buckets:
+            return 0
+        return now - max(self.buckets[0][0], self.first_time)
+
+
 class BridgeStats:
     """Convenience functions for the stats"""
 
     stats = {}  # Deliberately on class level
 
+    # The latency percentiles added to the snapshots
+    PERCENTILES = (50, 95, 99)
+
     def __init__(self):
-        self.kudos_record = deque()
-        self.pop_record = deque()
+        self.kudos_record = RollingWindow(3600, 60)
+        self.pop_times_5_mins = RollingWindow(60 * 5, 10, histogram=True)
+        self.pop_times_1_hour = RollingWindow(3600, 60, histogram=True)
+        self.submit_queue_times = RollingWindow(60 * 5, 10)
+        self.submit_times = RollingWindow(60 * 5, 10, histogram=True)
+        self.upload_jobs = 0
+        self.upload_bytes_copied = 0
         # We are called from diverse thread contexts
         self._mutex = threading.Lock()
 
     def reset(self):
         with self._mutex:
-            self.kudos_record = deque()
-            self.pop_record = deque()
+            for window in (
+                self.kudos_record,
+                self.pop_times_5_mins,
+                self.pop_times_1_hour,
+                self.submit_queue_times,
+                self.submit_times,
+            ):
+                window.reset()
+            self.upload_jobs = 0
+            self.upload_bytes_copied = 0
             BridgeStats.stats = {}
 
-    def update_pop_stats(self, node, pop_time):
+    def update_pop_stats(self, node, pop_time):  # noqa: ARG002
         with self._mutex:
-            self.pop_record.append((node, pop_time, time.time()))
+            now = time.time()
+            self.pop_times_5_mins.add(pop_time, now)
+            self.pop_times_1_hour.add(pop_time, now)
+            self.stats["pop_time_avg_5_mins"] = round(self.pop_times_5_mins.average(), 2)
+            self.stats["pop_time_avg_1_hour"] = round(self.pop_times_1_hour.average(), 2)
 
-            # only keep pop stats for an hour
+    def update_submit_stats(self, queue_time, submit_time):
+        """Records how long a finished job waited for a submit thread, and how long its upload and submit took"""
+        with self._mutex:
             now = time.time()
-            too_old = now - 3600
-            while self.pop_record and self.pop_record[0][2] < too_old:
-                self.pop_record.popleft()
-
-            # Calculate some facts
-            recent = now - (60 * 5)
-            average_1_hour = (
-                sum(poptime for _, poptime, _ in self.pop_record) / len(self.pop_record) if self.pop_record else 0
-            )
-            data_5_mins = [poptime for _, poptime, when in self.pop_record if when > recent]
-            average_5_mins = sum(data_5_mins) / len(data_5_mins) if data_5_mins else 0
+            self.submit_queue_times.add(queue_time, now)
+            self.submit_times.add(submit_time, now)
+            self.stats["submit_queue_time_avg_5_mins"] = round(self.submit_queue_times.average(), 2)
+            self.stats["submit_time_avg_5_mins"] = round(self.submit_times.average(), 2)
 
-            if self.pop_record:
-                self.stats["pop_time_avg_5_mins"] = round(average_5_mins, 2)
-                self.stats["pop_time_avg_1_hour"] = round(average_1_hour, 2)
+    def update_submit_queue_depth(self, queue_depth):
+        with self._mutex:
+            self.stats["submit_queue_depth"] = queue_depth
+            self.stats["submit_queue_depth_max"] = max(self.stats.get("submit_queue_depth_max", 0), queue_depth)
+
+    def update_upload_stats(self, bytes_copied):
+        """Records how many bytes a job had to copy in memory to upload and submit its results"""
+        with self._mutex:
+            self.upload_jobs += 1
+            self.upload_bytes_copied += bytes_copied
+            self.stats["upload_kb_copied_per_job"] = round(self.upload_bytes_copied / self.upload_jobs / 1024, 1)
 
     def update_inference_stats(self, model_name, kudos):
         """Updates the stats for a model inference"""
@@ -61,28 +174,41 @@ class BridgeStats:
 
             # Remember the kudos we got awarded over the last hour
             now = time.time()
-            too_old = now - 3600
-            self.kudos_record.append((kudos, now))
-            oldest = self.kudos_record[0][1] if self.kudos_record else now
-            while self.kudos_record and self.kudos_record[0][1] < too_old:
-                oldest = self.kudos_record.popleft()[1]
-            period = now - oldest
-
-            # Calculate the total kudos
-            total_kudos = sum(score for score, _ in self.kudos_record)
-            # If period is less than an hour, extrapolate
-            total_kudos = 0 if period < 10 else total_kudos * (3600 / period)
-            jobs_per_hour = 1 if period < 10 else len(self.kudos_record) * (3600 / period)
-
-            if self.kudos_record:
-                self.stats["kudos_per_hour"] = round(total_kudos)
-                self.stats["jobs_per_hour"] = round(jobs_per_hour)
-                self.stats["avg_kudos_per_job"] = round(total_kudos / jobs_per_hour, 1)
+            self.kudos_record.add(kudos, now)
+            period = self.kudos_record.span(now)
+
+            # If period is not an hour, extrapolate
+            total_kudos = 0 if period < 10 else self.kudos_record.total * (3600 / period)
+            jobs_per_hour = 1 if period < 10 else self.kudos_record.count * (3600 / period)
+
+            self.stats["kudos_per_hour"] = round(total_kudos)
+            self.stats["jobs_per_hour"] = round(jobs_per_hour)
+            self.stats["avg_kudos_per_job"] = round(total_kudos / jobs_per_hour, 1)
+
+    def snapshot(self):
+        """Returns a copy of the stats, with the latency percentiles. The lock is only held while copying,
+        so the job threads are not kept waiting by the readers"""
+        with self._mutex:
+            stats = dict(self.stats)
+            if "inference" in stats:
+                stats["inference"] = {model_name: dict(model) for model_name, model in stats["inference"].items()}
+            histograms = {
+                name: list(window.histogram)
+                for name, window in (
+                    ("pop_time_{}_5_mins", self.pop_times_5_mins),
+                    ("pop_time_{}_1_hour", self.pop_times_1_hour),
+                    ("submit_time_{}_5_mins", self.submit_times),
+                )
+                if window.count
+            }
+        for name, histogram in histograms.items():
+            for percentile in self.PERCENTILES:
+                stats[name.format(f"p{percentile}")] = round(RollingWindow.get_percentile(histogram, percentile), 2)
+        return stats
 
     def get_pretty_stats(self):
         """Returns a pretty string of the stats"""
-        with self._mutex:
-            return json.dumps(self.stats, indent=4)
+        return json.dumps(self.snapshot(), indent=4)
 
 
 bridge_stats = BridgeStats()
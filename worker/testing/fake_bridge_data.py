@@ -0,0 +1,29 @@
+"""A stand-in for the bridge data, for workers running against the fake horde"""
+from types import SimpleNamespace
+
+
+class FakeBridgeData(SimpleNamespace):
+    """Takes the configuration as keyword arguments. There's no config file to reload, so it is its own snapshot"""
+
+    # What the worker loop configures itself from on reload, unless given. No traces and no disk cache are left
+    # behind, there's no UI, and no GPU either
+    defaults = {
+        "submit_threads": 2,
+        "submit_backlog": 10,
+        "job_trace_file": "",
+        "job_trace_sample_rate": 1.0,
+        "source_cache_size": 256,
+        "source_cache_disk_size": 0,
+        "source_cache_dir": "",
+        "model_load_threads": 2,
+        "metrics_port": 0,
+        "disable_terminal_ui": True,
+        "stats_output_frequency": 0,
+        "prefetch_jobs": False,
+    }
+
+    def __init__(self, **kwargs):
+        super().__init__(**{**self.defaults, **kwargs})
+
+    def snapshot(self):
+        return self
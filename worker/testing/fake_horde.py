@@ -0,0 +1,373 @@
+"""A local stand-in for the AI Horde API, so that the worker can be exercised without the real horde"""
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+
+class FakeHorde:
+    """The state of the fake horde. Generates jobs on pop and records what was submitted.
+
+    Each pop and submit can be slowed down by a latency, and answered with a fault instead: pop_faults and
+    submit_faults give the ratio of the requests answered with each of FAULTS. A "timeout" holds the request
+    for timeout_seconds, longer than the worker waits for it. "stale" only applies to submits.
+
+    The jobs are timed from their pop to their submit, to measure the throughput of the workers popping from it.
+    """
+
+    # The status code and message of each fault, as the horde answers them
+    FAULTS = {
+        "stale": (404, "Processing Job with ID {id} does not exist"),
+        "bad_request": (400, "Input payload validation failed"),
+        "server_error": (503, "The horde is under maintenance"),
+        "timeout": (504, "Gateway timeout"),
+        "bad_json": (200, None),
+    }
+    IMAGE_SIZES = ((512, 512),)
+    INTERROGATION_FORMS = ("caption", "nsfw", "interrogation")
+
+    def __init__(
+        self,
+        pop_latency=0,
+        source_image_ratio=0,
+        model="stable_diffusion",
+        reward=10.0,
+        submit_latency=0,
+        empty_pop_ratio=0,
+        pop_faults=None,
+        submit_faults=None,
+        timeout_seconds=65,
+        image_sizes=IMAGE_SIZES,
+        steps=(20,),
+        post_processing=((),),
+        models=None,
+        seed=None,
+    ):
+        self.pop_latency = pop_latency
+        self.source_image_ratio = source_image_ratio
+        self.model = model
+        self.reward = reward
+        self.submit_latency = submit_latency
+        self.empty_pop_ratio = empty_pop_ratio
+        self.pop_faults = pop_faults or {}
+        self.submit_faults = submit_faults or {}
+        self.timeout_seconds = timeout_seconds
+        self.image_sizes = image_sizes
+        self.steps = steps
+        # The post-processors of each job are one of these, at random
+        self.post_processing = post_processing
+        # Model name -> jobs queued for it, for /status/models
+        self.models = models or {model: 100}
+        self.rng = random.Random(seed)
+        # Set to simulate an outage: every submit until then is answered with a 503
+        self.outage_until = 0
+        self.url = None
+        self.pops = 0
+        self.empty_pops = 0
+        self.submits = []
+        self.uploads = {}
+        # Job id -> when it was popped, and by which worker
+        self.popped = {}
+        # Seconds from the pop to the submit of each job
+        self.job_seconds = []
+        self.worker_jobs = {}
+        self.faults = dict.fromkeys(self.FAULTS, 0)
+        self.started = time.monotonic()
+        self._mutex = threading.Lock()
+        buffer = BytesIO()
+        Image.new("RGB", (512, 512), (128, 64, 32)).save(buffer, format="PNG")
+        self.source_image_bytes = buffer.getvalue()
+
+    def draw_fault(self, faults):
+        """Returns the fault to answer the request with, if any"""
+        roll = self.rng.random()
+        for fault, ratio in faults.items():
+            if roll < ratio:
+                with self._mutex:
+                    self.faults[fault] += 1
+                return fault
+            roll -= ratio
+        return None
+
+    def answer_fault(self, fault, job_id=None):
+        if fault == "timeout":
+            time.sleep(self.timeout_seconds)
+        status, message = self.FAULTS[fault]
+        if message is None:
+            return status, b"<html><body>502 Bad Gateway</body></html>"
+        return status, {"message": message.format(id=job_id)}
+
+    def start_job(self, payload, with_source):
+        """Registers a new job, and returns its id, and where to fetch its source and upload its result"""
+        job_id = str(uuid.uuid4())
+        with self._mutex:
+            self.popped[job_id] = (time.monotonic(), payload.get("name"))
+        source_image = f"{self.url}/r2/source/{job_id}.png" if with_source else None
+        return job_id, source_image, f"{self.url}/r2/upload/{job_id}"
+
+    def is_empty_pop(self):
+        if self.rng.random() < self.empty_pop_ratio:
+            with self._mutex:
+                self.empty_pops += 1
+            return True
+        return False
+
+    def generate_job(self, payload=None):
+        payload = payload or {}
+        with_source = self.source_image_ratio and self.pops % round(1 / self.source_image_ratio) == 0
+        job_id, source_image, r2_upload = self.start_job(payload, with_source)
+        width, height = self.rng.choice(self.image_sizes)
+        job = {
+            "id": job_id,
+            "model": self.rng.choice(payload.get("models") or [self.model]),
+            "payload": {
+                "prompt": "a fake prompt",
+                "height": height,
+                "width": width,
+                "ddim_steps": self.rng.choice(self.steps),
+                "sampler_name": "k_euler",
+                "cfg_scale": 7.5,
+                "seed": "1234",
+                "tiling": False,
+                "karras": False,
+                "n_iter": 1,
+                "post_processing": list(self.rng.choice(self.post_processing)),
+            },
+            "r2_upload": r2_upload,
+            "skipped": {},
+        }
+        if source_image:
+            job["source_image"] = source_image
+            job["source_processing"] = "img2img"
+        return job
+
+    def generate_text_job(self, payload):
+        job_id, _, _ = self.start_job(payload, False)
+        return {
+            "id": job_id,
+            "model": (payload.get("models") or [self.model])[0],
+            "payload": {
+                "prompt": "a fake prompt",
+                "n": 1,
+                "max_length": min(payload.get("max_length", 80), 80),
+                "max_context_length": min(payload.get("max_context_length", 1024), 1024),
+            },
+            "softprompt": None,
+            "skipped": {},
+        }
+
+    def generate_forms(self, payload):
+        forms = [form for form in payload.get("forms", self.INTERROGATION_FORMS) if form in self.INTERROGATION_FORMS]
+        jobs = []
+        for _ in range(payload.get("amount", 1) if forms else 0):
+            job_id, source_image, r2_upload = self.start_job(payload, True)
+            jobs.append(
+                {
+                    "id": job_id,
+                    "form": self.rng.choice(forms),
+                    "payload": {},
+                    "source_image": source_image,
+                    "r2_upload": r2_upload,
+                },
+            )
+        return {"forms": jobs, "skipped": {}}
+
+    def pop(self, payload, kind="image"):
+        time.sleep(self.pop_latency)
+        with self._mutex:
+            self.pops += 1
+        if fault := self.draw_fault({key: value for key, value in self.pop_faults.items() if key != "stale"}):
+            return self.answer_fault(fault)
+        if kind == "interrogation":
+            return 200, self.generate_forms({**payload, "amount": 0} if self.is_empty_pop() else payload)
+        if self.is_empty_pop():
+            return 200, {"id": None, "skipped": {"models": 1}}
+        if kind == "text":
+            return 200, self.generate_text_job(payload)
+        return 200, self.generate_job(payload)
+
+    def submit(self, payload):
+        time.sleep(self.submit_latency)
+        if time.monotonic() < self.outage_until:
+            return 503, {"message": "The horde is under maintenance"}
+        job_id = payload.get("id")
+        if fault := self.draw_fault(self.submit_faults):
+            if fault == "stale":
+                with self._mutex:
+                    self.popped.pop(job_id, None)
+            return self.answer_fault(fault, job_id)
+        with self._mutex:
+            self.submits.append(payload)
+            # Jobs which weren't popped from us are accepted, but not timed
+            if job_id in self.popped:
+                popped_at, worker = self.popped.pop(job_id)
+                self.job_seconds.append(time.monotonic() - popped_at)
+                self.worker_jobs[worker] = self.worker_jobs.get(worker, 0) + 1
+        return 200, {"reward": self.reward}
+
+    def get_model_statuses(self):
+        """The answer of /status/models, with every model served by one worker"""
+        return [
+            {"name": name, "count": 1, "performance": 1.0, "queued": queued, "jobs": queued, "eta": 0, "type": "image"}
+            for name, queued in self.models.items()
+        ]
+
+    def reset_stats(self):
+        """Starts measuring the throughput anew, to leave out the warm up of the workers"""
+        with self._mutex:
+            self.job_seconds = []
+            self.worker_jobs = {}
+            self.faults = dict.fromkeys(self.FAULTS, 0)
+            self.started = time.monotonic()
+
+    @staticmethod
+    def get_percentile(values, percentile):
+        """The value below which `percentile` percent of the sorted values are"""
+        if not values:
+            return None
+        return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+    def get_report(self):
+        """The throughput of the workers since the start or the last reset_stats()"""
+        with self._mutex:
+            job_seconds = sorted(self.job_seconds)
+            elapsed = time.monotonic() - self.started
+            report = {
+                "jobs": len(job_seconds),
+                "jobs_per_second": round(len(job_seconds) / elapsed, 2),
+                "workers": dict(self.worker_jobs),
+                "faults": {fault: count for fault, count in self.faults.items() if count},
+                # Popped but not submitted yet, or never will be
+                "open_jobs": len(self.popped),
+            }
+        for percentile in (50, 95, 99):
+            seconds = self.get_percentile(job_seconds, percentile)
+            report[f"p{percentile}_seconds"] = seconds and round(seconds, 3)
+        return report
+
+
+class FakeHordeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which stalls on delayed ACKs over keep-alive connections
+    disable_nagle_algorithm = True
+    pop_paths = {
+        "/api/v2/generate/pop": "image",
+        "/api/v2/generate/text/pop": "text",
+        "/api/v2/interrogate/pop": "interrogation",
+    }
+    submit_paths = ("/api/v2/generate/submit", "/api/v2/generate/text/submit", "/api/v2/interrogate/submit")
+
+    def log_message(self, format, *args):
+        """We don't want the default stderr access log"""
+
+    @property
+    def horde(self):
+        return self.server.horde
+
+    def send_json(self, status, payload):
+        if isinstance(payload, bytes):
+            # Not JSON at all, as a proxy in front of the horde may answer
+            self.send_bytes(status, payload, "text/html")
+            return
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_bytes(self, status, body, content_type="application/octet-stream"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def read_json(self):
+        body = self.read_body()
+        return json.loads(body) if body else {}
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path.startswith("/r2/source/"):
+            self.send_bytes(200, self.horde.source_image_bytes, "image/png")
+            return
+        if path == "/api/v2/status/models":
+            self.send_json(200, self.horde.get_model_statuses())
+            return
+        if path == "/api/v2/stats/img/models":
+            counts = {status["name"]: status["queued"] for status in self.horde.get_model_statuses()}
+            self.send_json(200, {"day": counts, "month": counts, "total": counts})
+            return
+        if path == "/api/v2/find_user":
+            self.send_json(200, {"username": "Fake User#1", "id": 1, "kudos": 0})
+            return
+        self.send_json(404, {"message": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path in self.pop_paths:
+            self.send_json(*self.horde.pop(self.read_json(), self.pop_paths[self.path]))
+            return
+        if self.path in self.submit_paths:
+            self.send_json(*self.horde.submit(self.read_json()))
+            return
+        self.read_body()
+        self.send_json(404, {"message": f"Unknown path {self.path}"})
+
+    def do_PUT(self):
+        if self.path.startswith("/r2/upload/"):
+            self.horde.uploads[self.path.rsplit("/", 1)[-1]] = len(self.read_body())
+            self.send_bytes(200, b"")
+            return
+        self.read_body()
+        self.send_json(404, {"message": f"Unknown path {self.path}"})
+
+
+class FakeHordeHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        """The workers hang up on the requests held by a timeout fault, which isn't worth a traceback"""
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeHordeServer:
+    """Serves a FakeHorde over HTTP on localhost from a background thread.
+
+    Usage:
+        with FakeHordeServer(FakeHorde(pop_latency=1)) as server:
+            bridge_data.horde_url = server.url
+    """
+
+    def __init__(self, horde=None, host="127.0.0.1", port=0):
+        self.horde = horde or FakeHorde()
+        self.httpd = FakeHordeHTTPServer((host, port), FakeHordeRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.horde = self.horde
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.horde.url = self.url
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,46 @@
+"""A stand-in for the hordelib SharedModelManager, for benchmarks and simulations which don't have a GPU"""
+import threading
+import time
+
+
+class FakeLoraManager:
+    def are_downloads_complete(self):
+        return True
+
+
+class FakeModelManager:
+    """Implements the parts of the hordelib model manager API the worker uses.
+
+    The models start loaded, unless loaded is False. Loading a model then sleeps for its load_seconds, or
+    for default_load_seconds, as if it were read from the disk."""
+
+    def __init__(self, model_names=None, loaded=True, load_seconds=None, default_load_seconds=0):
+        self.models = {}
+        self.loaded_models = {}
+        self.lora = FakeLoraManager()
+        self.load_seconds = load_seconds or {}
+        self.default_load_seconds = default_load_seconds
+        self._mutex = threading.Lock()
+        for model_name in model_names or ["stable_diffusion"]:
+            self.models[model_name] = {"name": model_name, "baseline": "stable diffusion 1", "nsfw": False}
+            if loaded:
+                self.loaded_models[model_name] = {}
+
+    def get_loaded_models_names(self):
+        with self._mutex:
+            return list(self.loaded_models)
+
+    def get_available_models(self):
+        return list(self.models)
+
+    def load(self, model_name, cpu_only=False):
+        if model_name not in self.models:
+            return None
+        time.sleep(self.load_seconds.get(model_name, self.default_load_seconds))
+        with self._mutex:
+            self.loaded_models[model_name] = {"cpu_only": cpu_only}
+        return True
+
+    def unload_model(self, model_name):
+        with self._mutex:
+            return self.loaded_models.pop(model_name, None) is not None
@@ -0,0 +1,458 @@
+"""Runs the scheduling of the worker on simulated time, against a replayed stream of jobs, to tune its settings.
+
+The main loop of WorkerFramework runs as it is. Only the ends are simulated: the clock, the thread pool of the
+jobs, the submit pool and the horde. Each job takes the time its recorded stages took. The inference of the
+jobs running at the same time shares the GPU, each getting an equal part of it, and a few threads get a
+little more done in total than one, as set by gpu_concurrency_gain.
+
+Hours of jobs replay in seconds, so max_threads, queue_size or max_power can be tried out on a laptop.
+
+Usage:
+    simulator = WorkerSimulator(read_job_trace("job_trace.jsonl"), FakeBridgeData(max_threads=2, ...))
+    print(simulator.run())
+"""
+import heapq
+import itertools
+import json
+import random
+from collections import deque
+
+from worker.jobs.framework import HordeJobFramework
+from worker.jobs.kudos import KudosModel
+from worker.workers.framework import WorkerFramework
+
+
+class RecordedJob:
+    """A job as it happened, with how long each of its stages took, in seconds"""
+
+    def __init__(
+        self,
+        model="stable_diffusion",
+        width=512,
+        height=512,
+        steps=30,
+        kudos=0,
+        pop=0.5,
+        prepare=0.05,
+        inference=5,
+        after=0.3,
+        submit=0.5,
+    ):
+        self.model = model
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.kudos = kudos
+        # The pop, and the download of the source images
+        self.pop = pop
+        self.prepare = prepare
+        self.inference = inference
+        # The safety checks and post-processing, after the inference
+        self.after = after
+        # The encode, upload and submit, on the submit pool
+        self.submit = submit
+
+    @classmethod
+    def from_trace(cls, trace):
+        """Makes the job out of a line of the job trace file (job_trace_file)"""
+        durations = {}
+        for stage in trace.get("stages", []):
+            durations[stage["stage"]] = durations.get(stage["stage"], 0) + stage["duration"]
+        return cls(
+            model=trace.get("model"),
+            width=trace.get("width") or 512,
+            height=trace.get("height") or 512,
+            steps=trace.get("steps") or 30,
+            kudos=float(trace.get("kudos") or 0),
+            pop=durations.get("pop", 0) + durations.get("download", 0),
+            prepare=durations.get("prepare", 0),
+            inference=durations.get("inference", 0),
+            after=durations.get("safety", 0) + durations.get("post_process", 0),
+            submit=durations.get("encode", 0) + durations.get("upload", 0) + durations.get("submit", 0),
+        )
+
+    def get_pixels(self):
+        return self.width * self.height
+
+
+def read_job_trace(filename):
+    """Returns the RecordedJob of each job of the trace file which was submitted"""
+    jobs = []
+    with open(filename, "rt", encoding="utf-8") as trace_file:
+        for line in trace_file:
+            if line.strip():
+                trace = json.loads(line)
+                if trace.get("status") in (None, "DONE"):
+                    jobs.append(RecordedJob.from_trace(trace))
+    return jobs
+
+
+def generate_jobs(count, rng, speed=1.0, models=("stable_diffusion",)):
+    """Returns count jobs of the usual sizes, on a GPU doing `speed` megapixelsteps per second, worth the kudos of
+    KudosModel.KUDOS_BASIS for a 512x512 image of 50 steps, in proportion"""
+    basis = KudosModel.BASIS_PAYLOAD
+    basis_megapixelsteps = basis["width"] * basis["height"] * basis["ddim_steps"] / 1e6
+    sizes = [(512, 512), (512, 768), (768, 768), (1024, 1024)]
+    jobs = []
+    for _ in range(count):
+        width, height = rng.choices(sizes, weights=(6, 3, 2, 1))[0]
+        steps = rng.choice((20, 25, 30, 40, 50))
+        megapixelsteps = width * height * steps / 1e6
+        jobs.append(
+            RecordedJob(
+                model=rng.choice(models),
+                width=width,
+                height=height,
+                steps=steps,
+                kudos=round(KudosModel.KUDOS_BASIS * megapixelsteps / basis_megapixelsteps, 2),
+                pop=rng.uniform(0.2, 1.5),
+                prepare=0.05,
+                inference=megapixelsteps / speed,
+                after=rng.uniform(0.1, 0.5),
+                submit=rng.uniform(0.2, 1.0),
+            ),
+        )
+    return jobs
+
+
+class SimulatedClock:
+    """Stands in for the time module in the scheduling: the time is the simulated one, in seconds"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+class SimulatedFuture:
+    """The future of a simulated job, done when the simulator says so"""
+
+    def __init__(self):
+        self._done = False
+        self.callbacks = []
+
+    def done(self):
+        return self._done
+
+    def running(self):
+        return not self._done
+
+    def exception(self, timeout=None):  # noqa: ARG002
+        return None
+
+    def cancel(self):
+        # Like the futures of running threads, they can't be cancelled
+        return False
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_done(self):
+        self._done = True
+        for callback in self.callbacks:
+            callback(self)
+
+
+class SimulatedExecutor:
+    """Takes the jobs the worker starts, and hands them to the simulator to be timed instead of run"""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def submit(self, run_job):
+        future = SimulatedFuture()
+        self.simulator.start_job(run_job.__self__, future)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class SimulatedJob:
+    """Stands in for a HordeJobFramework job, which goes stale the same way"""
+
+    max_job_lifetime = HordeJobFramework.max_job_lifetime
+
+    def __init__(self, record, clock):
+        self.record = record
+        self.clock = clock
+        self.current_model = record.model
+        self.start_time = clock.time()
+        self.stale_time = None
+        self.working = False
+        # Dropped by a restart of the worker
+        self.abandoned = False
+
+    def run_job(self):
+        raise RuntimeError("Simulated jobs are timed by the simulator, not run")
+
+    def start(self):
+        self.working = True
+        # As StableDiffusionHordeJob.start_job sets it
+        self.stale_time = self.clock.time() + self.record.steps * 5 + 10
+
+    def is_faulted(self):
+        return False
+
+    def is_out_of_memory(self):
+        return False
+
+    def is_stale(self):
+        if self.clock.time() - self.start_time > self.max_job_lifetime:
+            return True
+        return self.working and self.clock.time() > self.stale_time
+
+    def get_stale_deadline(self):
+        deadline = self.start_time + self.max_job_lifetime
+        if self.working:
+            return min(deadline, self.stale_time)
+        return min(deadline, self.clock.time() + 1)
+
+
+class SimulatedPopper:
+    """Pops the next job of the stream the worker can do, taking the time its pop took"""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.stages = []
+
+    def horde_pop(self):
+        record = self.simulator.pop()
+        return [record] if record else None
+
+
+class SimulatedSubmitter:
+    """The JobSubmitter on simulated time: submit_threads jobs are submitted at once, each taking the time its
+    encode, upload and submit took"""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.max_threads = 2
+        self.max_backlog = 10
+        self.backlog = 0
+        self.busy = 0
+        self.queue = deque()
+        self.listeners = []
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.max_threads = max(bridge_data.submit_threads, 1)
+        self.max_backlog = max(bridge_data.submit_backlog, 1)
+
+    def add_listener(self, callback):
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    def is_saturated(self):
+        return self.backlog >= self.max_backlog
+
+    def submit(self, job):
+        self.backlog += 1
+        self.queue.append(job)
+        self.start_next()
+
+    def start_next(self):
+        while self.busy < self.max_threads and self.queue:
+            job = self.queue.popleft()
+            self.busy += 1
+            self.simulator.schedule(job.record.submit, self.finish, job)
+
+    def finish(self, job):
+        self.busy -= 1
+        self.backlog -= 1
+        self.simulator.on_submitted(job)
+        self.start_next()
+        for callback in self.listeners:
+            callback()
+
+
+class SimulatedWorker(WorkerFramework):
+    """The worker, with its clock, thread pool, submitter and horde replaced by the simulator's"""
+
+    # The timers of the worker expire once their time is past, so waiting for them takes at least this long
+    min_wait = 0.01
+
+    def __init__(self, simulator, bridge_data):
+        super().__init__(None, bridge_data)
+        self.simulator = simulator
+        self.is_daemon = True
+        self.clock = simulator.clock
+        self.submitter = simulator.submitter
+        self.submitter.configure_from_bridge_data(bridge_data)
+        self.submitter.add_listener(self.on_submit_done)
+        self.executor = SimulatedExecutor(simulator)
+        self.bridge_data_snapshot = bridge_data.snapshot()
+        self.last_config_reload = self.clock.time()
+        self.last_stats_time = self.clock.time()
+        self.PopperClass = lambda _model_manager, _bridge_data: SimulatedPopper(simulator)
+        self.JobClass = lambda _model_manager, _bridge_data, record: SimulatedJob(record, simulator.clock)
+
+    def can_process_jobs(self):
+        return True
+
+    def reload_bridge_data(self):
+        # There's nothing to reload
+        self.last_config_reload = self.clock.time()
+
+    def wait_for_event(self, timeout):
+        self.simulator.advance(self.clock.time() + max(timeout, self.min_wait), until_woken=True)
+        self.wakeup_event.clear()
+
+
+class WorkerSimulator:
+    """Replays the jobs through the worker's scheduling, a discrete event at a time.
+
+    bridge_data needs max_threads, queue_size, max_power and submit_threads and submit_backlog, and can have
+    model_names, to only pop the jobs of those models. Jobs too big for max_power are left to other workers,
+    so a lower max_power can be simulated, but not a higher one than the jobs were recorded with.
+    empty_pop_ratio is the share of the pops which find no job, and empty_pop_seconds how long those take."""
+
+    # Simulated jobs are dropped from the GPU when their inference is done to within this many seconds
+    epsilon = 1e-6
+
+    def __init__(self, jobs, bridge_data, gpu_concurrency_gain=0.15, empty_pop_ratio=0, empty_pop_seconds=1, seed=0):
+        self.jobs = deque(jobs)
+        self.bridge_data = bridge_data
+        self.gpu_concurrency_gain = gpu_concurrency_gain
+        self.empty_pop_ratio = empty_pop_ratio
+        self.empty_pop_seconds = empty_pop_seconds
+        self.rng = random.Random(seed)
+        self.clock = SimulatedClock()
+        self.events = []
+        self.sequence = itertools.count()
+        # Job -> (seconds of inference left at full speed, future)
+        self.gpu = {}
+        self.submitter = SimulatedSubmitter(self)
+        # The simulated time after which no more jobs are popped
+        self.until = None
+        self.stats = {
+            "pops": 0,
+            "empty_pops": 0,
+            "skipped_jobs": 0,
+            "jobs": 0,
+            "kudos": 0,
+            "gpu_idle_seconds": 0,
+            "stale_jobs": 0,
+            "restarts": 0,
+        }
+        bridge_data.disable_terminal_ui = True
+        bridge_data.prefetch_jobs = False
+        self.worker = SimulatedWorker(self, bridge_data)
+
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self.events, (self.clock.now + delay, next(self.sequence), callback, args))
+
+    def get_gpu_rate(self):
+        """How fast each job running on the GPU progresses, 1 being as fast as alone"""
+        running = len(self.gpu)
+        return (1 + self.gpu_concurrency_gain * (running - 1)) / running
+
+    def advance(self, until, until_woken=False):
+        """Runs the events up to `until`, or until one wakes up the worker"""
+        while not (until_woken and self.worker.wakeup_event.is_set()):
+            rate = self.get_gpu_rate() if self.gpu else 0
+            next_gpu = self.clock.now + min(left for left, _ in self.gpu.values()) / rate if self.gpu else None
+            next_event = self.events[0][0] if self.events else None
+            step_end = min(time for time in (until, next_gpu, next_event) if time is not None)
+            elapsed = step_end - self.clock.now
+            if self.gpu:
+                for job, (left, future) in self.gpu.items():
+                    self.gpu[job] = (left - elapsed * rate, future)
+            else:
+                self.stats["gpu_idle_seconds"] += elapsed
+            self.clock.now = step_end
+            if next_gpu is not None and step_end == next_gpu:
+                for job, (left, future) in list(self.gpu.items()):
+                    if left <= self.epsilon:
+                        del self.gpu[job]
+                        self.schedule(job.record.after, self.finish_job, job, future)
+            elif next_event is not None and step_end == next_event:
+                _, _, callback, args = heapq.heappop(self.events)
+                callback(*args)
+            elif step_end >= until:
+                return
+
+    def pop(self):
+        """Returns the next job of the stream the worker can do, or None, after the time the pop took"""
+        self.stats["pops"] += 1
+        max_pixels = 64 * 64 * 8 * self.bridge_data.max_power
+        model_names = getattr(self.bridge_data, "model_names", None)
+        while self.jobs:
+            record = self.jobs[0]
+            if record.get_pixels() <= max_pixels and (not model_names or record.model in model_names):
+                break
+            self.jobs.popleft()
+            self.stats["skipped_jobs"] += 1
+        if not self.jobs or (self.until is not None and self.clock.now >= self.until):
+            # With queue_size 0, the worker keeps popping as long as it has free threads, so we end the pass of
+            # its main loop here. run() lets it carry on, to finish its jobs
+            self.worker.should_stop = True
+        if self.worker.should_stop or self.rng.random() < self.empty_pop_ratio:
+            self.stats["empty_pops"] += 1
+            self.advance(self.clock.now + self.empty_pop_seconds)
+            return None
+        record = self.jobs.popleft()
+        self.advance(self.clock.now + record.pop)
+        return record
+
+    def start_job(self, job, future):
+        job.start()
+        self.schedule(job.record.prepare, self.start_inference, job, future)
+
+    def start_inference(self, job, future):
+        self.gpu[job] = (job.record.inference, future)
+
+    def finish_job(self, job, future):
+        job.working = False
+        if not job.abandoned:
+            self.submitter.submit(job)
+        future.set_done()
+
+    def on_submitted(self, job):
+        self.stats["jobs"] += 1
+        self.stats["kudos"] += job.record.kudos
+
+    def is_done(self):
+        worker = self.worker
+        return not (self.jobs or worker.running_jobs or worker.waiting_jobs or self.submitter.backlog)
+
+    def run(self, duration=None):
+        """Runs the worker until the jobs run out, or for `duration` simulated seconds. Returns the report"""
+        worker = self.worker
+        self.until = duration
+        while not self.is_done() and (duration is None or self.clock.now < duration):
+            running = {job for _, _, job in worker.running_jobs}
+            worker.process_jobs()
+            worker.should_stop = False
+            if worker.should_restart:
+                # The jobs the worker gave up on run to the end, but aren't submitted
+                for job in running - {job for _, _, job in worker.running_jobs}:
+                    if job.working:
+                        job.abandoned = True
+                        self.stats["stale_jobs"] += 1
+                self.stats["restarts"] += 1
+                worker.should_restart = False
+                worker.on_restart()
+                worker.run_count = 0
+        return self.get_report()
+
+    def get_report(self):
+        hours = max(self.clock.now, 1) / 3600
+        return {
+            "simulated_hours": round(self.clock.now / 3600, 2),
+            "jobs": self.stats["jobs"],
+            "jobs_per_hour": round(self.stats["jobs"] / hours, 1),
+            "kudos_per_hour": round(self.stats["kudos"] / hours),
+            "gpu_idle_percent": round(100 * self.stats["gpu_idle_seconds"] / max(self.clock.now, 1), 1),
+            "stale_jobs": self.stats["stale_jobs"],
+            "restarts": self.stats["restarts"],
+            "pops": self.stats["pops"],
+            "empty_pops": self.stats["empty_pops"],
+            "skipped_jobs": self.stats["skipped_jobs"],
+        }
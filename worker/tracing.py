@@ -0,0 +1,120 @@
+"""Times the stages of each job, from its pop to its submit"""
+import json
+import random
+import threading
+import time
+
+from worker.logger import log_stage, logger
+from worker.metrics import metrics
+
+metrics.describe("horde_worker_job_stage_seconds", "histogram", "How long each stage of the jobs took")
+metrics.describe("horde_worker_job_seconds", "histogram", "How long the jobs took, from their pop to their submit")
+
+
+class JobTimeline:
+    """The stages a job went through, with when each started and ended (in time.monotonic()).
+
+    A job begins each stage as the previous one ends, so only the boundaries need marking. The stages which
+    happen before the job exists (its pop, the download of its source images) are recorded by the popper.
+    The timeline is written to by the job's thread, then by its submit thread, never by both at once."""
+
+    def __init__(self, worker_type):
+        self.worker_type = worker_type
+        self.created = time.monotonic()
+        self.created_wall_time = time.time()
+        # (stage, start, end), in the order they ended
+        self.stages = []
+        # (stage, start) of the stage in progress
+        self.current = None
+        # Anything else worth knowing about the job, e.g. its id or model
+        self.attributes = {}
+
+    def record(self, stage, start, end):
+        self.stages.append((stage, start, end))
+
+    def begin(self, stage):
+        """Ends the stage in progress, if any, and starts the next one"""
+        now = time.monotonic()
+        self.end(now)
+        self.current = (stage, now)
+        log_stage.set(stage)
+
+    def end(self, now=None):
+        """Ends the stage in progress, if any"""
+        if self.current:
+            stage, start = self.current
+            self.stages.append((stage, start, now if now is not None else time.monotonic()))
+            self.current = None
+            log_stage.set(None)
+
+    def get_durations(self):
+        """Stage -> how long it took in total, in seconds"""
+        durations = {}
+        for stage, start, end in self.stages:
+            durations[stage] = round(durations.get(stage, 0) + end - start, 4)
+        return durations
+
+    def get_total(self):
+        origin = min([self.created, *(start for _, start, _ in self.stages)])
+        return max([self.created, *(end for _, _, end in self.stages)]) - origin
+
+    def to_dict(self):
+        """The timeline as JSON, with the stages starting from the first one, in seconds"""
+        origin = min([self.created, *(start for _, start, _ in self.stages)])
+        return {
+            **self.attributes,
+            "worker": self.worker_type,
+            "time": round(self.created_wall_time - (self.created - origin), 3),
+            "total": round(self.get_total(), 4),
+            "stages": [
+                {"stage": stage, "start": round(start - origin, 4), "duration": round(end - start, 4)}
+                for stage, start, end in sorted(self.stages, key=lambda stage: stage[1])
+            ],
+        }
+
+
+class JobTracer:
+    """Aggregates the finished timelines into the per stage histograms of the metrics, and writes a sample
+    of them to a JSONL trace file, one timeline per line"""
+
+    def __init__(self):
+        self.trace_file = None
+        self.sample_rate = 1.0
+        self.file = None
+        self._mutex = threading.Lock()
+
+    def configure(self, trace_file=None, sample_rate=None):
+        with self._mutex:
+            if sample_rate is not None:
+                self.sample_rate = min(max(float(sample_rate), 0), 1)
+            if trace_file is not None and trace_file != self.trace_file:
+                self.trace_file = trace_file
+                if self.file:
+                    self.file.close()
+                    self.file = None
+
+    def configure_from_bridge_data(self, bridge_data):
+        self.configure(trace_file=bridge_data.job_trace_file, sample_rate=bridge_data.job_trace_sample_rate)
+
+    def finish(self, timeline):
+        timeline.end()
+        for stage, start, end in timeline.stages:
+            metrics.observe("horde_worker_job_stage_seconds", end - start, worker=timeline.worker_type, stage=stage)
+        metrics.observe("horde_worker_job_seconds", timeline.get_total(), worker=timeline.worker_type)
+        logger.bind(duration=round(timeline.get_total(), 4), durations=timeline.get_durations()).debug(
+            f"Job {timeline.attributes.get('id')} took {timeline.get_total():.2f} seconds",
+        )
+        if not self.trace_file or random.random() >= self.sample_rate:
+            return
+        line = json.dumps(timeline.to_dict()) + "\n"
+        with self._mutex:
+            try:
+                if self.file is None:
+                    self.file = open(self.trace_file, "a", encoding="utf-8")  # noqa: SIM115
+                self.file.write(line)
+                self.file.flush()
+            except OSError as err:
+                logger.warning(f"Failed to write the job trace to {self.trace_file}: {err}")
+
+
+job_tracer = JobTracer()
@@ -17,7 +17,8 @@ import pkg_resources
 import psutil
 import requests
 
-from worker.logger import config, logger
+from worker.logger import config, is_not_suppressed, logger
+from worker.sessions import http_session
 from worker.stats import bridge_stats
 from worker.utils.gpuinfo import GPUInfo
 
@@ -168,7 +169,7 @@ class TerminalUI:
         newconfig = {"handlers": handlers}
         logger.configure(**newconfig)
         # Add our own handler
-        logger.add(self.input, level="DEBUG")
+        logger.add(self.input, level="DEBUG", filter=is_not_suppressed)
         locale.setlocale(locale.LC_ALL, "")
         self.initialise_main_window()
         self.resize()
@@ -628,7 +629,7 @@ class TerminalUI:
                     continue
                 workers_url = f"{self.url}/api/v2/workers"
                 try:
-                    r = requests.get(workers_url, headers={"client-agent": TerminalUI.CLIENT_AGENT}, timeout=5)
+                    r = http_session.get(workers_url, headers={"client-agent": TerminalUI.CLIENT_AGENT}, timeout=5)
                 except requests.exceptions.Timeout:
                     logger.warning("Timeout while waiting for worker ID from API")
                 except requests.exceptions.RequestException as ex:
@@ -661,7 +662,7 @@ class TerminalUI:
         else:
             logger.warning("Attempting to disable maintenance mode.")
         worker_URL = f"{self.url}/api/v2/workers/{self.worker_id}"
-        res = requests.put(worker_URL, json=payload, headers=header)
+        res = http_session.put(worker_URL, json=payload, headers=header)
         if not res.ok:
             logger.error(f"Maintenance mode failed: {res.text}")
 
@@ -671,7 +672,7 @@ class TerminalUI:
                 return
             worker_URL = f"{self.url}/api/v2/workers/{self.worker_id}"
             try:
-                r = requests.get(worker_URL, headers={"client-agent": TerminalUI.CLIENT_AGENT}, timeout=5)
+                r = http_session.get(worker_URL, headers={"client-agent": TerminalUI.CLIENT_AGENT}, timeout=5)
             except requests.exceptions.Timeout:
                 logger.warning("Worker info API failed to respond in time")
                 return
@@ -701,7 +702,7 @@ class TerminalUI:
         try:
             url = f"{self.url}/api/v2/status/performance"
             try:
-                r = requests.get(url, headers={"client-agent": TerminalUI.CLIENT_AGENT}, timeout=10)
+                r = http_session.get(url, headers={"client-agent": TerminalUI.CLIENT_AGENT}, timeout=10)
             except requests.exceptions.Timeout:
                 pass
             except requests.exceptions.RequestException:
@@ -733,12 +734,13 @@ class TerminalUI:
             elif self.scribe_worker:
                 self.total_models = "See KAI"
         # Recent job pop times
-        if "pop_time_avg_5_mins" in bridge_stats.stats:
-            self.pop_time = bridge_stats.stats["pop_time_avg_5_mins"]
-        if "jobs_per_hour" in bridge_stats.stats:
-            self.jobs_per_hour = bridge_stats.stats["jobs_per_hour"]
-        if "avg_kudos_per_job" in bridge_stats.stats:
-            self.avg_kudos_per_job = bridge_stats.stats["avg_kudos_per_job"]
+        stats = bridge_stats.snapshot()
+        if "pop_time_avg_5_mins" in stats:
+            self.pop_time = stats["pop_time_avg_5_mins"]
+        if "jobs_per_hour" in stats:
+            self.jobs_per_hour = stats["jobs_per_hour"]
+        if "avg_kudos_per_job" in stats:
+            self.avg_kudos_per_job = stats["avg_kudos_per_job"]
 
         if time.time() - self.last_stats_refresh > TerminalUI.REMOTE_STATS_REFRESH:
             self.last_stats_refresh = time.time()
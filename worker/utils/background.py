@@ -0,0 +1,94 @@
+"""Background removal with rembg, on long lived sessions.
+rembg is only imported once a background is removed, as the workers which never remove any may not have it."""
+import contextlib
+import threading
+import time
+
+
+class RembgSessionPool:
+    """Keeps the rembg sessions loaded between requests, instead of loading the ONNX model for every image.
+
+    Sessions are created lazily, per model, up to max_sessions of them. Each is checked out by one thread
+    at a time, and threads wait for one to be checked back in when they're all in use.
+    Sessions which stay unused for idle_timeout seconds are dropped, to give their memory back."""
+
+    def __init__(self, max_sessions=1, idle_timeout=300):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        # Model name -> the sessions waiting to be checked out, with the time they were checked in
+        self.idle_sessions = {}
+        # Model name -> how many sessions are checked out, or being created
+        self.busy_sessions = {}
+        self._condition = threading.Condition()
+
+    def configure(self, max_sessions=None, idle_timeout=None):
+        with self._condition:
+            if max_sessions is not None:
+                self.max_sessions = max(int(max_sessions), 1)
+            if idle_timeout is not None:
+                self.idle_timeout = float(idle_timeout)
+            self._condition.notify_all()
+
+    def count_sessions(self, model_name):
+        return self.busy_sessions.get(model_name, 0) + len(self.idle_sessions.get(model_name, []))
+
+    def evict_idle(self):
+        """Drops the sessions which have been idle for longer than idle_timeout. Returns how many were dropped"""
+        evicted = 0
+        with self._condition:
+            now = time.monotonic()
+            for model_name, sessions in self.idle_sessions.items():
+                fresh_sessions = [entry for entry in sessions if now - entry[1] < self.idle_timeout]
+                evicted += len(sessions) - len(fresh_sessions)
+                self.idle_sessions[model_name] = fresh_sessions
+            if evicted:
+                self._condition.notify_all()
+        return evicted
+
+    def acquire(self, model_name):
+        with self._condition:
+            while True:
+                if self.idle_sessions.get(model_name):
+                    session, _ = self.idle_sessions[model_name].pop()
+                    self.busy_sessions[model_name] = self.busy_sessions.get(model_name, 0) + 1
+                    return session
+                if self.count_sessions(model_name) < self.max_sessions:
+                    self.busy_sessions[model_name] = self.busy_sessions.get(model_name, 0) + 1
+                    break
+                self._condition.wait()
+        # Loading the model takes a while, so the other threads are not kept waiting for it
+        try:
+            import rembg
+
+            return rembg.new_session(model_name)
+        except Exception:
+            with self._condition:
+                self.busy_sessions[model_name] -= 1
+                self._condition.notify_all()
+            raise
+
+    def release(self, model_name, session):
+        with self._condition:
+            self.busy_sessions[model_name] -= 1
+            if self.count_sessions(model_name) < self.max_sessions:
+                self.idle_sessions.setdefault(model_name, []).append((session, time.monotonic()))
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def checkout(self, model_name):
+        session = self.acquire(model_name)
+        try:
+            yield session
+        finally:
+            self.release(model_name, session)
+
+
+rembg_sessions = RembgSessionPool()
+
+
+def remove_background(image, model_name, alpha_matting_options):
+    """Returns the image with its background removed, on one of the pooled sessions"""
+    import rembg
+
+    with rembg_sessions.checkout(model_name) as session:
+        return rembg.remove(image, session=session, only_mask=False, **alpha_matting_options)
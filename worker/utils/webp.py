@@ -0,0 +1,61 @@
+"""WebP encoding of the generated images, as run by the encode threads"""
+import contextlib
+import os
+import tempfile
+import time
+from io import BytesIO
+
+
+class EncodedImage:
+    """The WebP bytes of an encoded image. Either kept in memory, or spooled to a file when they're too big,
+    so that large (e.g. upscaled) outputs don't sit in the worker's memory until they're uploaded.
+
+    In memory, they're exposed through a memoryview, so that uploads don't need to copy them."""
+
+    def __init__(self, data=None, path=None, size=0):
+        self.data = data
+        self.path = path
+        self.size = size
+        # How many bytes the worker had to copy to get hold of this result. The encoding buffer is kept as is
+        self.bytes_copied = 0
+
+    def is_spooled(self):
+        return self.path is not None
+
+    def get_buffer(self):
+        """Returns the bytes without copying them when they're in memory. Spooled bytes are read from their file"""
+        if self.is_spooled():
+            with open(self.path, "rb") as spool:
+                return memoryview(spool.read())
+        if isinstance(self.data, BytesIO):
+            return self.data.getbuffer()
+        return memoryview(self.data)
+
+    def open_upload_body(self):
+        """Returns something to use as a request body, which streams from the file when the bytes are spooled"""
+        if self.is_spooled():
+            return open(self.path, "rb")
+        return contextlib.nullcontext(self.get_buffer())
+
+    def close(self):
+        if self.is_spooled():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+            self.path = None
+
+
+def encode_webp(image, quality, method, spool_threshold=None):
+    """Encodes a PIL image to WebP. Returns the EncodedImage and how many seconds the encoding took.
+    Results bigger than spool_threshold bytes are written to a temporary file. Otherwise the encoding buffer
+    itself is kept, instead of a copy of its bytes."""
+    start = time.perf_counter()
+    buffer = BytesIO()
+    image.save(buffer, format="WebP", quality=quality, method=method)
+    size = buffer.tell()
+    if spool_threshold is not None and size > spool_threshold:
+        with tempfile.NamedTemporaryFile(prefix="horde-upload-", suffix=".webp", delete=False) as spool:
+            spool.write(buffer.getbuffer())
+        encoded = EncodedImage(path=spool.name, size=size)
+    else:
+        encoded = EncodedImage(data=buffer, size=size)
+    return encoded, time.perf_counter() - start
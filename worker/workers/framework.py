@@ -4,14 +4,31 @@ import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 
+from worker.jobs.prefetcher import JobPrefetcher
+from worker.jobs.source_cache import source_cache
+from worker.jobs.submitter import job_submitter
 from worker.logger import logger
+from worker.metrics import metrics
+from worker.model_loader import model_loader
 from worker.stats import bridge_stats
+from worker.tracing import job_tracer
 
 
 class WorkerFramework:
+    # How often (in seconds) we reload the bridge configuration
+    config_reload_interval = 60
+    # The longest the main loop will sleep without an event, as a safety net for missed wakeups
+    max_idle_wait = 5
+
     def __init__(self, this_model_manager, this_bridge_data):
         self.model_manager = this_model_manager
         self.bridge_data = this_bridge_data
+        # Where the scheduling gets the time from, and hands the finished jobs over to. The simulator
+        # replaces them, to run the scheduling on simulated time
+        self.clock = time
+        self.submitter = job_submitter
+        # What jobs and poppers get to see of the bridge data. Refreshed on every reload
+        self.bridge_data_snapshot = None
         self.running_jobs = []
         self.waiting_jobs = []
         self.run_count = 0
@@ -25,9 +42,14 @@ class WorkerFramework:
         self.out_of_memory_jobs = 0
         self.soft_restarts = 0
         self.executor = None
+        self.prefetcher = None
+        # False while can_process_jobs() says we should not be picking up jobs
+        self.accepting_jobs = False
         self.ui = None
         self.ui_class = None
-        self.last_stats_time = time.time()
+        self.last_stats_time = self.clock.time()
+        # Set whenever something the main loop should react to happens (job completion, new pops, stop requests)
+        self.wakeup_event = threading.Event()
         logger.stats("Starting new stats session")
         # These two should be filled in by the extending classes
         self.PopperClass = None
@@ -50,9 +72,16 @@ class WorkerFramework:
             from worker.ui import TerminalUI
 
             self.ui_class = TerminalUI(self.bridge_data)
-            self.ui = threading.Thread(target=self.ui_class.run, daemon=True)
+            self.ui = threading.Thread(target=self.run_terminal_ui, daemon=True)
             self.ui.start()
 
+    def run_terminal_ui(self):
+        """Runs the terminal UI and wakes up the main loop when it exits, so that we can shut down"""
+        try:
+            self.ui_class.run()
+        finally:
+            self.wake()
+
     def on_restart(self):
         """Called when the worker loop is restarted. Make sure to invoke super().on_restart() when overriding."""
         self.soft_restarts += 1
@@ -61,12 +90,21 @@ class WorkerFramework:
     def stop(self):
         self.should_stop = True
         self.ui_class.stop()
+        self.wake()
         logger.info("Stop methods called")
 
     @logger.catch(reraise=True)
     def start(self):
         self.reload_data()
         self.exit_rc = 1
+        self.submitter.add_listener(self.on_submit_done)
+        model_loader.add_listener(self.on_model_loaded)
+        if self.bridge_data.metrics_port:
+            metrics.add_collector(self.collect_metrics)
+            metrics.start_server(self.bridge_data.metrics_port, self.bridge_data.metrics_host)
+        if self.bridge_data.prefetch_jobs:
+            self.prefetcher = JobPrefetcher(self)
+            self.prefetcher.start()
 
         self.consecutive_failed_jobs = 0  # Moved out of the loop to capture failure across soft-restarts
 
@@ -96,39 +134,94 @@ class WorkerFramework:
                         logger.error("Too many soft restarts, exiting the worker. Please review your config.")
                         logger.error("You can try asking for help in the official discord if this persists.")
                     logger.init("Worker", status="Shutting Down")
+                    if self.prefetcher:
+                        self.prefetcher.stop()
                     if self.is_daemon:
                         return
                     else:  # noqa: RET505
                         sys.exit(self.exit_rc)
 
     def process_jobs(self):
-        # logger.debug("Cron: Starting process_jobs()")
-        if time.time() - self.last_config_reload > 60:
+        if self.clock.time() - self.last_config_reload > self.config_reload_interval:
             self.reload_bridge_data()
         if not self.can_process_jobs():
-            # logger.debug("Cron: SLEEPING FOR 5 SECONDS")
-            time.sleep(5)
+            self.accepting_jobs = False
+            self.wait_for_event(5)
             return
-        # Add job to queue if we have space
-        if len(self.waiting_jobs) < self.bridge_data.queue_size:
-            # logger.debug("Cron: Starting to add job to queue")
+        self.accepting_jobs = True
+        # Add job to queue if we have space. The prefetcher already took care of the space for us.
+        if self.prefetcher or len(self.waiting_jobs) < self.bridge_data.queue_size:
             self.add_job_to_queue()
-            # logger.debug("Cron: End to add job to queue")
         # Start new jobs
-        # logger.debug("Cron: Starting to start new jobs")
         while len(self.running_jobs) < self.bridge_data.max_threads and self.start_job():
             pass
-        # logger.debug("Cron: End of start new jobs")
         # Check if any jobs are done
-        # logger.debug("Cron: Starting to check if jobs are done")
-        for job_thread, start_time, job in self.running_jobs:
+        for job_thread, start_time, job in self.running_jobs.copy():
             self.check_running_job_status(job_thread, start_time, job)
             if self.should_restart or self.should_stop:
-                break
-        # logger.debug("Cron: End of check if jobs are done")
-        # Give the CPU a break
-        time.sleep(0.02)
-        # logger.debug("Cron: End process_jobs()")
+                return
+        if self.prefetcher:
+            # Completed jobs have been removed, so the prefetcher might be able to pop more
+            self.prefetcher.notify()
+        # If we can start or pop a job, we go straight back to it. Popping blocks on the horde anyway.
+        # Otherwise there is nothing to do until a job finishes, a job is prefetched or one of our timers expires.
+        if not self.has_free_job_slots():
+            self.wait_for_event(self.get_next_wakeup_timeout())
+
+    def has_free_job_slots(self):
+        """Returns True when the next pass of the main loop can start or pop a job without waiting"""
+        can_pop = not self.prefetcher and not self.submitter.is_saturated()
+        if len(self.running_jobs) < self.bridge_data.max_threads and (self.waiting_jobs or can_pop):
+            return True
+        return can_pop and len(self.waiting_jobs) < self.bridge_data.queue_size
+
+    def get_job_demand(self):
+        """Returns how many more jobs we can hold between our running threads and the local queue"""
+        if not self.accepting_jobs or self.should_stop or self.should_restart:
+            return 0
+        # Backpressure from the submit backlog, we don't pick up work we can't hand back
+        if self.submitter.is_saturated():
+            return 0
+        return (
+            self.bridge_data.max_threads
+            + self.bridge_data.queue_size
+            - len(self.running_jobs)
+            - len(self.waiting_jobs)
+        )
+
+    def wake(self):
+        """Wakes up the main loop. Safe to call from any thread."""
+        self.wakeup_event.set()
+
+    def on_job_done(self, _job_future):
+        """Completion callback for the job futures. It runs in the executor thread, so it only wakes up the loop
+        and leaves the actual processing to check_running_job_status()"""
+        self.wake()
+
+    def on_submit_done(self):
+        """Called by the job submitter whenever a submission finishes, so that we resume popping if we had stopped"""
+        if self.prefetcher:
+            self.prefetcher.notify()
+        self.wake()
+
+    def on_model_loaded(self, _model):
+        """Called by the model loader whenever a model is loaded, so that we start popping for it straight away"""
+        self.wake()
+
+    def wait_for_event(self, timeout):
+        """Sleeps until something wakes us up, or the timeout expires"""
+        self.wakeup_event.wait(max(timeout, 0))
+        # Anything which happened before this point will be seen by the pass following this wait
+        self.wakeup_event.clear()
+
+    def get_next_wakeup_timeout(self):
+        """Returns how long we can sleep before one of our timers needs servicing"""
+        now = self.clock.time()
+        deadlines = [now + self.max_idle_wait, self.last_config_reload + self.config_reload_interval]
+        if self.running_jobs and self.bridge_data.stats_output_frequency:
+            deadlines.append(self.last_stats_time + self.bridge_data.stats_output_frequency)
+        deadlines.extend(job.get_stale_deadline() for _, _, job in self.running_jobs)
+        return min(deadlines) - now
 
     def can_process_jobs(self):
         """This function returns true when this worker can start polling for jobs from the AI Horde
@@ -136,21 +229,27 @@ class WorkerFramework:
         return False
 
     def add_job_to_queue(self):
-        """Picks up a job from the horde and adds it to the local queue
+        """Picks up a job from the horde (or the prefetcher) and adds it to the local queue
         Returns the job object created, if any"""
-        if jobs := self.pop_job():
+        jobs = self.prefetcher.take_jobs() if self.prefetcher else self.pop_job()
+        if jobs:
             self.waiting_jobs.extend(jobs)
 
     def pop_job(self):
         """Polls the AI Horde for new jobs and creates as many Job classes needed
         As the amount of jobs returned"""
-        job_popper = self.PopperClass(self.model_manager, self.bridge_data)
+        if self.submitter.is_saturated():
+            logger.debug("Submit backlog is full. Not picking up new jobs until it drains")
+            return None
+        job_popper = self.PopperClass(self.model_manager, self.bridge_data_snapshot)
         pops = job_popper.horde_pop()
         if not pops:
             return None
         new_jobs = []
         for pop in pops:
-            new_job = self.JobClass(self.model_manager, self.bridge_data, pop)
+            new_job = self.JobClass(self.model_manager, self.bridge_data_snapshot, pop)
+            for stage in job_popper.stages:
+                new_job.timeline.record(*stage)
             new_jobs.append(new_job)
         return new_jobs
 
@@ -160,7 +259,7 @@ class WorkerFramework:
         Returns False to break out of the loop and poll the horde again"""
         job = None
         # Queue disabled
-        if self.bridge_data.queue_size == 0:
+        if self.bridge_data.queue_size == 0 and not self.prefetcher:
             if jobs := self.pop_job():
                 job = jobs[0]
             if self.should_stop:
@@ -172,7 +271,9 @@ class WorkerFramework:
             return False
         # Run the job
         if job:
-            self.running_jobs.append((self.executor.submit(job.start_job), time.monotonic(), job))
+            job_thread = self.executor.submit(job.run_job)
+            self.running_jobs.append((job_thread, self.clock.monotonic(), job))
+            job_thread.add_done_callback(self.on_job_done)
             logger.debug("New job processing")
         else:
             logger.debug("No new job to start")
@@ -180,7 +281,7 @@ class WorkerFramework:
 
     def check_running_job_status(self, job_thread, start_time, job):
         """Polls the AI Horde for new jobs and creates a Job class"""
-        runtime = time.monotonic() - start_time
+        runtime = self.clock.monotonic() - start_time
         if job_thread.done():
             if job_thread.exception(timeout=1) or job.is_faulted():
                 if job_thread.exception(timeout=1):
@@ -231,13 +332,24 @@ class WorkerFramework:
         # Check periodically if any interesting stats should be announced
         if (
             self.bridge_data.stats_output_frequency
-            and (time.time() - self.last_stats_time) > self.bridge_data.stats_output_frequency
+            and (self.clock.time() - self.last_stats_time) > self.bridge_data.stats_output_frequency
         ):
             bonus_per_hour = self.get_uptime_kudos()
-            self.last_stats_time = time.time()
+            self.last_stats_time = self.clock.time()
             kph = bridge_stats.stats.get("kudos_per_hour", 0) + bonus_per_hour
             logger.info(f"Estimated average kudos per hour: {kph}")
 
+    def collect_metrics(self):
+        """Returns the gauges and counters of the worker loop, for the metrics endpoint"""
+        return [
+            ("horde_worker_waiting_jobs", {}, len(self.waiting_jobs)),
+            ("horde_worker_running_jobs", {}, len(self.running_jobs)),
+            ("horde_worker_soft_restarts_total", {}, self.soft_restarts),
+            ("horde_worker_out_of_memory_jobs_total", {}, self.out_of_memory_jobs),
+            ("horde_worker_consecutive_failed_jobs", {}, self.consecutive_failed_jobs),
+            ("horde_worker_consecutive_executor_restarts", {}, self.consecutive_executor_restarts),
+        ]
+
     def get_uptime_kudos(self):
         """Returns the expected uptime kudos for this worker
         This should be extended for each type of worker
@@ -250,8 +362,15 @@ class WorkerFramework:
         # Daemons are fed the configuration externally
         if not self.is_daemon:
             self.bridge_data.reload_data()
+        self.bridge_data_snapshot = self.bridge_data.snapshot()
+        self.submitter.configure_from_bridge_data(self.bridge_data)
+        job_tracer.configure_from_bridge_data(self.bridge_data)
+        model_loader.configure_from_bridge_data(self.bridge_data)
+        source_cache.configure_from_bridge_data(self.bridge_data)
 
     def reload_bridge_data(self):
         self.reload_data()
         self.executor._max_workers = self.bridge_data.max_threads
-        self.last_config_reload = time.time()
+        if self.prefetcher:
+            self.prefetcher.resize()
+        self.last_config_reload = self.clock.time()
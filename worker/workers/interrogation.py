@@ -2,6 +2,7 @@
 from worker.jobs.interrogation import InterrogationHordeJob
 from worker.jobs.poppers import InterrogationPopper
 from worker.logger import logger
+from worker.post_process import background_remover
 from worker.workers.framework import WorkerFramework
 
 
@@ -24,6 +25,8 @@ class InterrogationWorker(WorkerFramework):
     def reload_data(self):
         """This is just a utility function to reload the configuration"""
         super().reload_data()
+        background_remover.configure_from_bridge_data(self.bridge_data)
+        background_remover.evict_idle()
         self.bridge_data.check_models(self.model_manager)
         self.bridge_data.reload_models(self.model_manager)
 
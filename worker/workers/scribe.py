@@ -1,6 +1,4 @@
 """This is the scribe worker, it's the main workhorse that deals with getting requests, and spawning data processing"""
-import time
-
 from worker.jobs.poppers import ScribePopper
 from worker.jobs.scribe import ScribeHordeJob
 from worker.workers.framework import WorkerFramework
@@ -16,7 +14,7 @@ class ScribeWorker(WorkerFramework):
         kai_avail = self.bridge_data.kai_available
         if not kai_avail:
             # We do this to allow the worker to try and reload the config every 5 seconds until the KAI server is up
-            self.last_config_reload = time.time() - 55
+            self.last_config_reload = self.clock.time() - 55
         return kai_avail
 
     # We want this to be extendable as well
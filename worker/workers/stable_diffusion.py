@@ -3,16 +3,21 @@ import math
 import time
 import traceback
 
-import requests
+import psutil
 from hordelib.comfy_horde import cleanup, garbage_collect, get_models_on_gpu, get_torch_free_vram_mb
-from hordelib.horde import HordeLib
 from hordelib.utils.gpuinfo import GPUInfo
 from typing_extensions import override
 
 from worker.consts import KNOWN_INTERROGATORS, POST_PROCESSORS_HORDELIB_MODELS
+from worker.inference import inference
+from worker.jobs.encoder import image_encoder
 from worker.jobs.poppers import StableDiffusionPopper
 from worker.jobs.stable_diffusion import StableDiffusionHordeJob
 from worker.logger import logger
+from worker.model_loader import model_loader
+from worker.post_process import background_remover
+from worker.residency import residency_planner
+from worker.sessions import http_session
 from worker.workers.framework import WorkerFramework
 
 
@@ -21,6 +26,7 @@ class StableDiffusionWorker(WorkerFramework):
         super().__init__(this_model_manager, this_bridge_data)
         self.PopperClass = StableDiffusionPopper
         self.JobClass = StableDiffusionHordeJob
+        self.warned_over_budget = False
 
     # Setting it as it's own function so that it can be overriden
     def can_process_jobs(self):
@@ -61,32 +67,24 @@ class StableDiffusionWorker(WorkerFramework):
     def calculate_dynamic_models(self):
         if self.bridge_data.models_reloading:
             return
-        all_models_data = requests.get(f"{self.bridge_data.horde_url}/api/v2/status/models", timeout=10).json()
+        all_models_data = http_session.get(f"{self.bridge_data.horde_url}/api/v2/status/models", timeout=10).json()
+        residency_planner.record_status(all_models_data)
         # We remove models with no queue from our list of models to load dynamically
         models_data = [md for md in all_models_data if md["queued"] > 0]
         models_data.sort(key=lambda x: (x["eta"], x["queued"]), reverse=True)
         top_5 = [x["name"] for x in models_data[:5]]
         logger.stats(f"Top 5 models by load: {', '.join(top_5)}")
-        total_models = self.bridge_data.predefined_models.copy()
-        new_dynamic_models = []
+        # Models waiting in the queue or running stay loaded, but count towards the amount of dynamic models,
+        # as we may run out of RAM/VRAM otherwise
         running_models = self.get_running_models()
-        # Sometimes a dynamic model is wwaiting in the queue,
-        # and we do not wan to unload it
-        # However we also don't want to keep it loaded
-        # + the full amount of dynamic models
-        # as we may run out of RAM/VRAM.
-        # So we reduce the amount of dynamic models
-        # based on how many previous dynamic models we need to keep loaded
+        pinned = list(set(self.bridge_data.predefined_models + running_models))
         needed_previous_dynamic_models = sum(
             model_name not in self.bridge_data.predefined_models for model_name in running_models
         )
+        candidates = []
         for model in models_data:
             if model["name"] in self.bridge_data.models_to_skip:
                 continue
-            if model["name"] in total_models:
-                continue
-            if len(new_dynamic_models) + needed_previous_dynamic_models >= self.bridge_data.number_of_dynamic_models:
-                break
             # If we've limited the amount of models to download,
             # then we skip models which are not already downloaded
             if (
@@ -94,15 +92,52 @@ class StableDiffusionWorker(WorkerFramework):
                 and model["name"] not in self.model_manager.get_available_models()
             ):
                 continue
-            total_models.append(model["name"])
-            new_dynamic_models.append(model["name"])
-        logger.info(
-            "Dynamically loading new models to attack the relevant queue: {}",
-            new_dynamic_models,
+            candidates.append(model["name"])
+        plan = residency_planner.plan(
+            all_models_data,
+            candidates,
+            pinned=pinned,
+            budget_mb=self.get_model_memory_budget(),
+            max_models=max(self.bridge_data.number_of_dynamic_models - needed_previous_dynamic_models, 0),
+            sizes=self.get_model_sizes(set(candidates) | set(pinned) | set(residency_planner.resident)),
+            load_seconds=model_loader.load_seconds,
+            capacity=residency_planner.get_capacity(self.bridge_data.max_threads),
         )
+        residency_planner.apply(plan)
+        if plan.over_budget and not self.warned_over_budget:
+            self.warned_over_budget = True
+            logger.warning(
+                "The dynamic models {} don't fit in the RAM and VRAM left by ram_to_leave_free and "
+                "vram_to_leave_free. They're still loaded, into hordelib's disk cache, but the models which fit "
+                "are preferred. Lower number_of_dynamic_models if swapping them is too slow",
+                plan.over_budget,
+            )
+        if plan.load:
+            logger.info("Dynamically loading new models to attack the relevant queue: {}", plan.load)
+        if plan.evict:
+            logger.info("Unloading dynamic models which are no longer worth keeping: {}", plan.evict)
         # Ensure we don't unload currently queued models
         with self.bridge_data.mutex:
-            self.bridge_data.model_names = list(set(total_models + running_models))
+            self.bridge_data.model_names = list(set(pinned + plan.keep))
+
+    def get_model_memory_budget(self):
+        """The megabytes the models may fill, going by ram_to_leave_free and vram_to_leave_free.
+        hordelib keeps every loaded model in RAM, and also moves those in use into VRAM, so the budgets don't add
+        up: the models only all fit if they fit in each of them"""
+        ram_mb = psutil.virtual_memory().total / 1024 / 1024
+        vram_mb = GPUInfo().get_total_vram_mb()
+        ram_budget = residency_planner.get_memory_budget(ram_mb, self.bridge_data.ram_to_leave_free)
+        vram_budget = residency_planner.get_memory_budget(vram_mb, self.bridge_data.vram_to_leave_free)
+        return min(ram_budget, vram_budget)
+
+    def get_model_sizes(self, model_names):
+        """The megabytes of the models whose reference gives their size"""
+        sizes = {}
+        for model_name in model_names:
+            size = self.model_manager.models.get(model_name, {}).get("size_on_disk_bytes")
+            if size:
+                sizes[model_name] = size / 1024 / 1024
+        return sizes
 
     def reload_data(self):
         models_on_gpu = len(get_models_on_gpu())
@@ -124,6 +159,10 @@ class StableDiffusionWorker(WorkerFramework):
                 self.should_restart = True
                 return
         super().reload_data()
+        image_encoder.configure_from_bridge_data(self.bridge_data)
+        residency_planner.configure_from_bridge_data(self.bridge_data)
+        background_remover.configure_from_bridge_data(self.bridge_data)
+        background_remover.evict_idle()
         self.bridge_data.check_models(self.model_manager)
         self.bridge_data.reload_models(self.model_manager)
 
@@ -216,12 +255,11 @@ class StableDiffusionWorker(WorkerFramework):
         job_base["model"] = model_to_try
         job_base["request_type"] = "txt2img"
 
-        hordelib = HordeLib()
         logger.info(f"Running a basic inference job of {test_resolution}x{test_resolution} to test the worker...")
 
         stale_time = time.time() + (job_base.get("ddim_steps", 50) * 5) + 10 + 10
 
-        resulting_image = hordelib.basic_inference(job_base)
+        resulting_image = inference.basic_inference(job_base)
         shared_error_messages = [
             ("It is very likely the worker is not configured correctly for this system."),
             ("Consider lowering your `max_power` in your bridgeData."),
@@ -252,7 +290,7 @@ class StableDiffusionWorker(WorkerFramework):
                 "model": "RealESRGAN_x4plus",
                 "source_image": resulting_image,
             }
-            upscale_check = hordelib.image_upscale(pp_payload)
+            upscale_check = inference.image_upscale(pp_payload)
             if not upscale_check:
                 logger.error("Failed to run a basic upscale job. This is a critical error.")
                 for error_message in shared_error_messages: